@@ -1,10 +1,14 @@
 import os
+import shutil
 import logging
 import datetime as dt
 import math
 import multiprocessing as mp
 import pandas as pd
 
+from amlrgliders.staging import OutputStager
+from amlrgliders.storage import LocalStorage
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,18 +24,135 @@ def line_prepender(filename, line):
         f.write(line.rstrip('\r\n') + '\n' + content)
 
 
-def amlr_acoustics_metadata(gdm, deployment_mode, glider_path):
+def acoustics_data_frames(data, pitch_column, roll_column, lat_column, 
+                          lon_column, depth_column):
+    """
+    Create the pitch, roll, GPS, and depth data frames for acoustics files
+    
+    Args:
+        data (DataFrame): gdm data
+        pitch_column, roll_column, lat_column, lon_column, depth_column (str): 
+            names of the columns of data to use
+
+    Returns:
+        dict: data frames, with keys pitch, roll, gps, and depth
+    """
+    gdm_dt_dt = data.index.values.astype('datetime64[s]').astype(dt.datetime)
+
+    # Pitch
+    logger.info(f'Creating Pitch file')
+    pitch_dict = {'Pitch_date': [i.strftime('%m/%d/%Y') for i in gdm_dt_dt], 
+                  'Pitch_time': [i.strftime('%H:%M:%S') for i in gdm_dt_dt], 
+                  'Pitch_angle': [math.degrees(x) for x in data[pitch_column]]}
+
+    # Roll
+    logger.info(f'Creating Roll file')
+    roll_dict = {'Roll_date': [i.strftime('%m/%d/%Y') for i in gdm_dt_dt],
+                  'Roll_time': [i.strftime('%H:%M:%S') for i in gdm_dt_dt], 
+                  'Roll_angle': [math.degrees(x) for x in data[roll_column]]}
+
+    # GPS
+    logger.info(f'Creating GPS file')
+    gps_dict = {'GPS_date': [i.strftime('%Y-%m-%d') for i in gdm_dt_dt],
+                  'GPS_time': [i.strftime('%H:%M:%S') for i in gdm_dt_dt], 
+                  'Latitude': data[lat_column], 
+                  'Longitude': data[lon_column]}
+
+    # Depth
+    logger.info(f'Creating Depth file')
+    depth_dict = {'Depth_date': [i.strftime('%Y%m%d') for i in gdm_dt_dt],
+                  'Depth_time': [f"{i.strftime('%H%M%S')}0000" for i in gdm_dt_dt], 
+                  'Depth': data[depth_column], 
+                  'repthree': 3}
+
+    return {
+        'pitch': pd.DataFrame(pitch_dict), 
+        'roll': pd.DataFrame(roll_dict), 
+        'gps': pd.DataFrame(gps_dict), 
+        'depth': pd.DataFrame(depth_dict), 
+    }
+
+
+def acoustics_splice_window(data, pitch_column, roll_column, lat_column, 
+                            lon_column, depth_column, csv_files, depth_rows_file, 
+                            start, end):
+    """
+    Replace the rows of the time window [start, end) in existing acoustics 
+    files with those created from data (see csv_splice_window). 
+    Acoustics file times are whole seconds, so the window is widened 
+    to whole seconds
+
+    Args:
+        data (DataFrame): gdm data of the time window, 
+            and of at least the seconds of start and end
+        pitch_column, roll_column, lat_column, lon_column, depth_column (str): 
+            names of the columns of data to use
+        csv_files (dict): local paths of the pitch, roll, and gps csv files
+        depth_rows_file (str): local path of the rows of the depth file, 
+            ie without its header
+        start (Timestamp): window start, or None
+        end (Timestamp): window end, or None
+
+    Returns:
+        int: number of rows of the depth file
+    """
+    from amlrgliders.chunked import csv_splice_window, data_window
+
+    # Rows of times truncated to the seconds of start and end are replaced
+    start = start.floor('s') if start is not None else None
+    end = end.ceil('s') if end is not None else None
+    acoustics_dfs = acoustics_data_frames(
+        data_window(data, start, end), pitch_column, roll_column, 
+        lat_column, lon_column, depth_column)
+    csv_times = {
+        'pitch': lambda df: pd.to_datetime(
+            df.Pitch_date + ' ' + df.Pitch_time, format='%m/%d/%Y %H:%M:%S'), 
+        'roll': lambda df: pd.to_datetime(
+            df.Roll_date + ' ' + df.Roll_time, format='%m/%d/%Y %H:%M:%S'), 
+        'gps': lambda df: pd.to_datetime(
+            df.GPS_date + ' ' + df.GPS_time, format='%Y-%m-%d %H:%M:%S'), 
+    }
+    for i, csv_file in csv_files.items():
+        csv_splice_window(
+            csv_file, acoustics_dfs[i], start, end, csv_times[i], index = False)
+
+    # Depth rows have no header; times are eg 20230101 1234560000
+    return csv_splice_window(
+        depth_rows_file, acoustics_dfs['depth'], start, end, 
+        lambda df: pd.to_datetime(df[0] + df[1].str[:6], format='%Y%m%d%H%M%S'), 
+        index = False, header = False, sep = '\t')
+
+
+def amlr_acoustics_metadata(gdm, deployment_mode, glider_path, scratch_path=None, 
+                            storage=None, catalog=None, windows=None, 
+                            start=None, end=None):
     """
     Create files for acoustics data processing, 
-    using the interpolated variables
+    using the interpolated variables. 
+    Files are written to local staging, and then uploaded
     
     Args:
         gdm (GliderDataModel): gdm object created by amlr_gdm
         glider_path (str): path to glider folder
         deployment (str): 
         mode (str): deployment-mode string, eg amlr##-YYYYmmdd-delayed
+        scratch_path (str, optional): directory for local staging. 
+            Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for glider_path. 
+            Defaults to None, meaning LocalStorage.
+        catalog (AmlrCatalog, optional): deployment catalog in which 
+            to record the written files. Defaults to None.
+        windows (GdmWindows, optional): if given, files are written 
+            one time window at a time, rather than from gdm.data. 
+            Defaults to None.
+        start (Timestamp, optional): if start or end are given, gdm.data 
+            are those of the time window [start, end) (see amlr_gdm), 
+            and their rows replace those of the window in the existing 
+            acoustics files. The rows are created from gdm.data_overlap, 
+            if present (see acoustics_splice_window). Defaults to None.
+        end (Timestamp, optional): end of the time window. Defaults to None.
         
-    Returns: 0
+    Returns: 0, or None if the files could not be written or uploaded
     """
 
     lat_column = 'ilatitude'
@@ -46,61 +167,85 @@ def amlr_acoustics_metadata(gdm, deployment_mode, glider_path):
     # Check that all required variables are present
     acoustic_vars_list = [pitch_column, roll_column, depth_column, lat_column, lon_column]
     acoustic_vars_set = set(acoustic_vars_list)
-    if not acoustic_vars_set.issubset(gdm.data.columns):
+    data_columns = gdm.data.columns if windows is None else windows.columns
+    if not acoustic_vars_set.issubset(data_columns):
         logger.error('gdm object does not contain all required columns. ' + 
-            f"Missing columns: {', '.join(acoustic_vars_set.difference(gdm.data.columns))}")
-        return()
+            f"Missing columns: {', '.join(acoustic_vars_set.difference(data_columns))}")
+        return None
 
+    # Directory is created by OutputStager, if necessary
     acoustics_path = os.path.join(glider_path, 'data', 'out', 'acoustics')
-    if not os.path.exists(acoustics_path):
-        logger.info(f'Creating directory at: {acoustics_path}')
-        os.makedirs(acoustics_path)
-
-    gdm_dt_dt = gdm.data.index.values.astype('datetime64[s]').astype(dt.datetime)
-    acoustic_file_pre = os.path.join(acoustics_path, deployment_mode)
+    acoustics_names = [f'{deployment_mode}-{i}.csv' for i in ['pitch', 'roll', 'gps']] + \
+        [f'{deployment_mode}-depth.evl']
+
+    time_range = start is not None or end is not None
+    if time_range:
+        if storage is None:
+            storage = LocalStorage()
+        missing = [
+            i for i in acoustics_names 
+            if not storage.exists(os.path.join(acoustics_path, i))
+        ]
+        if len(missing) > 0:
+            logger.error(f"The acoustics files {', '.join(missing)} do not exist, " + 
+                         'and thus their time window cannot be replaced')
+            return None
     
     logger.info(f'Writing acoustics files to {acoustics_path}')
-
-    # Pitch
-    logger.info(f'Creating Pitch file')
-    pitch_dict = {'Pitch_date': [i.strftime('%m/%d/%Y') for i in gdm_dt_dt], 
-                  'Pitch_time': [i.strftime('%H:%M:%S') for i in gdm_dt_dt], 
-                  'Pitch_angle': [math.degrees(x) for x in gdm.data[pitch_column]]}
-    pitch_df = pd.DataFrame(pitch_dict)
-    pitch_df.to_csv(f'{acoustic_file_pre}-pitch.csv', index = False)
-
-
-    # Roll
-    logger.info(f'Creating Roll file')
-    roll_dict = {'Roll_date': [i.strftime('%m/%d/%Y') for i in gdm_dt_dt],
-                  'Roll_time': [i.strftime('%H:%M:%S') for i in gdm_dt_dt], 
-                  'Roll_angle': [math.degrees(x) for x in gdm.data[roll_column]]}
-    roll_df = pd.DataFrame(roll_dict)
-    roll_df.to_csv(f'{acoustic_file_pre}-roll.csv', index = False)
-
-
-    # GPS
-    logger.info(f'Creating GPS file')
-    gps_dict = {'GPS_date': [i.strftime('%Y-%m-%d') for i in gdm_dt_dt],
-                  'GPS_time': [i.strftime('%H:%M:%S') for i in gdm_dt_dt], 
-                  'Latitude': gdm.data[lat_column], 
-                  'Longitude': gdm.data[lon_column]}
-    gps_df = pd.DataFrame(gps_dict)
-    gps_df.to_csv(f'{acoustic_file_pre}-gps.csv', index = False)
-
-
-    # Depth
-    logger.info(f'Creating Depth file')
-    depth_dict = {'Depth_date': [i.strftime('%Y%m%d') for i in gdm_dt_dt],
-                  'Depth_time': [f"{i.strftime('%H%M%S')}0000" for i in gdm_dt_dt], 
-                  'Depth': gdm.data[depth_column], 
-                  'repthree': 3}
-    depth_df = pd.DataFrame(depth_dict)
-    depth_file = f'{acoustic_file_pre}-depth.evl'
-    depth_df.to_csv(depth_file, index = False, header = False, sep ='\t')
-            
-    line_prepender(depth_file, str(len(depth_df.index)))
-    line_prepender(depth_file, 'EVBD 3 8.0.73.30735')
+    try:
+        with OutputStager(acoustics_path, scratch_path, storage=storage) as stager:
+            csv_files = {
+                i: stager.path(f'{deployment_mode}-{i}.csv') for i in ['pitch', 'roll', 'gps']
+            }
+            depth_file = stager.path(f'{deployment_mode}-depth.evl')
+            depth_rows_file = f'{depth_file}.rows'
+
+            if time_range:
+                # Replace the rows of the time window in the existing files
+                for i in acoustics_names:
+                    storage.get(os.path.join(acoustics_path, i), stager.path(i))
+                with open(depth_file, 'r') as f_in, open(depth_rows_file, 'w') as f_out:
+                    f_in.readline()
+                    f_in.readline()
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(depth_file)
+                n_depth = acoustics_splice_window(
+                    getattr(gdm, 'data_overlap', gdm.data), pitch_column, roll_column, 
+                    lat_column, lon_column, depth_column, csv_files, depth_rows_file, 
+                    start, end)
+
+            else:
+                # Append the rows of each time window
+                n_depth = 0
+                data_iter = (i for i, _ in windows) if windows is not None else [gdm.data]
+                for k, data in enumerate(data_iter):
+                    acoustics_dfs = acoustics_data_frames(
+                        data, pitch_column, roll_column, lat_column, lon_column, depth_column)
+                    for i, csv_file in csv_files.items():
+                        acoustics_dfs[i].to_csv(
+                            csv_file, index = False, mode = 'a', header = k == 0)
+                    acoustics_dfs['depth'].to_csv(
+                        depth_rows_file, index = False, header = False, sep ='\t', mode = 'a')
+                    n_depth += len(acoustics_dfs['depth'].index)
+                    del acoustics_dfs
+
+            # The depth file starts with a header and its number of rows
+            with open(depth_file, 'w') as f_out, open(depth_rows_file, 'r') as f_in:
+                f_out.write('EVBD 3 8.0.73.30735\n')
+                f_out.write(f'{n_depth}\n')
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(depth_rows_file)
+    except Exception as e:
+        logger.error(f'Unable to write the acoustics files: {e}')
+        return None
+
+    if catalog is not None:
+        deployment, mode = deployment_mode.rsplit('-', 1)
+        catalog.record_files(
+            deployment, mode, 'acoustics', acoustics_path, stager.uploaded)
+    if len(stager.failed) > 0:
+        logger.error(f"Acoustics files {', '.join(stager.failed)} could not be uploaded")
+        return None
 
     logger.info(f'Acoustics files created for {deployment_mode}')
     return 0
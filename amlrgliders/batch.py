@@ -0,0 +1,337 @@
+"""
+Batch processing of multiple deployments (amlr-batch), eg reprocessing
+all deployments of a project and year. Deployments are run with
+amlr_process, concurrently, and share one worker pool.
+A deployment is started once its estimated memory fits in the memory budget
+alongside the deployments that are running; deployments too large
+for the budget on their own are processed out of core (see chunked.py)
+"""
+
+import os
+import sys
+import copy
+import time
+import logging
+import argparse
+import threading
+import multiprocessing as mp
+
+from amlrgliders.utils import amlr_year_path
+from amlrgliders.storage import amlr_storage
+from amlrgliders.parallel import available_memory, worker_base_bytes, \
+    binary_dba_ratio, default_parse_ratio, amlr_pool
+from amlrgliders.process import amlr_process, amlr_process_options
+
+logger = logging.getLogger(__name__)
+
+
+def amlr_batch_deployments(deployments_path, project, year, storage):
+    """
+    Get the deployments of a project and year, ie the deployment folders
+    in deployments_path/project/year
+
+    Args:
+        deployments_path (str): path to glider deployments directory
+        project (str): glider project name
+        year (str): year string, as from amlr_year_path, eg '2022-23'
+        storage (Storage): storage backend for deployments_path
+
+    Returns:
+        list: deployment names, or None if the year directory does not exist
+    """
+    year_path = os.path.join(deployments_path, project, year)
+    if not storage.isdir(year_path):
+        logger.error(f'The year directory {year_path} does not exist')
+        return None
+
+    deployments = []
+    for i in storage.list(year_path):
+        i = i.rstrip('/')
+        deployment_split = i.split('-')
+        if len(deployment_split) != 2 or not deployment_split[1].isdigit() \
+                or len(deployment_split[1]) != 8:
+            logger.debug(f'Skipping {i}, which is not a deployment name')
+            continue
+        if amlr_year_path(project, deployment_split) != year:
+            logger.warning(f'Skipping {i}, which is not a {year} deployment')
+            continue
+        deployments.append(i)
+
+    return deployments
+
+
+def amlr_deployment_memory(deployments_path, project, deployment, mode, storage):
+    """
+    Estimate the peak memory, in bytes, of processing a deployment in memory:
+    the parsed data of all dba files, and a copy when concatenating them.
+    Sizes are from the dba files if they exist, and otherwise from
+    the binary files
+
+    Returns:
+        float: estimated memory in bytes
+    """
+    glider_path = os.path.join(
+        deployments_path, project, amlr_year_path(project, deployment.split('-')),
+        deployment)
+    ascii_path = os.path.join(glider_path, 'data', 'ascii', mode)
+    binary_path = os.path.join(glider_path, 'data', 'binary', mode)
+
+    if storage.isdir(ascii_path):
+        dba_bytes = sum(i[1] for i in storage.walk_stats(
+            ascii_path, recursive=False, checksum=False))
+    elif storage.isdir(binary_path):
+        dba_bytes = binary_dba_ratio * sum(i[1] for i in storage.walk_stats(
+            binary_path, recursive=False, checksum=False))
+    else:
+        dba_bytes = 0
+
+    return 2 * default_parse_ratio * dba_bytes
+
+
+class BatchScheduler:
+    """
+    Admit deployments to run concurrently within a memory budget,
+    in order. A deployment may start if its estimate fits alongside the 
+    running deployments, or if nothing is running; at most max_concurrent
+    deployments run at once
+
+        scheduler.acquire(k, estimate)
+        try:
+            amlr_process(...)
+        finally:
+            scheduler.release(estimate)
+    """
+
+    def __init__(self, memory_budget, max_concurrent):
+        self.memory_budget = memory_budget
+        self.max_concurrent = max_concurrent
+        self.in_use = 0
+        self.running = 0
+        self.next = 0
+        self._cond = threading.Condition()
+
+    def _fits(self, estimate):
+        if self.running == 0:
+            return True
+        return self.running < self.max_concurrent and \
+            self.in_use + estimate <= self.memory_budget
+
+    def acquire(self, k, estimate):
+        """
+        Wait until deployment k (in order, from 0) may start
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.next == k and self._fits(estimate))
+            self.in_use += estimate
+            self.running += 1
+            self.next += 1
+            self._cond.notify_all()
+
+    def release(self, estimate):
+        with self._cond:
+            self.in_use -= estimate
+            self.running -= 1
+            self._cond.notify_all()
+
+
+def amlr_batch(args):
+    """
+    Process multiple deployments, sharing one worker pool.
+    Deployments are started in order, each once its estimated memory fits
+    in the memory budget (see BatchScheduler). Deployments whose
+    estimate exceeds the budget are processed out of core,
+    in time windows of args.window_rows rows (or 1000000 rows, if 0)
+
+    Args:
+        args (Namespace): parsed arguments, from amlr_batch_parser
+
+    Returns:
+        DataFrame: seconds of each stage (columns) of each deployment (rows),
+        with a status column; or None if no deployments were found
+    """
+    project = args.project
+    mode = args.mode
+    deployments_path = args.deployments_path
+    storage = amlr_storage(deployments_path, args.deployments_bucket)
+
+    if args.deployments:
+        deployments = args.deployments
+    elif args.year != '':
+        deployments = amlr_batch_deployments(
+            deployments_path, project, args.year, storage)
+    else:
+        logger.error('Either --year or --deployments must be specified')
+        return None
+    if not deployments:
+        logger.error('There are no deployments to process')
+        return None
+
+    numcores = args.numcores if args.numcores > 0 else mp.cpu_count()
+    memory_budget = args.memory_budget * 1e9 if args.memory_budget > 0 \
+        else 0.8 * available_memory()
+    # Memory left for deployment data, after the worker processes
+    data_budget = max(memory_budget - numcores * worker_base_bytes, 0)
+    logger.info(f'Processing {len(deployments)} deployment(s) with a shared pool ' +
+                f'of {numcores} core(s), and a memory budget of ' +
+                f'{memory_budget / 1e9:.1f} GB')
+
+    estimates = {}
+    for deployment in deployments:
+        estimates[deployment] = amlr_deployment_memory(
+            deployments_path, project, deployment, mode, storage)
+        logger.info(f'{deployment}: estimated memory ' +
+                    f'{estimates[deployment] / 1e9:.2f} GB')
+
+    scheduler = BatchScheduler(data_budget, args.max_concurrent)
+    timers = {}
+
+    def run_deployment(k, deployment):
+        deployment_args = copy.copy(args)
+        deployment_args.deployment = deployment
+        # Shared pool, so each deployment uses all of its cores
+        deployment_args.numcores = numcores
+        estimate = estimates[deployment]
+        if estimate > data_budget:
+            logger.warning(f'{deployment} may not fit in the memory budget, ' +
+                           'and will be processed out of core')
+            if deployment_args.window_rows <= 0:
+                deployment_args.window_rows = 1000000
+            estimate = data_budget
+
+        scheduler.acquire(k, estimate)
+        try:
+            timers[deployment] = amlr_process(deployment_args, pool)
+        except Exception:
+            logger.exception(f'Processing failed for {deployment}')
+            timers[deployment] = None
+        finally:
+            scheduler.release(estimate)
+
+    t_start = time.perf_counter()
+    with amlr_pool(numcores) as pool:
+        threads = []
+        for k, deployment in enumerate(deployments):
+            thread = threading.Thread(
+                target=run_deployment, args=(k, deployment), name=deployment)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    t_elapsed = time.perf_counter() - t_start
+
+    report = amlr_batch_report(deployments, timers)
+    logger.info(f'Batch processing complete in {t_elapsed:.1f} seconds. ' +
+                f'Stage timings (seconds):\n{report.to_string()}')
+    if args.report_file != '':
+        logger.info(f'Writing batch report to {args.report_file}')
+        report.to_csv(args.report_file)
+
+    return report
+
+
+def amlr_batch_report(deployments, timers):
+    """
+    Aggregate the stage timings of each deployment
+
+    Args:
+        deployments (list): deployment names
+        timers (dict): StageTimer (or None, if processing failed)
+            of each deployment
+
+    Returns:
+        DataFrame: seconds of each stage (columns) of each deployment (rows),
+        with total and status columns, and a total row
+    """
+    import pandas as pd
+    rows = {}
+    for deployment in deployments:
+        timer = timers.get(deployment)
+        row = {}
+        if timer is not None:
+            for name, t, _ in timer.timings:
+                row[name] = row.get(name, 0) + t
+        row['total'] = sum(row.values())
+        row['status'] = 'complete' if timer is not None else 'failed'
+        rows[deployment] = row
+
+    report = pd.DataFrame.from_dict(rows, orient='index')
+    report.index.name = 'deployment'
+    stage_columns = [i for i in report.columns if i not in ['total', 'status']]
+    report = report[stage_columns + ['total', 'status']]
+    report[stage_columns + ['total']] = report[stage_columns + ['total']].round(1)
+    report.loc['total'] = report[stage_columns + ['total']].sum().tolist() + \
+        [f"{(report['status'] == 'complete').sum()}/{len(deployments)} complete"]
+
+    return report
+
+
+def amlr_batch_parser():
+    """
+    Get the argument parser for amlr-batch
+    """
+    arg_parser = argparse.ArgumentParser(
+        description='Process multiple AMLR glider deployments, ' +
+            'eg all deployments of a project and year, sharing one worker pool',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        allow_abbrev=False)
+
+    arg_parser.add_argument('project',
+        type=str,
+        help='Glider project name',
+        choices=['FREEBYRD', 'REFOCUS', 'SANDIEGO'])
+
+    arg_parser.add_argument('mode',
+        type=str,
+        help="Deployment mode. 'delayed' means [de]bd files will be used, " +
+            "and 'rt' means [st]bd files will be used",
+        choices=['delayed', 'rt'])
+
+    arg_parser.add_argument('deployments_path',
+        type=str,
+        help='Path to glider deployments directory. ' +
+            'In GCP, this will be the mounted bucket path')
+
+    arg_parser.add_argument('--year',
+        type=str,
+        help="Year directory of the deployments to process, eg '2022-23' " +
+            "for FREEBYRD or '2022' for other projects",
+        default='')
+
+    arg_parser.add_argument('--deployments',
+        type=str,
+        nargs='+',
+        help='Deployments to process, eg amlr03-20220425. ' +
+            'If specified, --year is ignored')
+
+    arg_parser.add_argument('--max_concurrent',
+        type=int,
+        help='Maximum number of deployments to process at once',
+        default=2)
+
+    arg_parser.add_argument('--report_file',
+        type=str,
+        help='Path of a CSV file to which to write the stage timings ' +
+            'of each deployment. If empty (the default), not written',
+        default='')
+
+    return amlr_process_options(arg_parser)
+
+
+def main(argv=None):
+    """
+    Entry point for amlr-batch
+    """
+    args = amlr_batch_parser().parse_args(argv)
+
+    log_level = getattr(logging, args.loglevel.upper())
+    log_format = '%(threadName)s:%(module)s:%(levelname)s:%(message)s [line %(lineno)d]'
+    logging.basicConfig(format=log_format, level=log_level)
+
+    report = amlr_batch(args)
+    if report is None:
+        return 1
+    return 0 if (report['status'].iloc[:-1] == 'complete').all() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
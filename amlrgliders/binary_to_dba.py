@@ -0,0 +1,429 @@
+import os
+import time
+import logging
+import tempfile
+import multiprocessing as mp
+from subprocess import run
+
+from amlrgliders.utils import amlr_year_path
+from amlrgliders.slocum import amlr_sensor_filter, dba_summary, amlr_decompress_files, \
+    dba_compress_files, dba_segments
+from amlrgliders.storage import LocalStorage, UploadError
+from amlrgliders.metrics import metric_set
+
+logger = logging.getLogger(__name__)
+
+
+def amlr_binary_to_dba(deployment, project, mode, deployments_path,
+                       processDbds_file, cac2lower_file, linuxbin_path,
+                       sensor_filter=False, numcores=0, compress_dba='none',
+                       scratch_path=None, storage=None, catalog=None,
+                       work_path=None, pool=None, filter_report_segments=2,
+                       unmerged=False):
+    """
+    Wrapper around cac2lower.sh and processDbds.sh;
+    Makes cac files lowercase and creates dbas
+
+    Args:
+        deployment (str): Deployment name, eg amlr##-YYYYmmdd
+        project (str): Project name, eg FREEBYRD
+        mode (str): deployment mode; delayed or rt
+        deployments_path (str): path to glider deployments directory
+        processDbds_file (str): path to processDbds shell script
+        cac2lower_file (str): path to cac2lower shell script
+        linuxbin_path (str): path to linux-bin directory
+        sensor_filter (bool, optional): only write the sensors in
+            sensor_defs.yml and amlr_gdm_varnames to the dba files?
+            Defaults to False.
+        numcores (int, optional): number of cores to use when decompressing
+            and compressing files. If 0 (the default), all cores are used
+        compress_dba (str, optional): compression for dba files;
+            one of 'none', 'gzip', or 'zstd'. Defaults to 'none'.
+        scratch_path (str, optional): directory for local copies of
+            bucket files, for non-local storage. Defaults to None,
+            meaning $TMPDIR
+        storage (Storage, optional): storage backend for deployments_path.
+            Defaults to None, meaning LocalStorage
+        catalog (AmlrCatalog, optional): deployment catalog in which to
+            record the binary and dba files, and status. Defaults to None.
+        work_path (str, optional): for non-local storage, directory for
+            the local copies, which is not removed so the dba files can be
+            read by the next stage. Defaults to None, meaning a temporary
+            directory that is removed
+        pool (mp.Pool, optional): existing worker pool to use,
+            rather than creating one. Defaults to None.
+        filter_report_segments (int, optional): with sensor_filter, the
+            number of segments converted with and without the filter for
+            the savings report (see amlr_sensor_filter_report).
+            If 0, there is no report. Defaults to 2.
+        unmerged (bool, optional): write the flight and science dba files
+            of each segment unmerged (processDbds -u), rather than merged
+            by dba_merge? They are then merged in memory when read
+            (see amlr_dba_merge). Defaults to False.
+
+    Returns:
+        str: path to the directory with the dba files,
+        which is local if work_path was given. None if there was an error
+    """
+
+    if storage is None:
+        storage = LocalStorage()
+
+    # Checks
+    if not storage.isdir(deployments_path):
+        logger.error(f'deployments_path ({deployments_path}) does not exist')
+        return
+
+    if not os.path.isfile(processDbds_file):
+        logger.error(f'processDbds_file ({processDbds_file}) does not exist')
+        return
+
+    if not os.path.isfile(cac2lower_file):
+        logger.error(f'cac2lower_file ({cac2lower_file}) does not exist')
+        return
+
+    if not os.path.isdir(linuxbin_path):
+        logger.error(f'linuxbin_path ({linuxbin_path}) does not exist')
+        return
+
+
+    if not (mode in ['delayed', 'rt']):
+        logger.error("mode must be either 'delayed' or 'rt'")
+        return
+
+    if numcores == 0:
+        numcores = mp.cpu_count()
+    if not (1 <= numcores and numcores <= mp.cpu_count()):
+        logger.error(f'numcores must be between 1 and {mp.cpu_count()}')
+        return
+
+    deployment_split = deployment.split('-')
+    if len(deployment_split[1]) != 8:
+        logger.error("The deployment string format must be 'glider-YYYYmmdd', " +
+            "eg amlr03-20220101")
+        return
+
+    #--------------------------------------------
+    # Set/check/create file paths for processDbds script
+    logger.info(f'Writing dba files for deployment {deployment}, mode {mode}')
+    year = amlr_year_path(project, deployment_split)
+
+    glider_depl_path = os.path.join(deployments_path, project, year, deployment)
+    glider_data_in = os.path.join(glider_depl_path, 'data')
+
+    binary_path = os.path.join(glider_data_in, 'binary', mode)
+    ascii_path = os.path.join(glider_data_in, 'ascii', mode)
+    config_path = os.path.join(glider_data_in, 'data-config')
+    cache_path = os.path.join(deployments_path, 'cache')
+    scripts_path = os.path.join(glider_depl_path, 'scripts')
+    processDbds_out_file = f'{deployment}_{mode}_processDbds_out.txt'
+    sensor_filter_file = os.path.join(
+        scripts_path, f'{deployment}_{mode}_sensor_filter.txt')
+
+    logger.debug(f'processDbds file: {processDbds_file}')
+    logger.debug(f'Cache path: {cache_path}')
+    logger.debug(f'linux-bin path: {linuxbin_path}')
+    logger.debug(f'Binary path: {binary_path}')
+    logger.debug(f'Ascii path: {ascii_path}')
+    logger.debug(f'Scripts path: {scripts_path}')
+    logger.debug(f'processDbds_out file: {processDbds_out_file}')
+
+    if not storage.isdir(cache_path):
+        logger.error(f'cache_path ({cache_path}) does not exist')
+        return
+
+    if not storage.isdir(binary_path):
+        logger.error(f'binary_path ({binary_path}) does not exist')
+        return
+
+    if not storage.isdir(ascii_path):
+        logger.info(f'Making path at: {ascii_path}')
+        storage.makedirs(ascii_path)
+
+    if not storage.isdir(scripts_path):
+        logger.info(f'Making path at: {scripts_path}')
+        storage.makedirs(scripts_path)
+
+    #--------------------------------------------
+    # For non-local storage, the shell scripts run on local copies of the
+    #   cache, binary, and config files, and outputs are uploaded at the end
+    remote_paths = {
+        'cache': cache_path, 'binary': binary_path, 'ascii': ascii_path,
+        'scripts': scripts_path, 'config': config_path
+    }
+    local_tmp = None
+    if not storage.is_local:
+        if work_path is None:
+            local_tmp = tempfile.TemporaryDirectory(
+                prefix='amlr-binary-to-dba-', dir=scratch_path)
+            work_path = local_tmp.name
+        local_paths = {
+            k: os.path.join(work_path, k) for k in remote_paths.keys()
+        }
+        logger.info(f'Downloading cache and binary files to {work_path}')
+        storage.download_dir(cache_path, local_paths['cache'])
+        storage.download_dir(binary_path, local_paths['binary'])
+        storage.download_dir(config_path, local_paths['config'])
+        os.makedirs(local_paths['ascii'], exist_ok=True)
+        os.makedirs(local_paths['scripts'], exist_ok=True)
+
+        cache_path = local_paths['cache']
+        binary_path = local_paths['binary']
+        ascii_path = local_paths['ascii']
+        scripts_path = local_paths['scripts']
+        config_path = local_paths['config']
+        sensor_filter_file = os.path.join(
+            scripts_path, os.path.basename(sensor_filter_file))
+
+    #--------------------------------------------
+    # Decompress compressed cache and binary files, eg .ccc and .[st]cd files
+    amlr_decompress_files(cache_path, cache_path, numcores, pool=pool)
+    amlr_decompress_files(binary_path, binary_path, numcores, pool=pool)
+
+
+    #--------------------------------------------
+    # Make sure cache files are lowercase
+    files_list = os.listdir(cache_path)
+    files_list_CAC = list(filter(lambda i: i.endswith(".CAC"), files_list))
+
+    if len(files_list_CAC) > 0:
+        logger.info(f'{len(files_list_CAC)} .CAC files will be renamed')
+        run_out = run([cac2lower_file, os.path.join(cache_path, "*")],
+            capture_output=True, text=True)
+
+        if run_out.returncode != 0:
+            logger.error(f'Error running `{cac2lower_file}`')
+            logger.error(f'ARGS:\n{run_out.args}')
+            logger.error(f'STDERR:\n{run_out.stderr}')
+            return
+        else:
+            logger.info(f'Successfully completed run of `{cac2lower_file}`')
+            logger.debug(f'ARGS:\n{run_out.args}')
+            logger.debug(f'STDOUT:\n{run_out.stdout}')
+
+        # Make sure that all .CAC files have corresponding .cac files before deleting
+        delete_ok = True
+        files_list_new = os.listdir(cache_path)
+
+        for i in files_list_CAC:
+            if i.lower() not in files_list_new:
+                delete_ok = False
+
+        if delete_ok:
+            run_out = run(["find", cache_path, '-name', '*.CAC', '-delete'])
+            if run_out.returncode != 0:
+                logger.error(f'Error running `find {cache_path} -name *.CAC -delete`')
+                return
+
+            logger.info(f"{len(files_list_CAC)} uppercase .CAC files were deleted")
+        else:
+            logger.warn("Not all '.CAC' files have a corresponding '.cac' file, " +
+                "and thus the .CAC files were not deleted. " +
+                "Please inspect by hand.")
+
+            del run_out
+
+    else:
+        logger.info('There are no .CAC files to rename')
+
+
+    #--------------------------------------------
+    # Create sensor filter file, if specified
+    processDbds_args = [processDbds_file, "-c", cache_path, "-e", linuxbin_path]
+    if unmerged:
+        processDbds_args.append("-u")
+    if sensor_filter:
+        if amlr_sensor_filter(config_path, sensor_filter_file) is None:
+            logger.error('Unable to create sensor filter file')
+            return
+        if filter_report_segments > 0:
+            amlr_sensor_filter_report(
+                processDbds_args, sensor_filter_file, binary_path,
+                filter_report_segments, scratch_path)
+        processDbds_args.extend(["-f", sensor_filter_file])
+
+    # Number of existing dba segments, for the conversion metrics
+    n_segments_pre = len(dba_segments(os.listdir(ascii_path)))
+
+
+    # Make dba files
+    logger.info(f'Running processDbds script and writing dba files to {ascii_path}')
+    run_out = run(processDbds_args + [binary_path, ascii_path],
+                capture_output=True, text=True)
+    if run_out.returncode != 0:
+        logger.error(f'Error running `{processDbds_file}`')
+        logger.error(f'ARGS:\n{run_out.args}')
+        logger.error(f'STDERR:\n{run_out.stderr}')
+        if catalog is not None:
+            catalog.set_status(deployment, mode, 'binary_to_dba', 'failed',
+                               f'Error running {processDbds_file}')
+        return
+    else:
+        logger.info(f'Successfully completed run of `{processDbds_file}`')
+        logger.debug(f'ARGS:\n{run_out.args}')
+        logger.debug(f'STDOUT:\n{run_out.stdout}')
+
+        # TODO: write to log directory, if applicable
+        # fileout_path = os.path.join(scripts_path, processDbds_out_file)
+        # logger.info(f'Writing `{processDbds_file}` output to {fileout_path}')
+        # fileout = open(fileout_path, 'w')
+        # fileout.write(f'ARGS PASSED TO processDbds SCRIPT:\n{run_out.args}\n\n\n')
+        # fileout.write(f'STDOUT:\n{run_out.stdout}')
+        # fileout.close()
+
+    # Compress dba files, if specified
+    if compress_dba != 'none':
+        dba_compress_files(ascii_path, compress_dba, numcores, pool=pool)
+
+    dba_summary_post = dba_summary(ascii_path)
+    logger.info(f"dba files in {ascii_path}: {dba_summary_post['n_files']} " +
+        f"files, {dba_summary_post['n_bytes'] / 1e6:.1f} MB, " +
+        f"up to {dba_summary_post['n_sensors']} sensors per file")
+
+    # processDbds writes one dba file (or, unmerged, a flight and a science
+    #   file) per flight binary file (segment);
+    #   flight files without a dba file are the conversion backlog
+    n_flight = len([i for i in os.listdir(binary_path)
+                    if os.path.splitext(i)[1].lower() in ('.sbd', '.dbd')])
+    n_segments = len(dba_segments(os.listdir(ascii_path)))
+    metric_set('dba_files', dba_summary_post['n_files'])
+    metric_set('segments_converted', n_segments - n_segments_pre)
+    metric_set('segments_pending', max(n_flight - n_segments, 0))
+
+
+    #--------------------------------------------
+    # Upload outputs, for non-local storage
+    if not storage.is_local:
+        logger.info('Uploading cache, binary, and dba files')
+        # The files are not recorded in the catalog if any upload failed
+        try:
+            storage.upload_dir(cache_path, remote_paths['cache'])
+            storage.upload_dir(binary_path, remote_paths['binary'])
+            storage.upload_dir(ascii_path, remote_paths['ascii'], clobber=True)
+            storage.upload_dir(scripts_path, remote_paths['scripts'], clobber=True)
+        except UploadError as e:
+            logger.error(f'Error uploading files: {e}')
+            logger.debug(f'Files not uploaded: {e.failed}')
+            return
+
+        # Remove uppercase .CAC files that were renamed locally
+        files_CAC_removed = [
+            i for i in files_list_CAC if not os.path.exists(os.path.join(cache_path, i))
+        ]
+        storage.remove_many(
+            [os.path.join(remote_paths['cache'], i) for i in files_CAC_removed])
+
+
+    #--------------------------------------------
+    # Record binary and dba files in the deployment catalog, if specified.
+    #   Checksums are computed from the local files
+    if catalog is not None:
+        catalog.add_deployment(deployment, project, glider_depl_path)
+        catalog.record_files(
+            deployment, mode, 'binary', remote_paths['binary'],
+            LocalStorage().walk_stats(binary_path, recursive=False),
+            replace=True)
+        catalog.record_files(
+            deployment, mode, 'dba', remote_paths['ascii'],
+            LocalStorage().walk_stats(ascii_path, recursive=False),
+            replace=True)
+        catalog.set_status(deployment, mode, 'binary_to_dba', 'complete')
+
+    if local_tmp is not None:
+        local_tmp.cleanup()
+        return remote_paths['ascii']
+
+    return ascii_path
+
+
+def amlr_sensor_filter_report(processDbds_args, sensor_filter_file, binary_path,
+                              n_segments=2, scratch_path=None):
+    """
+    Report the savings of the sensor filter: the newest n_segments segments
+    are converted both with and without the filter, and the dba size,
+    sensors per file, and load_slocum_dba parse time of each are compared
+
+    Args:
+        processDbds_args (list): processDbds command, without -f
+        sensor_filter_file (str): path to the sensor filter file
+        binary_path (str): local path to the binary files
+        n_segments (int, optional): number of segments to convert.
+            Defaults to 2.
+        scratch_path (str, optional): directory for the temporary files.
+            Defaults to None, meaning $TMPDIR.
+
+    Returns:
+        dict: the summary (see dba_summary) and parse_seconds of the
+        'unfiltered' and 'filtered' dba files, or None if there was an error
+    """
+    # Flight files, and their science files if present
+    flight_ext = {'.dbd': '.ebd', '.sbd': '.tbd', '.mbd': '.nbd'}
+    binary_files = sorted(os.listdir(binary_path))
+    flight_files = [
+        i for i in binary_files if os.path.splitext(i)[1].lower() in flight_ext
+    ][-n_segments:]
+    if len(flight_files) == 0:
+        logger.info('There are no flight binary files for the sensor filter report')
+        return None
+
+    sample_files = []
+    for i in flight_files:
+        segment, ext = os.path.splitext(i)
+        sci_ext = flight_ext[ext.lower()]
+        sample_files.append(i)
+        sample_files.extend(
+            j for j in binary_files if j in [segment + sci_ext, segment + sci_ext.upper()])
+
+    report = {}
+    with tempfile.TemporaryDirectory(prefix='amlr-filter-report-', dir=scratch_path) as tmp_path:
+        sample_path = os.path.join(tmp_path, 'binary')
+        os.makedirs(sample_path)
+        for i in sample_files:
+            os.symlink(os.path.join(os.path.abspath(binary_path), i),
+                       os.path.join(sample_path, i))
+
+        for k, filter_args in [('unfiltered', []), ('filtered', ['-f', sensor_filter_file])]:
+            out_path = os.path.join(tmp_path, k)
+            os.makedirs(out_path)
+            run_out = run(processDbds_args + filter_args + [sample_path, out_path],
+                          capture_output=True, text=True)
+            if run_out.returncode != 0:
+                logger.warning(f'Unable to convert the {k} sample segments ' +
+                               'for the sensor filter report')
+                logger.debug(f'STDERR:\n{run_out.stderr}')
+                return None
+            report[k] = dba_summary(out_path)
+            report[k]['parse_seconds'] = dba_parse_seconds(out_path)
+
+    unfiltered, filtered = report['unfiltered'], report['filtered']
+    logger.info(f'Sensor filter savings for {len(flight_files)} segment(s): ' +
+        f"{unfiltered['n_bytes'] / 1e6:.2f} MB to {filtered['n_bytes'] / 1e6:.2f} MB, " +
+        f"{unfiltered['n_sensors']} to {filtered['n_sensors']} sensors per file")
+    if unfiltered['parse_seconds'] is not None and filtered['parse_seconds'] is not None:
+        logger.info('Sensor filter parse time savings: ' +
+            f"{unfiltered['parse_seconds']:.2f} s to {filtered['parse_seconds']:.2f} s")
+    return report
+
+
+def dba_parse_seconds(ascii_path):
+    """
+    Time the parsing of the dba files in ascii_path, by segment, 
+    with amlr_load_slocum_dba
+
+    Args:
+        ascii_path (str): path to dba files
+
+    Returns:
+        float: seconds, or None if gdm is not available
+    """
+    from amlrgliders.glider import amlr_load_slocum_dba
+
+    dba_files = [os.path.join(ascii_path, i) for i in sorted(os.listdir(ascii_path))]
+    t_start = time.perf_counter()
+    try:
+        for i in dba_segments(dba_files):
+            amlr_load_slocum_dba(i)
+    except ImportError:
+        logger.info('gdm is not available, and thus dba parse time is not measured')
+        return None
+    return time.perf_counter() - t_start
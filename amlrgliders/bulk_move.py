@@ -0,0 +1,134 @@
+"""
+Bulk move/rename of files or bucket objects, eg imagery blobs
+"""
+
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def bulk_move_plan(files, replace, include=None, exclude=None):
+    """
+    Create the list of (source, destination) moves,
+    by applying string replacements to each source path
+
+    Args:
+        files (list): source paths
+        replace (list): (old, new) string replacements, applied in order
+        include (str, optional): only move paths containing this string.
+            Defaults to None.
+        exclude (str, optional): do not move paths containing this string.
+            Defaults to None.
+
+    Returns:
+        list: (source, destination) tuples, for paths that change
+    """
+
+    pairs = []
+    for src in files:
+        if include is not None and include not in src:
+            continue
+        if exclude is not None and exclude in src:
+            continue
+        dst = src
+        for old, new in replace:
+            dst = dst.replace(old, new)
+        if dst != src:
+            pairs.append((src, dst))
+
+    return pairs
+
+
+def read_journal(journal_file):
+    """
+    Read the completed moves from journal_file, 
+    with one tab-separated source and destination path per line
+
+    Returns:
+        dict: destination paths, keyed by source path
+    """
+    done = {}
+    if journal_file is None or not os.path.isfile(journal_file):
+        return done
+    with open(journal_file, 'r') as f:
+        for line in f:
+            src, _, dst = line.rstrip('\n').partition('\t')
+            done[src] = dst
+    return done
+
+
+def amlr_bulk_move(storage, path, replace, include=None, exclude=None,
+                   journal_file=None, dry_run=False, chunk_size=1000):
+    """
+    Move (rename) all files under path, by applying string replacements
+    to their paths. Files are listed once, and then moved in chunks
+    with the parallel batch operations of storage
+    (for GCSStorage, copy and delete with one pooled client).
+    Completed moves are appended to journal_file after each chunk,
+    so that an interrupted run can be resumed by running it again. 
+    Journaled destinations are not moved again when resuming, 
+    even if the replacements would match them (eg 'images/' -> 'images/2022/')
+
+    Args:
+        storage (Storage): storage backend, eg GCSStorage or LocalStorage
+        path (str): directory or prefix under which to move files
+        replace (list): (old, new) string replacements, applied in order
+        include (str, optional): only move paths containing this string.
+            Defaults to None.
+        exclude (str, optional): do not move paths containing this string.
+            Defaults to None.
+        journal_file (str, optional): local file in which to record
+            completed moves. Defaults to None, meaning no journal.
+        dry_run (bool, optional): only log the planned moves?
+            Defaults to False.
+        chunk_size (int, optional): number of moves per chunk.
+            Defaults to 1000.
+
+    Returns:
+        dict: counts of files listed, planned, skipped, moved, and failed
+    """
+
+    logger.info(f'Listing files under {path}')
+    files = [os.path.join(path, i) for i in storage.walk_files(path)]
+
+    done = read_journal(journal_file)
+    moved_dst = set(done.values())
+    files_todo = [i for i in files if i not in moved_dst]
+    pairs = bulk_move_plan(files_todo, replace, include, exclude)
+    pairs_todo = [i for i in pairs if i[0] not in done]
+    counts = {
+        'listed': len(files), 'planned': len(pairs),
+        'skipped': len(files) - len(files_todo) + len(pairs) - len(pairs_todo), 
+        'moved': 0, 'failed': 0
+    }
+    logger.info(f"{counts['listed']} files listed, {counts['planned']} to move, " +
+                f"{counts['skipped']} already moved according to the journal")
+
+    if dry_run:
+        for src, dst in pairs_todo:
+            logger.info(f'Dry run: {src} -> {dst}')
+        return counts
+
+    t_start = time.perf_counter()
+    for k in range(0, len(pairs_todo), chunk_size):
+        chunk = pairs_todo[k:(k+chunk_size)]
+        out = storage.move_many(chunk)
+        moved = [(src, dst) for (src, dst), i in zip(chunk, out) if i is not None]
+        counts['moved'] += len(moved)
+        counts['failed'] += len(chunk) - len(moved)
+
+        if journal_file is not None and len(moved) > 0:
+            with open(journal_file, 'a') as f:
+                f.write(''.join(f'{src}\t{dst}\n' for src, dst in moved))
+
+        t_elapsed = time.perf_counter() - t_start
+        logger.info(f"Moved {counts['moved']} of {len(pairs_todo)} files " +
+                    f"({counts['moved'] / t_elapsed:.0f} files/sec)")
+
+    if counts['failed'] > 0:
+        logger.warning(f"{counts['failed']} files could not be moved; " +
+                       'run again to retry them')
+
+    return counts
@@ -0,0 +1,319 @@
+"""
+SQLite catalog of deployments, their files, profiles, and processing status,
+for one deployments root (eg the deployments bucket).
+
+Stages record what they read and write in the catalog, and later stages
+query the catalog rather than listing (eg gcsfuse) directories
+"""
+
+import os
+import time
+import random
+import shutil
+import sqlite3
+import logging
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+from amlrgliders.storage import LocalStorage
+
+logger = logging.getLogger(__name__)
+
+
+catalog_file_name = 'amlr-catalog.sqlite'
+
+catalog_schema = """
+CREATE TABLE IF NOT EXISTS deployments (
+    deployment TEXT PRIMARY KEY, project TEXT, glider_path TEXT, updated TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    deployment TEXT, mode TEXT, kind TEXT, path TEXT, name TEXT,
+    size INTEGER, checksum TEXT, updated TEXT,
+    PRIMARY KEY (deployment, mode, kind, name)
+);
+CREATE TABLE IF NOT EXISTS scans (
+    deployment TEXT, mode TEXT, kind TEXT, path TEXT, updated TEXT,
+    PRIMARY KEY (deployment, mode, kind)
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    deployment TEXT, mode TEXT, profile_time TEXT, direction REAL,
+    metadata TEXT, updated TEXT,
+    PRIMARY KEY (deployment, mode, profile_time)
+);
+CREATE TABLE IF NOT EXISTS status (
+    deployment TEXT, mode TEXT, stage TEXT, status TEXT, message TEXT,
+    updated TEXT,
+    PRIMARY KEY (deployment, mode, stage)
+);
+"""
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec='microseconds')
+
+
+class AmlrCatalog:
+    """
+    Deployment catalog, stored as an SQLite file in the deployments root.
+
+    Use as a context manager. The catalog is copied to a local working file
+    on enter, because SQLite should not be written through gcsfuse.
+    On exit, the rows written during this session are merged into the
+    current catalog file in deployments_path (which may have been updated
+    by other runs in the meantime), and the result is uploaded if the
+    catalog file has not changed since; otherwise the merge is retried.
+
+        with AmlrCatalog(deployments_path, storage) as catalog:
+            dba_files = catalog.files(deployment, mode, 'dba')
+
+    File kinds are free-form, eg 'binary', 'dba', 'tmp', 'trajectory',
+    'ngdac', 'ragged', 'acoustics', and 'imagery'.
+    A (deployment, mode, kind) set of files is 'complete' if it was recorded
+    from a full listing, via scan_files or record_files(replace=True)
+
+    Args:
+        deployments_path (str): path to the deployments root
+        storage (Storage, optional): storage backend for deployments_path.
+            Defaults to None, meaning LocalStorage
+        scratch_path (str, optional): directory for the local working copy.
+            Defaults to None, meaning $TMPDIR
+    """
+
+    # Sessions in one process (eg amlr-batch threads) are saved one at a time
+    _save_lock = threading.Lock()
+
+    def __init__(self, deployments_path, storage=None, scratch_path=None):
+        self.deployments_path = deployments_path
+        self.catalog_file = os.path.join(deployments_path, catalog_file_name)
+        self.storage = storage if storage is not None else LocalStorage()
+        self.scratch_path = scratch_path
+        self.tmp_path = None
+        self.con = None
+        self._session_start = None
+
+    def __enter__(self):
+        self.tmp_path = tempfile.mkdtemp(prefix='amlr-catalog-', dir=self.scratch_path)
+        local_file = os.path.join(self.tmp_path, catalog_file_name)
+        if self.storage.exists(self.catalog_file):
+            logger.debug(f'Reading catalog {self.catalog_file}')
+            self.storage.get(self.catalog_file, local_file)
+        else:
+            logger.info(f'Creating catalog {self.catalog_file}')
+
+        self.con = sqlite3.connect(local_file)
+        self.con.executescript(catalog_schema)
+        self._session_start = _now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.con.commit()
+            self.con.close()
+            with AmlrCatalog._save_lock:
+                self._save()
+        finally:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def _save(self, max_attempts=10):
+        """
+        Merge this session's rows into the current catalog file, and upload it.
+        The upload only succeeds if the catalog file was not changed by
+        another run (process or host) since it was read for the merge;
+        otherwise, the merge is redone with the new catalog file
+        """
+        local_file = os.path.join(self.tmp_path, catalog_file_name)
+        merge_file = os.path.join(self.tmp_path, f'merge-{catalog_file_name}')
+        for k in range(max_attempts):
+            if os.path.exists(merge_file):
+                os.remove(merge_file)
+            generation = self.storage.get_generation(self.catalog_file, merge_file)
+            if generation is None:
+                shutil.copyfile(local_file, merge_file)
+            else:
+                self._merge(local_file, merge_file)
+            if self.storage.put_if_generation(
+                    merge_file, self.catalog_file, generation):
+                return
+            logger.info(f'Catalog {self.catalog_file} was updated by another ' +
+                        'run; merging again')
+            time.sleep(random.uniform(0, 0.5 * 2 ** k))
+        raise OSError(f'Unable to save catalog {self.catalog_file} ' +
+                      f'after {max_attempts} attempts')
+
+    def _merge(self, local_file, merge_file):
+        """
+        Merge this session's rows (local_file) into merge_file
+        """
+        con = sqlite3.connect(merge_file)
+        con.executescript(catalog_schema)
+        con.execute('ATTACH DATABASE ? AS session', (local_file,))
+        t = self._session_start
+        with con:
+            # Complete file listings and profiles replace existing rows
+            con.execute("""
+                DELETE FROM main.files WHERE (deployment, mode, kind) IN (
+                    SELECT deployment, mode, kind FROM session.scans
+                    WHERE updated >= ?)""", (t,))
+            con.execute("""
+                DELETE FROM main.profiles WHERE (deployment, mode) IN (
+                    SELECT DISTINCT deployment, mode FROM session.profiles
+                    WHERE updated >= ?)""", (t,))
+            for table in ['deployments', 'files', 'scans', 'profiles', 'status']:
+                con.execute(
+                    f'INSERT OR REPLACE INTO main.{table} ' +
+                    f'SELECT * FROM session.{table} WHERE updated >= ?', (t,))
+        con.execute('DETACH DATABASE session')
+        con.close()
+
+    def add_deployment(self, deployment, project, glider_path):
+        """
+        Record a deployment and its glider_path
+        """
+        with self.con:
+            self.con.execute(
+                'INSERT OR REPLACE INTO deployments VALUES (?, ?, ?, ?)',
+                (deployment, project, glider_path, _now()))
+
+    def has_deployment(self, deployment):
+        cur = self.con.execute(
+            'SELECT 1 FROM deployments WHERE deployment = ?', (deployment,))
+        return cur.fetchone() is not None
+
+    def record_files(self, deployment, mode, kind, path, stats, replace=False):
+        """
+        Record files in directory path
+
+        Args:
+            deployment (str): deployment name
+            mode (str): deployment mode; '' for mode-independent files
+            kind (str): file kind, eg 'dba'
+            path (str): directory of the files
+            stats (list): (name, size, checksum) tuples, eg from
+                Storage.walk_stats or OutputStager.uploaded
+            replace (bool, optional): is stats a full listing, that
+                replaces all recorded files of this kind? Defaults to False.
+        """
+        updated = _now()
+        with self.con:
+            if replace:
+                self.con.execute(
+                    'DELETE FROM files WHERE deployment = ? AND mode = ? AND kind = ?',
+                    (deployment, mode, kind))
+                self.con.execute(
+                    'INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?)',
+                    (deployment, mode, kind, path, updated))
+            self.con.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(deployment, mode, kind, path, name, size, checksum, updated)
+                 for name, size, checksum in stats])
+        logger.debug(f'Recorded {len(stats)} {kind} files for {deployment} {mode}')
+
+    def scan_files(self, deployment, mode, kind, path, storage=None,
+                   recursive=False, checksum=True):
+        """
+        List files in path, and record them as the complete set of files
+        of this kind
+
+        Args:
+            storage (Storage, optional): storage backend for path.
+                Defaults to None, meaning the catalog storage
+            recursive (bool, optional): list files in subdirectories?
+                Defaults to False.
+            checksum (bool, optional): record checksums? For LocalStorage,
+                this requires reading each file. Defaults to True.
+
+        Returns:
+            list: names of files in path, relative to path
+        """
+        storage = storage if storage is not None else self.storage
+        logger.info(f'Scanning {kind} files in {path}')
+        stats = storage.walk_stats(path, recursive, checksum) \
+            if storage.isdir(path) else []
+        self.record_files(deployment, mode, kind, path, stats, replace=True)
+        return [i[0] for i in stats]
+
+    def files(self, deployment, mode, kind):
+        """
+        Get the recorded files of this kind
+
+        Returns:
+            list: names of files, relative to their directory, or
+            None if this kind of file has not been recorded from a full listing
+        """
+        cur = self.con.execute(
+            'SELECT 1 FROM scans WHERE deployment = ? AND mode = ? AND kind = ?',
+            (deployment, mode, kind))
+        if cur.fetchone() is None:
+            return None
+        cur = self.con.execute(
+            'SELECT name FROM files WHERE deployment = ? AND mode = ? AND kind = ? ' +
+            'ORDER BY name', (deployment, mode, kind))
+        return [i[0] for i in cur.fetchall()]
+
+    def files_df(self, deployment, mode=None):
+        """
+        Get a data frame of all recorded files for a deployment
+        """
+        # Local import, so that eg amlr_binary_to_dba.py does not load pandas
+        import pandas as pd
+        sql = 'SELECT * FROM files WHERE deployment = ?'
+        params = [deployment]
+        if mode is not None:
+            sql += ' AND mode = ?'
+            params.append(mode)
+        return pd.read_sql_query(sql, self.con, params=params)
+
+    def record_profiles(self, deployment, mode, profiles):
+        """
+        Record profiles, replacing any previously recorded profiles
+
+        Args:
+            profiles (DataFrame): gdm profiles data frame, indexed by time
+        """
+        import pandas as pd
+        updated = _now()
+        rows = [
+            (deployment, mode, pd.Timestamp(t).isoformat(),
+             float(row['direction']) if 'direction' in row.index else None,
+             row.to_json(date_format='iso'), updated)
+            for t, row in profiles.iterrows()
+        ]
+        with self.con:
+            self.con.execute(
+                'DELETE FROM profiles WHERE deployment = ? AND mode = ?',
+                (deployment, mode))
+            self.con.executemany(
+                'INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?, ?)', rows)
+        logger.debug(f'Recorded {len(rows)} profiles for {deployment} {mode}')
+
+    def n_profiles(self, deployment, mode):
+        cur = self.con.execute(
+            'SELECT COUNT(*) FROM profiles WHERE deployment = ? AND mode = ?',
+            (deployment, mode))
+        return cur.fetchone()[0]
+
+    def set_status(self, deployment, mode, stage, status, message=''):
+        """
+        Record the processing status of a stage, eg 'running' or 'complete'
+        """
+        with self.con:
+            self.con.execute(
+                'INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?, ?, ?)',
+                (deployment, mode, stage, status, message, _now()))
+
+    def status(self, deployment=None, mode=None):
+        """
+        Get a data frame of processing status, optionally for
+        one deployment and mode
+        """
+        import pandas as pd
+        sql = 'SELECT * FROM status WHERE 1 = 1'
+        params = []
+        if deployment is not None:
+            sql += ' AND deployment = ?'
+            params.append(deployment)
+        if mode is not None:
+            sql += ' AND mode = ?'
+            params.append(mode)
+        return pd.read_sql_query(sql + ' ORDER BY updated', self.con, params=params)
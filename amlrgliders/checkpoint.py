@@ -0,0 +1,117 @@
+"""
+Durable checkpoints for long processing runs, eg on preemptible VMs,
+so that a run can be resumed where it stopped
+"""
+
+import os
+import json
+import logging
+
+from amlrgliders.storage import LocalStorage
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint:
+    """
+    Progress of one run, stored in checkpoint_path via storage:
+    completed stages, completed items within stages (eg dba files parsed,
+    or ngdac files written), and chunk files (eg parsed dba data).
+    checkpoint.json is rewritten after each update, via a temporary file
+    and a move, so that a preemption does not leave it partially written.
+
+    Args:
+        checkpoint_path (str): directory for checkpoint files,
+            eg data/tmp/checkpoint-{deployment_mode}
+        storage (Storage, optional): storage backend for checkpoint_path.
+            Defaults to None, meaning LocalStorage
+        resume (bool, optional): resume from an existing checkpoint?
+            If False, any existing checkpoint is cleared. Defaults to False.
+        every (int, optional): number of items (eg files) between
+            checkpoints within a stage. Defaults to 500.
+    """
+
+    def __init__(self, checkpoint_path, storage=None, resume=False, every=500):
+        self.checkpoint_path = checkpoint_path
+        self.storage = storage if storage is not None else LocalStorage()
+        self.every = every
+        self.state_file = os.path.join(checkpoint_path, 'checkpoint.json')
+        self.state = {'stages': [], 'items': {}, 'files': []}
+
+        if resume and self.storage.exists(self.state_file):
+            with self.storage.open(self.state_file, 'r') as f:
+                self.state = json.load(f)
+            logger.info(f'Resuming from checkpoint {self.checkpoint_path}: ' +
+                        f"completed stages: {', '.join(self.state['stages']) or 'none'}")
+        else:
+            if resume:
+                logger.info(f'No checkpoint found at {self.checkpoint_path}; ' +
+                            'starting from the beginning')
+            self.clear()
+
+    def _save(self):
+        state_tmp = f'{self.state_file}.tmp'
+        with self.storage.open(state_tmp, 'w') as f:
+            json.dump(self.state, f)
+        self.storage.move(state_tmp, self.state_file)
+
+    def stage_done(self, stage):
+        return stage in self.state['stages']
+
+    def set_stage_done(self, stage):
+        if stage not in self.state['stages']:
+            self.state['stages'].append(stage)
+        self._save()
+
+    def items(self, key):
+        """
+        Get the completed items for key, eg the names of parsed dba files
+        """
+        return list(self.state['items'].get(key, []))
+
+    def add_items(self, key, items):
+        """
+        Record completed items for key, and save
+        """
+        self.state['items'].setdefault(key, []).extend(items)
+        self._save()
+
+    def put_files(self, local_files, key=None, items=None):
+        """
+        Save local_files in the checkpoint. If key and items are given,
+        items are recorded as completed in the same update, so that the
+        files and their items are committed together
+        """
+        names = [os.path.basename(i) for i in local_files]
+        out = self.storage.put_many(
+            (i, os.path.join(self.checkpoint_path, j))
+            for i, j in zip(local_files, names))
+        if any(i is None for i in out):
+            raise OSError(f'Unable to save checkpoint files to {self.checkpoint_path}')
+        self.state['files'].extend(names)
+        if key is not None:
+            self.state['items'].setdefault(key, []).extend(items)
+        self._save()
+
+    def files(self, prefix=''):
+        """
+        Get the names of saved files that start with prefix
+        """
+        return [i for i in self.state['files'] if i.startswith(prefix)]
+
+    def get_file(self, name, local_path):
+        local_file = os.path.join(local_path, name)
+        self.storage.get(os.path.join(self.checkpoint_path, name), local_file)
+        return local_file
+
+    def clear(self):
+        """
+        Remove all checkpoint files, eg after a run has completed
+        """
+        if self.storage.isdir(self.checkpoint_path):
+            self.storage.remove_many([
+                os.path.join(self.checkpoint_path, i)
+                for i in self.storage.walk_files(self.checkpoint_path)
+            ])
+        self.state = {'stages': [], 'items': {}, 'files': []}
+
@@ -0,0 +1,510 @@
+"""
+Out-of-core (chunked) processing, for deployments whose data do not fit
+in memory. Parsed dba data are stored sorted by time in a parquet file
+(the gdm tmp data file), from which GdmWindows reads and processes
+one time window at a time. Window boundaries do not split profiles,
+and each window is read with enough overlap that its processed data
+(see amlr_process_data) are identical to those of in-memory processing.
+
+The same overlapped reads are used to process a single time window of
+a deployment (read_processed_window), whose outputs then replace the
+window in the deployment files (nc_splice_window and csv_splice_window)
+"""
+
+import io
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import netCDF4
+import xarray as xr
+from xarray.coding.times import infer_datetime_units
+from xarray.conventions import encode_cf_variable
+
+from amlrgliders.utils import amlr_process_data, amlr_interp_vars
+
+logger = logging.getLogger(__name__)
+
+
+# Options with which gdm tmp parquet files are written: zstd compressed, 
+#   in row groups with statistics (including of the time index), so that 
+#   reads of a time window only read the row groups that overlap it
+tmp_row_group_rows = 100000
+tmp_parquet_options = {
+    'version': '2.6', 'compression': 'zstd', 'write_statistics': True
+}
+
+
+def parquet_index_name(pq_file):
+    """
+    Get the name of the column in which pandas stored the index of pq_file
+    """
+    return pq.read_schema(pq_file).pandas_metadata['index_columns'][0]
+
+
+def parquet_num_rows(pq_file):
+    """
+    Get the number of rows of pq_file, from its metadata
+    """
+    return pq.ParquetFile(pq_file).metadata.num_rows
+
+
+def read_parquet_window(pq_file, index_name, start=None, end=None, columns=None):
+    """
+    Read the rows of pq_file with index (time) in [start, end).
+    If start or end is None, the window is unbounded on that side
+    """
+    filters = []
+    if start is not None:
+        filters.append((index_name, '>=', start))
+    if end is not None:
+        filters.append((index_name, '<', end))
+    # Filters skip row groups whose time statistics are outside the window
+    return pd.read_parquet(pq_file, columns=columns, filters=filters or None, 
+                           memory_map=True)
+
+
+def write_tmp_parquet(df, pq_file):
+    """
+    Write df, sorted by time index, to the tmp parquet file pq_file 
+    (see tmp_parquet_options)
+    """
+    df.to_parquet(pq_file, index=True, row_group_size=tmp_row_group_rows, 
+                  **tmp_parquet_options)
+
+
+def read_tmp_parquet(pq_file, start=None, end=None, columns=None):
+    """
+    Read a tmp parquet file, memory-mapped if it is local, eg:
+
+        data = read_tmp_parquet(
+            'amlr08-20221205-delayed-data.parquet', '2022-12-10', '2022-12-11')
+
+    Args:
+        pq_file (str): path to a gdm tmp data or profiles parquet file
+        start (str or Timestamp, optional): only read rows with time 
+            at or after start. Defaults to None.
+        end (str or Timestamp, optional): only read rows with time 
+            before end. Defaults to None.
+        columns (list, optional): columns to read. Defaults to None, 
+            meaning all columns.
+
+    Returns:
+        DataFrame: data indexed by time
+    """
+    if start is None and end is None:
+        return pd.read_parquet(pq_file, columns=columns, memory_map=True)
+    return read_parquet_window(
+        pq_file, parquet_index_name(pq_file), 
+        pd.Timestamp(start) if start is not None else None, 
+        pd.Timestamp(end) if end is not None else None, columns)
+
+
+def parquet_times(pq_file, index_name):
+    """
+    Read only the time index of pq_file
+    """
+    return pd.DatetimeIndex(
+        pq.read_table(pq_file, columns=[index_name]).column(0).to_pandas())
+
+
+def parquet_time_range(pq_file, index_name):
+    """
+    Get the first and last times of pq_file, sorted by time, from its 
+    row group statistics, or if there are none from its time index
+    """
+    pq_meta = pq.ParquetFile(pq_file).metadata
+    k = pq_meta.schema.names.index(index_name)
+    first = pq_meta.row_group(0).column(k).statistics
+    last = pq_meta.row_group(pq_meta.num_row_groups - 1).column(k).statistics
+    if first is None or last is None or \
+            not (first.has_min_max and last.has_min_max):
+        times = parquet_times(pq_file, index_name)
+        return times[0], times[-1]
+    return pd.Timestamp(first.min), pd.Timestamp(last.max)
+
+
+def window_overlap_ok(data, start, end, read_start, read_end, time_min, time_max):
+    """
+    Does data, read from read_start to read_end for the window [start, end), 
+    include the nearest valid value on each side of the window of every 
+    interpolated variable, or reach the data limits (time_min and time_max)?
+    """
+    for i in amlr_interp_vars.values():
+        valid = data[i].notna()
+        if not (start is None or read_start <= time_min or
+                valid[data.index < start].any()):
+            return False
+        if not (end is None or read_end > time_max or
+                valid[data.index >= end].any()):
+            return False
+    return True
+
+
+def read_processed_window(read, start, end, time_min, time_max, 
+                          overlap=pd.Timedelta(hours=1), with_overlap=False):
+    """
+    Read and process (see amlr_process_data) the data in [start, end). 
+    The data are read with an overlap, doubled as needed, so that they are 
+    identical to those of processing all of the data (see GdmWindows)
+
+    Args:
+        read (function): read(read_start, read_end) returns the unprocessed 
+            data in [read_start, read_end); None means unbounded
+        start (Timestamp): window start, or None
+        end (Timestamp): window end, or None
+        time_min (Timestamp): first time of all of the data
+        time_max (Timestamp): last time of all of the data
+        overlap (Timedelta, optional): initial overlap. 
+            Defaults to one hour.
+        with_overlap (bool, optional): return the data read with 
+            the overlap, rather than only those in the window? 
+            Defaults to False.
+
+    Returns:
+        DataFrame: processed data
+    """
+    while True:
+        read_start = None if start is None else start - overlap
+        read_end = None if end is None else end + overlap
+        data = amlr_process_data(read(read_start, read_end))
+        if window_overlap_ok(data, start, end, read_start, read_end, 
+                             time_min, time_max):
+            break
+        overlap *= 2
+        logger.debug(f'Increasing the window overlap to {overlap}')
+    if with_overlap:
+        return data
+    return data_window(data, start, end)
+
+
+def data_window(data, start, end):
+    """
+    Get the rows of data, indexed by time, in the time window [start, end); 
+    None means unbounded
+    """
+    before, after = _window_split(data.index, start, end)
+    return data[~(before | after)]
+
+
+def row_boundaries(times, window_rows):
+    """
+    Get times that split sorted times into windows of about window_rows rows,
+    without splitting duplicated times
+    """
+    times = times.unique()
+    return list(times[window_rows::window_rows])
+
+
+def parquet_merge_sorted(part_files, out_file, window_rows=1000000):
+    """
+    Merge parquet files, each sorted by time, into one file sorted by time,
+    reading window_rows rows at a time. The result is identical to that of
+    concatenating the parts in order and (stable) sorting by time:
+    columns are in order of first appearance, and rows with the same
+    time are in part order
+
+    Args:
+        part_files (list): paths to parquet files, sorted by time index
+        out_file (str): path of the merged parquet file
+        window_rows (int, optional): approximate number of rows to read
+            and write at a time. Defaults to 1000000.
+    """
+    index_name = parquet_index_name(part_files[0])
+
+    # Column order and dtypes of the concatenated data
+    dtypes = {}
+    for i in part_files:
+        schema = pq.read_schema(i)
+        for j in schema.names:
+            if j != index_name:
+                dtypes.setdefault(j, []).append(schema.field(j).type.to_pandas_dtype())
+    dtypes = {
+        j: np.result_type(*(k + ([np.float64] if len(k) < len(part_files) else [])))
+        for j, k in dtypes.items()
+    }
+
+    times = pd.DatetimeIndex(np.concatenate(
+        [parquet_times(i, index_name).values for i in part_files])).sort_values()
+    bounds = [None] + row_boundaries(times, window_rows) + [None]
+    del times
+
+    schema = None
+    writer = None
+    try:
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            df = pd.concat([read_parquet_window(i, index_name, start, end)
+                            for i in part_files])
+            df = df.reindex(columns=list(dtypes)).astype(dtypes)
+            df = df.sort_index(kind='stable')
+            if schema is None:
+                table = pa.Table.from_pandas(df, preserve_index=True)
+                schema = table.schema
+                writer = pq.ParquetWriter(out_file, schema, **tmp_parquet_options)
+            else:
+                table = pa.Table.from_pandas(df, schema=schema, preserve_index=True)
+            writer.write_table(table, row_group_size=tmp_row_group_rows)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+class GdmWindows:
+    """
+    Processed gdm data, read from data_file one time window at a time.
+    Iterating yields the (data, profiles) of each window, where data
+    are processed by amlr_process_data and profiles are those that start
+    in the window. Window boundaries are placed about every window_rows rows,
+    but never within a profile (from its start_time to end_time).
+    Each window is read with an overlap, doubled as needed,
+    so that every interpolated variable has its nearest valid value
+    on each side of the window (or the overlap reaches the data limits)
+
+    Args:
+        data_file (str): local parquet file of gdm data, sorted by time,
+            eg written by amlr_load_dba
+        profiles (DataFrame): gdm profiles, with start_time and end_time
+        window_rows (int, optional): approximate number of rows per window.
+            Defaults to 1000000.
+        overlap (Timedelta, optional): initial overlap with which
+            windows are read. Defaults to one hour.
+        gdm (GliderDataModel, optional): gdm object (configs), 
+            with which writers process each window. Defaults to None.
+    """
+
+    def __init__(self, data_file, profiles, window_rows=1000000,
+                 overlap=pd.Timedelta(hours=1), gdm=None):
+        self.data_file = data_file
+        self.profiles = profiles
+        self.gdm = gdm
+        self.window_rows = window_rows
+        self.overlap = overlap
+        self.index_name = parquet_index_name(data_file)
+
+        times = parquet_times(data_file, self.index_name).unique()
+        self.time_min = times[0]
+        self.time_max = times[-1]
+        # As chosen by xarray when encoding the in-memory data
+        self.time_units = infer_datetime_units(times[times != '1970-01-01'])
+        self.boundaries = self._boundaries(times)
+        logger.info(f'Processing gdm data in {len(self)} time window(s) ' +
+                    f'of about {window_rows} rows')
+
+    def _boundaries(self, times):
+        spans = self.profiles[['start_time', 'end_time']].dropna().sort_values('start_time')
+        span_starts = pd.DatetimeIndex(spans['start_time'])
+        span_ends = pd.DatetimeIndex(spans['end_time']).to_series().cummax()
+
+        boundaries = []
+        k = self.window_rows
+        while k < len(times):
+            # Move the boundary past any profile that contains it
+            i = span_starts.searchsorted(times[k], 'left') - 1
+            while i >= 0 and span_ends.iloc[i] >= times[k]:
+                k = times.searchsorted(span_ends.iloc[i], 'right')
+                if k >= len(times):
+                    break
+                i = span_starts.searchsorted(times[k], 'left') - 1
+            if k >= len(times):
+                break
+            boundaries.append(times[k])
+            k += self.window_rows
+        return boundaries
+
+    def __len__(self):
+        return len(self.boundaries) + 1
+
+    @property
+    def columns(self):
+        """
+        Column names of the processed data
+        """
+        names = pq.read_schema(self.data_file).names
+        return [i.lower() for i in names if i != self.index_name] + \
+            list(amlr_interp_vars)
+
+    def windows(self):
+        """
+        Get the (start, end) of each window; the first start
+        and last end are None, meaning unbounded
+        """
+        bounds = [None] + self.boundaries + [None]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def read(self, start, end, overlap=False):
+        """
+        Read and process the data in [start, end), or if overlap is True, 
+        the data read with the window overlap, ie including at least 
+        the nearest rows on either side of the window
+        """
+        return read_processed_window(
+            lambda i, j: read_parquet_window(self.data_file, self.index_name, i, j), 
+            start, end, self.time_min, self.time_max, self.overlap, overlap)
+
+    def __iter__(self):
+        for k, (start, end) in enumerate(self.windows()):
+            logger.info(f'Time window {k+1} of {len(self)}: ' +
+                        f"{start or 'start'} to {end or 'end'}")
+            in_window = np.ones(len(self.profiles.index), dtype=bool)
+            if start is not None:
+                in_window &= self.profiles['start_time'] >= start
+            if end is not None:
+                in_window &= self.profiles['start_time'] < end
+            yield self.read(start, end), self.profiles[in_window]
+
+
+def nc_append(nc_file, ds, dim='time'):
+    """
+    Append ds along dim to nc_file, which was written by ds.to_netcdf
+    with dim as an unlimited dimension. Variables are encoded as they are
+    in nc_file. Variables without dim are not written again, and variables
+    that are not in nc_file are skipped
+
+    Args:
+        nc_file (str): path to nc file
+        ds (Dataset): dataset to append
+        dim (str, optional): dimension to append along. Defaults to 'time'.
+    """
+    with netCDF4.Dataset(nc_file, 'a') as nc:
+        nc.set_auto_maskandscale(False)
+        n = nc.dimensions[dim].size
+        for name, var in ds.variables.items():
+            if dim not in var.dims:
+                continue
+            if name not in nc.variables:
+                logger.warning(f'Variable {name} is not in {nc_file}, and will not be appended')
+                continue
+
+            nc_var = nc.variables[name]
+            var = var.copy(deep=False)
+            var.encoding = {'dtype': nc_var.dtype}
+            if '_FillValue' in nc_var.ncattrs():
+                var.encoding['_FillValue'] = nc_var.getncattr('_FillValue')
+            if np.issubdtype(var.dtype, np.datetime64):
+                for i in ['units', 'calendar']:
+                    if i in nc_var.ncattrs():
+                        var.encoding[i] = nc_var.getncattr(i)
+            var_enc = encode_cf_variable(var, name=name)
+            index = tuple(slice(n, n + ds.sizes[dim]) if i == dim else slice(None)
+                          for i in var_enc.dims)
+            nc_var[index] = var_enc.values
+
+
+def nc_write_window(ds, nc_file, time_units=None, dim='time'):
+    """
+    Write ds, eg the data of one time window, to nc_file. If nc_file exists,
+    ds is appended to it along dim (see nc_append); if not, nc_file is
+    created, with dim as an unlimited dimension
+
+    Args:
+        ds (Dataset): dataset to write
+        nc_file (str): path to nc file
+        time_units (str, optional): units with which to encode dim when
+            creating nc_file, if not set by ds, eg GdmWindows.time_units.
+            Defaults to None.
+        dim (str, optional): dimension to append along. Defaults to 'time'.
+    """
+    if os.path.exists(nc_file):
+        nc_append(nc_file, ds, dim)
+    else:
+        set_units = time_units is not None and 'units' not in ds[dim].encoding
+        if set_units:
+            ds = ds.copy(deep=False)
+            ds[dim].encoding = dict(ds[dim].encoding, units=time_units)
+        ds.to_netcdf(nc_file, unlimited_dims=[dim])
+        if set_units:
+            # xarray reformats given units, eg the reference date
+            with netCDF4.Dataset(nc_file, 'a') as nc:
+                nc.variables[dim].setncattr('units', time_units)
+
+
+def _window_split(times, start, end):
+    """
+    Boolean masks of the times before, and at or after, the window 
+    [start, end); None means unbounded
+    """
+    times = pd.DatetimeIndex(times)
+    before = times < start if start is not None else np.zeros(len(times), dtype=bool)
+    after = times >= end if end is not None else np.zeros(len(times), dtype=bool)
+    return np.asarray(before), np.asarray(after)
+
+
+def nc_splice_window(nc_file, ds, start, end, dim='time'):
+    """
+    Replace the data of nc_file in the time window [start, end) with ds, 
+    eg the data of the window processed again. Variables are encoded as 
+    they are in nc_file; variables that are not in both are filled. 
+    Attributes are those of nc_file
+
+    Args:
+        nc_file (str): path to local nc file, sorted by dim
+        ds (Dataset): dataset of the window
+        start (Timestamp): window start, or None
+        end (Timestamp): window end, or None
+        dim (str, optional): time dimension. Defaults to 'time'.
+    """
+    with xr.open_dataset(nc_file) as ds_file:
+        ds_file.load()
+    time_units = ds_file[dim].encoding.get('units')
+    unlimited_dims = list(ds_file.encoding.get('unlimited_dims', []))
+    before, after = _window_split(ds_file[dim].values, start, end)
+    logger.info(f'Replacing {(~(before | after)).sum()} rows of ' + 
+                f'{os.path.basename(nc_file)} with {ds.sizes[dim]} rows')
+
+    # The first dataset, from the file, sets the encoding and attributes
+    ds_out = xr.concat(
+        [ds_file.isel({dim: before}), ds, ds_file.isel({dim: after})], 
+        dim=dim, data_vars='minimal', coords='minimal', compat='override', 
+        combine_attrs='override')
+    try:
+        ds_out.to_netcdf(f'{nc_file}.tmp', unlimited_dims=unlimited_dims)
+    except:
+        if os.path.exists(f'{nc_file}.tmp'):
+            os.remove(f'{nc_file}.tmp')
+        raise
+    if time_units is not None:
+        # xarray reformats the units, eg the reference date
+        with netCDF4.Dataset(f'{nc_file}.tmp', 'a') as nc:
+            nc.variables[dim].setncattr('units', time_units)
+    os.replace(f'{nc_file}.tmp', nc_file)
+
+
+def csv_splice_window(csv_file, df, start, end, csv_times, **kwargs):
+    """
+    Replace the rows of csv_file in the time window [start, end) with 
+    the rows of df, eg the data of the window processed again. 
+    Rows of csv_file are kept as they were written
+
+    Args:
+        csv_file (str): path to local csv file, sorted by time
+        df (DataFrame): rows of the window
+        start (Timestamp): window start, or None
+        end (Timestamp): window end, or None
+        csv_times (function): get the times of a data frame of the rows 
+            of csv_file, read as strings
+        kwargs: the to_csv arguments with which csv_file was written, 
+            eg index, header, and sep
+
+    Returns:
+        int: number of rows in csv_file
+    """
+    read_kwargs = {
+        'sep': kwargs.get('sep', ','), 'dtype': str, 'keep_default_na': False, 
+        'header': 0 if kwargs.get('header', True) else None
+    }
+    df_file = pd.read_csv(csv_file, **read_kwargs)
+    # Rows of the window, as they would be written
+    if len(df.index) > 0:
+        df = pd.read_csv(io.StringIO(df.to_csv(**kwargs)), **read_kwargs)
+    else:
+        df = df_file.iloc[0:0]
+
+    before, after = _window_split(csv_times(df_file), start, end)
+    logger.info(f'Replacing {(~(before | after)).sum()} rows of ' + 
+                f'{os.path.basename(csv_file)} with {len(df.index)} rows')
+    df_out = pd.concat([df_file[before], df, df_file[after]])
+    df_out.to_csv(csv_file, **kwargs)
+    return len(df_out.index)
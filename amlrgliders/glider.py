@@ -1,13 +1,25 @@
 import os
+import copy
+import shutil
 import logging
+import tempfile
 import multiprocessing as mp
-# import numpy as np
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from itertools import repeat
+from itertools import repeat, islice
+from collections import deque
 
-from gdm import GliderDataModel
-from gdm.gliders.slocum import load_slocum_dba
-from amlrgliders.utils import amlr_interpolate
+from amlrgliders.utils import amlr_process_data
+from amlrgliders.slocum import dba_open, dba_is_compressed, dba_segments, \
+    dba_segment_files
+from amlrgliders.prefetch import Prefetcher
+from amlrgliders.staging import OutputStager
+from amlrgliders.storage import LocalStorage, file_md5
+from amlrgliders.parallel import amlr_numcores_plan, log_numcores_plan, amlr_pool
+from amlrgliders.instrument import step
+from amlrgliders.metrics import metric_set
 
 logger = logging.getLogger(__file__)
 
@@ -40,7 +52,10 @@ amlr_ds_varnames = [
 
 
 def amlr_gdm(deployment, project, mode, glider_path, 
-             numcores=0, loadfromtmp=False, clobbertmp=False):
+             numcores=0, loadfromtmp=False, clobbertmp=False, 
+             prefetch=False, scratch_path=None, storage=None, catalog=None, 
+             pool=None, ascii_path=None, checkpoint=None, memory_budget=None, 
+             window_rows=0, work_path=None, start=None, end=None):
     """
     Create gdm object from dba files. 
     Note the data stored in the tmp files has not 
@@ -52,14 +67,54 @@ def amlr_gdm(deployment, project, mode, glider_path,
         mode (str): deployment mode; delayed or rt
         glider_path (str): path to glider folder within deployment folder
         numcores (int, optional): Number of cores to use to read dba files. 
-            Defaults to 0.
+            Defaults to 0, meaning the number of cores is chosen based on 
+            the dba file sizes and memory_budget; see amlr_load_dba.
         loadfromtmp (bool, optional): Load gdm data and profiles from 
             temporary parquet files?. Defaults to False.
         clobbertmp (bool, optional): If they exist, should temporary 
             parquet files be clobbered? Defaults to False.
+        prefetch (bool, optional): Copy dba or parquet files to local 
+            scratch ahead of reading them? Defaults to False.
+        scratch_path (str, optional): Directory for prefetched files. 
+            Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): Storage backend for glider_path. 
+            Defaults to None, meaning LocalStorage. 
+            For other backends, files are always prefetched.
+        catalog (AmlrCatalog, optional): deployment catalog. If given, 
+            dba files are taken from the catalog rather than listed, 
+            and tmp files and profiles are recorded. Defaults to None.
+        pool (mp.Pool, optional): existing worker pool with which to read 
+            dba files, rather than creating one. Defaults to None.
+        ascii_path (str, optional): local directory from which to read 
+            dba files, eg the output of amlr_binary_to_dba. Defaults to None, 
+            meaning the ascii directory of glider_path.
+        checkpoint (Checkpoint, optional): checkpoint in which to save 
+            progress while reading dba files, and from which to resume. 
+            Defaults to None.
+        memory_budget (float, optional): memory budget in bytes, used when 
+            numcores is 0. Defaults to None, meaning 80% of available memory.
+        window_rows (int, optional): if greater than 0, process the data 
+            out of core, in time windows of about window_rows rows: 
+            the data are kept in a local parquet file, and a GdmWindows 
+            object is returned. Defaults to 0.
+        work_path (str, optional): local directory for the parquet file 
+            read by GdmWindows. Defaults to None, meaning a new directory 
+            in scratch_path, which is not removed.
+        start (str or Timestamp, optional): only load and process the data 
+            at or after start, and the profiles within the window 
+            (see amlr_profiles_window), eg to reprocess part of a deployment. 
+            Only the row groups of the tmp data file (loadfromtmp) or 
+            the dba files that overlap the window are read, with an overlap 
+            for the interpolated variables, so that the data are those of 
+            processing the whole deployment. The data read with the overlap 
+            are kept in gdm.data_overlap, eg to match images near the edges 
+            of the window. Tmp files are not written. Defaults to None.
+        end (str or Timestamp, optional): only load and process the data 
+            before end. Defaults to None.
 
     Returns:
-        gdm: gdm object
+        gdm: gdm object, or GdmWindows (with the gdm object, without data, 
+        as its gdm attribute) if window_rows is greater than 0
     """
 
     #--------------------------------------------
@@ -85,15 +140,26 @@ def amlr_gdm(deployment, project, mode, glider_path,
         logger.error(f"project must be one of {', '.join(prj_list)}")
         return 
     
-    # Handle script default value
-    if numcores == 0:
-        numcores = mp.cpu_count()
-
-    if not (1 <= numcores and numcores <= mp.cpu_count()):
-        logger.error(f'numcores must be between 1 and {mp.cpu_count()}')
+    # numcores of 0 (the script default) is handled in amlr_load_dba
+    if not (0 <= numcores and numcores <= mp.cpu_count()):
+        logger.error(f'numcores must be between 0 and {mp.cpu_count()}')
         return 
     
-    if not os.path.isdir(glider_path):
+    time_range = start is not None or end is not None
+    if time_range and window_rows > 0:
+        logger.error('A start or end time cannot be used with window_rows')
+        return
+    if time_range:
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        logger.info(f"Processing data from {start or 'start'} to {end or 'end'}")
+
+    if storage is None:
+        storage = LocalStorage()
+    if not storage.is_local:
+        prefetch = True
+
+    if not storage.isdir(glider_path):
         logger.error(f'glider_path ({glider_path}) does not exist')
         return
     logger.info(f'Glider deployment path: {glider_path}')
@@ -101,7 +167,11 @@ def amlr_gdm(deployment, project, mode, glider_path,
 
     #--------------------------------------------
     # Set path/file variables, and create file paths if necessary
-    ascii_path  = os.path.join(glider_path, 'data', 'ascii', mode)
+    ascii_storage = storage
+    if ascii_path is None:
+        ascii_path = os.path.join(glider_path, 'data', 'ascii', mode)
+    else:
+        ascii_storage = LocalStorage()
     config_path = os.path.join(glider_path, 'data', 'data-config')
     # nc_ngdac_path = os.path.join(glider_path, 'data', 'out', 'nc', 'ngdac', mode)
     # nc_trajectory_path = os.path.join(glider_path, 'data', 'out', 'nc', 'trajectory')
@@ -111,78 +181,127 @@ def amlr_gdm(deployment, project, mode, glider_path,
     pq_profiles_file = os.path.join(tmp_path, f'{deployment_mode}-profiles.parquet')
     
     # Confirm direcotry exists as GCS buckets don't do implicit directories
-    if not os.path.exists(tmp_path):
+    if not storage.exists(tmp_path):
         logger.info(f'Creating directory at: {tmp_path}')
-        os.makedirs(tmp_path)
+        storage.makedirs(tmp_path)
 
     #--------------------------------------------
     # Create gdm object, and load in data
-    if not os.path.exists(config_path):
+    if not storage.isdir(config_path):
         logger.error(f'The config path does not exist {config_path}')
         return 
+
+    if not storage.is_local:
+        # GliderDataModel reads its configs from a local directory
+        config_path_local = tempfile.mkdtemp(prefix='amlr-config-', dir=scratch_path)
+        logger.info(f'Downloading configs from {config_path} to {config_path_local}')
+        storage.download_dir(config_path, config_path_local)
+        config_path = config_path_local
                         
+    # Local import, so that gdm (and xarray) are only loaded by the stages 
+    #   that use them, rather than by every script that imports this module
+    from gdm import GliderDataModel
     logger.info(f'Creating GliderDataModel object from configs: {config_path}')
     gdm = GliderDataModel(config_path)
     
+    if window_rows > 0:
+        return amlr_gdm_windows(
+            gdm, deployment, mode, tmp_path, numcores, loadfromtmp, clobbertmp, 
+            window_rows, prefetch, scratch_path, storage, catalog, pool, 
+            ascii_path, ascii_storage, checkpoint, memory_budget, work_path)
+
     if loadfromtmp:        
+        from amlrgliders.chunked import read_tmp_parquet
         logger.info(f'Loading gdm data and profiles from parquet files in: {tmp_path}')
-        gdm.data = pd.read_parquet(pq_data_file)
-        gdm.profiles = pd.read_parquet(pq_profiles_file)
+        # Local (or prefetched) tmp files are memory-mapped
+        read_data = amlr_tmp_data_window if time_range else read_tmp_parquet
+        if prefetch:
+            with Prefetcher([pq_profiles_file, pq_data_file], scratch_path, 
+                            max_workers=2, storage=storage) as prefetcher:
+                gdm.profiles = read_tmp_parquet(prefetcher.get(pq_profiles_file))
+                gdm.data = read_data(prefetcher.get(pq_data_file), start, end)
+        else:
+            gdm.data = read_data(pq_data_file, start, end)
+            gdm.profiles = read_tmp_parquet(pq_profiles_file)
 
     else:    
-        gdm.data, gdm.profiles = amlr_load_dba(ascii_path, numcores)
-        
-        # Write data to parquet files, if specified
-        if not clobbertmp and os.path.exists(pq_profiles_file):
-            logger.info(f'The parquet file for gdm profiles {pq_profiles_file} ' + 
-                        'already exists, and will not be clobbered')
-        else:
-            logger.info('Writing gdm profiles to parquet file')
-            gdm.profiles.to_parquet(
-                pq_profiles_file, version="2.6", index = True
-            )
+        dba_files = None
+        if catalog is not None and ascii_storage is storage:
+            dba_files = catalog.files(deployment, mode, 'dba')
+            if dba_files is None:
+                dba_files = catalog.scan_files(
+                    deployment, mode, 'dba', ascii_path, storage, 
+                    checksum=not storage.is_local)
+
+        if time_range:
+            with step('load_dba') as s:
+                dba_out = amlr_load_dba_window(
+                    ascii_path, start, end, numcores, 
+                    prefetch and ascii_storage is storage, scratch_path, 
+                    ascii_storage, dba_files, pool, memory_budget)
+                if dba_out is None:
+                    return
+                gdm.data, gdm.profiles = dba_out
+                s.data(gdm.data)
 
-        if not clobbertmp and os.path.exists(pq_data_file):
-            logger.info(f'The parquet file for gdm data {pq_data_file} ' + 
-                        'already exists, and will not be clobbered')
         else:
-            logger.info('Writing gdm data to parquet file')
-            gdm.data.to_parquet(
-                pq_data_file, version="2.6", index = True
-            )
+            with step('load_dba') as s:
+                gdm.data, gdm.profiles = amlr_load_dba(
+                    ascii_path, numcores, prefetch and ascii_storage is storage, 
+                    scratch_path, ascii_storage, dba_files, pool, checkpoint, 
+                    memory_budget)
+                s.data(gdm.data)
+            metric_set('rows_parsed', len(gdm.data.index))
+        
+            # Write data to parquet files, if specified
+            from amlrgliders.chunked import write_tmp_parquet
+            with step('write_tmp'), \
+                    OutputStager(tmp_path, scratch_path, storage=storage) as stager:
+                if not clobbertmp and storage.exists(pq_profiles_file):
+                    logger.info(f'The parquet file for gdm profiles {pq_profiles_file} ' + 
+                                'already exists, and will not be clobbered')
+                else:
+                    logger.info('Writing gdm profiles to parquet file')
+                    write_tmp_parquet(
+                        gdm.profiles, stager.path(os.path.basename(pq_profiles_file)))
+
+                if not clobbertmp and storage.exists(pq_data_file):
+                    logger.info(f'The parquet file for gdm data {pq_data_file} ' + 
+                                'already exists, and will not be clobbered')
+                else:
+                    logger.info('Writing gdm data to parquet file')
+                    write_tmp_parquet(
+                        gdm.data, stager.path(os.path.basename(pq_data_file)))
+            if catalog is not None:
+                catalog.record_files(deployment, mode, 'tmp', tmp_path, stager.uploaded)
+
+    # The data of a time window were processed as they were read, 
+    #   with the overlap
+    if time_range:
+        from amlrgliders.chunked import data_window
+        gdm.data_overlap = gdm.data
+        gdm.data = data_window(gdm.data_overlap, start, end)
+        if len(gdm.data.index) == 0:
+            logger.error(f'There are no data from {start} to {end}')
+            return
+        gdm.profiles = amlr_profiles_window(gdm.profiles, start, end)
+        logger.info(f'Returning gdm object for {len(gdm.profiles.index)} profiles')
+        return gdm
+
+    # The gdm stage is complete, for resuming, if the tmp files match gdm
+    if checkpoint is not None and (loadfromtmp or len(stager.uploaded) == 2):
+        checkpoint.set_stage_done('gdm')
+
+    if catalog is not None:
+        catalog.record_profiles(deployment, mode, gdm.profiles)
+    metric_set('profiles', len(gdm.profiles.index))
         
     #--------------------------------------------
     ### Additional processing of gdm object
 
-    # Make columns lowercase to match sensor definitions yaml file
-    logger.info('Making sensor (data column) names lowercase')
-    gdm.data.columns = gdm.data.columns.str.lower()
-
-    # Remove garbage data
-    #   Removing these timestamps is for situations when there is a " + 
-    #   'Not enough timestamps for yo interpolation' warning",
-    if any(gdm.data.index == '1970-01-01'):
-        n_toremove = sum(gdm.data.index == '1970-01-01')
-        logger.info(f'Removing {n_toremove} invalid (1970-01-01) timestamps')
-        gdm.data = gdm.data[gdm.data.index != '1970-01-01']
-    else:
-        logger.info('No invalid (1970-01-01) timestamps to remove')
-
-    # Remove duplicate timestamps
-    gdm_dup = gdm.data.index.duplicated(keep='last')
-    if any(gdm_dup):
-        logger.info('Removing duplicated timestamps')
-        gdm.data = gdm.data[~gdm_dup]
-        logger.info(f'Removed {gdm_dup.sum()} rows with duplicated timestamps')
-    else:
-        logger.info('No duplicated timestamps to remove')
-
-    # Create interpolated variables
-    logger.info('Creating interpolated variables')
-    gdm.data['idepth']  = amlr_interpolate(gdm.data['depth'])
-    gdm.data['imdepth'] = amlr_interpolate(gdm.data['m_depth'])
-    gdm.data['impitch'] = amlr_interpolate(gdm.data['m_pitch'])
-    gdm.data['imroll']  = amlr_interpolate(gdm.data['m_roll'])
+    with step('process_data') as s:
+        gdm.data = amlr_process_data(gdm.data)
+        s.data(gdm.data)
 
     #--------------------------------------------
     logger.info(f'Returning gdm object')    
@@ -192,95 +311,712 @@ def amlr_gdm(deployment, project, mode, glider_path,
 
 
 
-def amlr_load_dba(ascii_path, numcores):
+def amlr_gdm_windows(gdm, deployment, mode, tmp_path, numcores, loadfromtmp, 
+                     clobbertmp, window_rows, prefetch, scratch_path, storage, 
+                     catalog, pool, ascii_path, ascii_storage, checkpoint, 
+                     memory_budget, work_path):
+    """
+    Out-of-core part of amlr_gdm: load the profiles, and either locate 
+    (loadfromtmp) or create the tmp data parquet file, without loading 
+    the data into memory. See amlr_gdm for arguments
+
+    Returns:
+        GdmWindows: windows of the gdm data, or None on error
+    """
+    from amlrgliders.chunked import (GdmWindows, parquet_num_rows, 
+                                     read_tmp_parquet, write_tmp_parquet)
+    deployment_mode = f'{deployment}-{mode}'
+    pq_data_file = os.path.join(tmp_path, f'{deployment_mode}-data.parquet')
+    pq_profiles_file = os.path.join(tmp_path, f'{deployment_mode}-profiles.parquet')
+
+    if work_path is None:
+        work_path = tempfile.mkdtemp(prefix='amlr-gdm-', dir=scratch_path)
+    data_file = os.path.join(work_path, os.path.basename(pq_data_file))
+
+    if loadfromtmp:
+        logger.info(f'Loading gdm profiles from parquet file in: {tmp_path}')
+        if storage.is_local:
+            gdm.profiles = read_tmp_parquet(pq_profiles_file)
+        else:
+            with storage.open(pq_profiles_file, 'rb') as f:
+                gdm.profiles = pd.read_parquet(f)
+        if storage.is_local:
+            data_file = pq_data_file
+        else:
+            logger.info(f'Downloading gdm data parquet file to {work_path}')
+            storage.get(pq_data_file, data_file)
+
+    else:
+        dba_files = None
+        if catalog is not None and ascii_storage is storage:
+            dba_files = catalog.files(deployment, mode, 'dba')
+            if dba_files is None:
+                dba_files = catalog.scan_files(
+                    deployment, mode, 'dba', ascii_path, storage, 
+                    checksum=not storage.is_local)
+        dba_out = amlr_load_dba(
+            ascii_path, numcores, prefetch and ascii_storage is storage, 
+            scratch_path, ascii_storage, dba_files, pool, checkpoint, 
+            memory_budget, data_file)
+        if dba_out is None:
+            return
+        gdm.profiles = dba_out[1]
+        metric_set('rows_parsed', parquet_num_rows(data_file))
+
+        # Write profiles, and upload the data file, to tmp files
+        with OutputStager(tmp_path, scratch_path, storage=storage) as stager:
+            if not clobbertmp and storage.exists(pq_profiles_file):
+                logger.info(f'The parquet file for gdm profiles {pq_profiles_file} ' + 
+                            'already exists, and will not be clobbered')
+            else:
+                logger.info('Writing gdm profiles to parquet file')
+                write_tmp_parquet(
+                    gdm.profiles, stager.path(os.path.basename(pq_profiles_file)))
+        uploaded = list(stager.uploaded)
+        if not clobbertmp and storage.exists(pq_data_file):
+            logger.info(f'The parquet file for gdm data {pq_data_file} ' + 
+                        'already exists, and will not be clobbered')
+        else:
+            logger.info('Uploading gdm data parquet file')
+            storage.put(data_file, pq_data_file)
+            uploaded.append((os.path.basename(pq_data_file), 
+                             os.path.getsize(data_file), file_md5(data_file)))
+        if catalog is not None:
+            catalog.record_files(deployment, mode, 'tmp', tmp_path, uploaded)
+
+    # The gdm stage is complete, for resuming, if the tmp files match gdm
+    if checkpoint is not None and (loadfromtmp or len(uploaded) == 2):
+        checkpoint.set_stage_done('gdm')
+
+    if catalog is not None:
+        catalog.record_profiles(deployment, mode, gdm.profiles)
+    metric_set('profiles', len(gdm.profiles.index))
+
+    if not {'start_time', 'end_time'}.issubset(gdm.profiles.columns):
+        logger.error('The gdm profiles do not have start_time and end_time, ' + 
+                     'and thus the data cannot be processed in time windows')
+        return
+
+    return GdmWindows(data_file, gdm.profiles, window_rows, gdm=gdm)
+
+
+def amlr_profiles_window(profiles, start=None, end=None):
+    """
+    Subset gdm profiles to those within the time window [start, end), 
+    ie that start at or after start and end before end. Profiles that 
+    cross start or end are not kept, as their data are not all in the 
+    window (GdmWindows never splits profiles). 
+    If profiles have no start_time column, all are kept
+
+    Args:
+        profiles (DataFrame): gdm profiles
+        start (str or Timestamp, optional): window start. Defaults to None.
+        end (str or Timestamp, optional): window end. Defaults to None.
+
+    Returns:
+        DataFrame: profiles in the window
+    """
+    if 'start_time' not in profiles.columns:
+        return profiles
+    in_window = pd.Series(True, index=profiles.index)
+    if start is not None:
+        in_window &= profiles['start_time'] >= pd.Timestamp(start)
+    if end is not None:
+        in_window &= profiles['end_time'] < pd.Timestamp(end)
+    if not in_window.all():
+        logger.info(f'{(~in_window).sum()} profiles are not within the time window')
+    return profiles[in_window]
+
+
+def amlr_tmp_data_window(data_file, start, end):
+    """
+    Read and process the gdm data in the time window [start, end) from 
+    a local tmp data parquet file, reading only the row groups that 
+    overlap the window and its overlap (see read_processed_window)
+
+    Returns:
+        DataFrame: processed data in the window, with the overlap
+    """
+    from amlrgliders.chunked import (parquet_index_name, parquet_time_range, 
+                                     read_processed_window, read_tmp_parquet)
+    time_min, time_max = parquet_time_range(data_file, parquet_index_name(data_file))
+    return read_processed_window(
+        lambda i, j: read_tmp_parquet(data_file, i, j), 
+        start, end, time_min, time_max, with_overlap=True)
+
+
+def amlr_load_dba_window(ascii_path, start, end, numcores, prefetch=False, 
+                         scratch_path=None, storage=None, dba_files=None, 
+                         pool=None, memory_budget=None):
+    """
+    Read only the dba files that overlap the time window [start, end), 
+    and process their data. Each dba file is taken to span from its 
+    open time (see dba_open_time) to that of the next file. 
+    Files are read with an overlap, widened as needed, so that the data 
+    are those of processing the whole deployment (see read_processed_window), 
+    and in the order in which amlr_load_dba reads them. 
+    See amlr_load_dba for arguments
+
+    Returns:
+        Tuple of processed data in the window, with the overlap, and 
+        the profiles of the dba files read; None if no dba files 
+        overlap the window
+    """
+    from amlrgliders.chunked import read_processed_window
+    from amlrgliders.slocum import dba_open_time
+    if storage is None:
+        storage = LocalStorage()
+
+    if dba_files is None:
+        dba_files = storage.walk_files(ascii_path, recursive=False)
+    # The open time of a segment is that of its flight file
+    segments = {dba_segment_files(i)[0]: i for i in dba_segments(dba_files)}
+    logger.info(f'Reading the open times of {len(segments)} dba segments')
+    with ThreadPoolExecutor(16) as executor:
+        open_times = pd.Series(list(executor.map(
+            lambda i: dba_open_time(os.path.join(ascii_path, i), storage), 
+            segments)), index=list(segments), dtype='datetime64[ns]')
+    # Files without an open time are always read
+    files_unknown = list(open_times.index[open_times.isna()])
+    open_times = open_times.dropna().sort_values(kind='stable')
+    if len(open_times.index) == 0:
+        logger.error(f'The open times of the dba files in {ascii_path} ' + 
+                     'could not be read')
+        return
+    next_times = open_times.shift(-1)
+
+    def files_window(read_start, read_end):
+        in_window = pd.Series(True, index=open_times.index)
+        if read_start is not None:
+            in_window &= next_times.isna() | (next_times > read_start)
+        if read_end is not None:
+            in_window &= open_times < read_end
+        # Segments are kept in the order of dba_files, as when reading 
+        #   all files, so that duplicated times are dropped identically
+        files_read = set(open_times.index[in_window]).union(files_unknown)
+        return [
+            j for i in segments if i in files_read 
+            for j in dba_segment_files(segments[i])
+        ]
+
+    if len(files_window(start, end)) == 0:
+        logger.error(f'No dba files overlap the time window from {start} to {end}')
+        return
+
+    profiles = []
+    def read(read_start, read_end):
+        files = files_window(read_start, read_end)
+        logger.info(f'Reading {len(files)} of {len(dba_files)} dba files, ' + 
+                    f"from {read_start or 'start'} to {read_end or 'end'}")
+        data, pro_meta_df = amlr_load_dba(
+            ascii_path, numcores, prefetch, scratch_path, storage, files, pool, 
+            memory_budget=memory_budget)
+        profiles[:] = [pro_meta_df]
+        return data
+
+    data = read_processed_window(
+        read, start, end, open_times.iloc[0], open_times.iloc[-1], 
+        with_overlap=True)
+    return data, profiles[0]
+
+
+def amlr_load_dba(ascii_path, numcores, prefetch=False, scratch_path=None, 
+                  storage=None, dba_files=None, pool=None, checkpoint=None, 
+                  memory_budget=None, data_file=None, chunk_files=500):
     """
     Read in dba files from ascii_path using numcores cores
     Returns dba data and profile data frames
 
     Args:
         ascii_path (str): path to ascii (dba) files
-        numcores (int): number of cores to use
+        numcores (int): number of cores to use. If 0, the number of cores 
+            is chosen so that the parsed data and the parsing workers fit 
+            in memory_budget, estimated from the dba file sizes and the 
+            parsed size of the largest file (see amlr_numcores_plan)
+        prefetch (bool, optional): copy dba files to local scratch 
+            ahead of parsing them? Defaults to False.
+        scratch_path (str, optional): directory for prefetched files. 
+            Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for ascii_path. 
+            Defaults to None, meaning LocalStorage. 
+            For other backends, files are always prefetched.
+        dba_files (list, optional): names of files in ascii_path, 
+            eg from the deployment catalog. Defaults to None, 
+            meaning ascii_path is listed.
+        pool (mp.Pool, optional): existing worker pool to use, 
+            rather than creating one. Defaults to None.
+        checkpoint (Checkpoint, optional): checkpoint in which to save 
+            the parsed data every checkpoint.every files, and from which 
+            to resume. Defaults to None.
+        memory_budget (float, optional): memory budget in bytes, used when 
+            numcores is 0. Defaults to None, meaning 80% of available memory.
+        data_file (str, optional): local parquet file to which to write 
+            the data, out of core (see amlr_load_dba_chunked), rather than 
+            returning them. Defaults to None.
+        chunk_files (int, optional): number of files per chunk, 
+            if data_file is given. Defaults to 500.
         
     Returns:
-        Tuple of dba (data) and profiles data frames
+        Tuple of dba (data) and profiles data frames. 
+        If data_file is given, the data are None
     """
-    dba_files_list = list(
-        map(lambda x: os.path.join(ascii_path, x), os.listdir(ascii_path))
-    )
+    if storage is None:
+        storage = LocalStorage()
+    if not storage.is_local:
+        prefetch = True
+
+    if dba_files is None:
+        dba_files = storage.walk_files(ascii_path, recursive=False)
+    dba_files_list = [os.path.join(ascii_path, i) for i in dba_files]
+    # If a dba file is present both compressed and uncompressed, 
+    #   read the uncompressed (more recently converted) file
+    dba_files_set = set(dba_files_list)
+    dba_files_list = [
+        i for i in dba_files_list 
+        if not (dba_is_compressed(i) and os.path.splitext(i)[0] in dba_files_set)
+    ]
+    # Unmerged flight and science files are read (and merged) together
+    dba_files_list = dba_segments(dba_files_list)
     # dba_files = pd.DataFrame(dba_files_list, columns = ['dba_file'])
     # dba_files_count = len(dba_files.index)        
-    logger.info(f'Reading ascii data from {len(dba_files_list)} files ' + 
-                f'using {numcores} core(s)')
 
     if len(dba_files_list) == 0:
         logger.error(f'There are no dba files in the expected directory ' + 
             f'({ascii_path}), and thus the gdm object cannot be created')
         return
+
+    if numcores == 0:
+        if pool is not None:
+            numcores = pool._processes
+        else:
+            sizes = {
+                os.path.join(ascii_path, i): j 
+                for i, j, _ in storage.walk_stats(ascii_path, recursive=False, 
+                                                  checksum=False)
+            }
+            file_sizes = [
+                sum(sizes.get(j, 0) for j in dba_segment_files(i)) 
+                for i in dba_files_list
+            ]
+            if data_file is not None:
+                # Only one chunk of files is held in memory at a time
+                file_sizes = sorted(file_sizes)[-chunk_files:]
+            k_sample = max(range(len(file_sizes)), key=lambda k: file_sizes[k])
+            sample_file = dba_files_list[k_sample]
+            parse_ratio = dba_parse_ratio(
+                sample_file, file_sizes[k_sample], scratch_path, storage)
+            plan = amlr_numcores_plan(file_sizes, parse_ratio, memory_budget)
+            log_numcores_plan(plan)
+            numcores = plan['parse']
+
+    logger.info(f'Reading ascii data from {len(dba_files_list)} files ' + 
+                f'using {numcores} core(s)')
     
-    # Read dba files
-    if numcores > 1:
-        logger.debug('Reading dba files in parallel')
-        # If numcores is greater than 1, run load_slocum_dba in parallel
-        with mp.Pool(numcores) as pool:
-            load_slocum_dba_list = pool.map(load_slocum_dba, dba_files_list)
-        # pool = mp.Pool(numcores)
-        # load_slocum_dba_list = pool.map(load_slocum_dba, dba_files_list)
-        # pool.close()
-        # pool.join()
+    # Read dba files, prefetching them to local scratch if specified
+    if data_file is not None:
+        if checkpoint is not None:
+            logger.info('dba files read out of core are not checkpointed')
+        with step('parse_chunked'):
+            pro_meta_df = amlr_load_dba_chunked(
+                dba_files_list, numcores, data_file, chunk_files, prefetch, 
+                scratch_path, storage, pool)
+        return None, pro_meta_df
+    
+    with step('parse'):
+        if checkpoint is not None:
+            load_slocum_dba_list = amlr_load_dba_checkpoint(
+                dba_files_list, numcores, checkpoint, prefetch, scratch_path, 
+                storage, pool)
+        elif prefetch:
+            with Prefetcher(dba_files_list, scratch_path, storage=storage) as prefetcher:
+                load_slocum_dba_list = amlr_load_dba_files(
+                    prefetcher, numcores, prefetcher.release, pool, 2 * numcores)
+        else:
+            load_slocum_dba_list = amlr_load_dba_files(
+                dba_files_list, numcores, pool=pool)
         
-        logger.info('Zipping output and concatenating data')
+    logger.info('Zipping output and concatenating data')
+    with step('concat') as s:
         # dba_zip_list = list(zip(*load_slocum_dba_list))
         dba_zip, pro_meta_zip = zip(*load_slocum_dba_list)
-        del load_slocum_dba_list, pool
+        del load_slocum_dba_list
                     
-        logger.debug('Concatenating pool output into profile data frame')
+        logger.debug('Concatenating output into profile data frame')
         pro_meta_df = pd.concat(pro_meta_zip)
         
-        logger.debug('Concatenating pool output into trajectory data frame')
+        logger.debug('Concatenating output into trajectory data frame')
         dba_df = pd.concat(dba_zip)
         del pro_meta_zip, dba_zip
-
-    else :        
-        logger.debug(f'Reading dba files in for loop')
-        pro_meta_df = pd.DataFrame()
-        dba_df = pd.DataFrame()
-        for i in dba_files_list:
-            logger.debug(f'dba file: {i}')
-            dba, pro_meta = load_slocum_dba(i)                
-            pro_meta_df = pd.concat([pro_meta_df, pro_meta])
-            dba_df = pd.concat([dba_df, dba])
+        s.data(dba_df)
         
     logger.info('Sorting data and profile data frames by time index')
-    pro_meta_df = pro_meta_df.sort_index()
-    dba_df = dba_df.sort_index()
+    with step('sort') as s:
+        # Stable sorts, so that the last of duplicated timestamps 
+        #   is from the last file read
+        pro_meta_df = pro_meta_df.sort_index(kind='stable')
+        dba_df = dba_df.sort_index(kind='stable')
+        s.data(dba_df)
    
     logger.info('Returning data and profiles data frames')    
     return dba_df, pro_meta_df
 
 
-def amlr_write_trajectory(gdm, deployment, mode, glider_path, write_full = True):
+def amlr_load_dba_checkpoint(dba_files_list, numcores, checkpoint, prefetch=False, 
+                             scratch_path=None, storage=None, pool=None):
+    """
+    Read dba files in chunks of checkpoint.every files, and save the 
+    data and profiles of each chunk to the checkpoint. 
+    Chunks saved by a previous (eg preempted) run are read from the 
+    checkpoint, rather than parsed again
+
+    Args:
+        dba_files_list (list): paths to dba files, or segments 
+            (see dba_segments)
+        numcores (int): number of cores to use
+        checkpoint (Checkpoint): checkpoint
+        prefetch (bool, optional): copy dba files to local scratch 
+            ahead of parsing them? Defaults to False.
+        scratch_path (str, optional): directory for prefetched and 
+            checkpoint files. Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for dba files. 
+            Defaults to None, meaning LocalStorage.
+        pool (mp.Pool, optional): existing worker pool to use, 
+            rather than creating one. Defaults to None.
+
+    Returns:
+        list: (dba, profiles) tuples, one per chunk
+    """
+    done = set(checkpoint.items('dba_files'))
+    dba_files_todo = [
+        i for i in dba_files_list 
+        if os.path.basename(dba_segment_files(i)[0]) not in done
+    ]
+    n_done = len(dba_files_list) - len(dba_files_todo)
+    if n_done > 0:
+        logger.info(f'Loading {n_done} parsed dba files from checkpoint')
+
+    load_slocum_dba_list = []
+    with tempfile.TemporaryDirectory(prefix='amlr-checkpoint-', dir=scratch_path) as tmp_path:
+        chunk_names = checkpoint.files('dba-')
+        for i in chunk_names:
+            data_file = checkpoint.get_file(i, tmp_path)
+            pro_file = checkpoint.get_file(i.replace('dba-', 'profiles-', 1), tmp_path)
+            load_slocum_dba_list.append(
+                (pd.read_parquet(data_file), pd.read_parquet(pro_file)))
+            os.remove(data_file)
+            os.remove(pro_file)
+
+        with (nullcontext(pool) if pool is not None or numcores == 1 
+              else amlr_pool(numcores)) as pool_curr, \
+                (Prefetcher(dba_files_todo, scratch_path, storage=storage) 
+                 if prefetch else nullcontext()) as prefetcher:
+            files_iter = iter(prefetcher if prefetch else dba_files_todo)
+            release = prefetcher.release if prefetch else None
+            for k in range(0, len(dba_files_todo), checkpoint.every):
+                chunk = dba_files_todo[k:(k+checkpoint.every)]
+                chunk_list = amlr_load_dba_files(
+                    islice(files_iter, len(chunk)), numcores, release, pool_curr, 
+                    2 * numcores if prefetch else None)
+                dba_zip, pro_meta_zip = zip(*chunk_list)
+                dba_df = pd.concat(dba_zip)
+                pro_meta_df = pd.concat(pro_meta_zip)
+                del chunk_list, dba_zip, pro_meta_zip
+
+                # Save the chunk, and record its files as parsed
+                k_chunk = len(chunk_names)
+                data_file = os.path.join(tmp_path, f'dba-{k_chunk:05d}.parquet')
+                pro_file = os.path.join(tmp_path, f'profiles-{k_chunk:05d}.parquet')
+                dba_df.to_parquet(data_file, version="2.6", index=True)
+                pro_meta_df.to_parquet(pro_file, version="2.6", index=True)
+                checkpoint.put_files(
+                    [data_file, pro_file], 'dba_files', 
+                    [os.path.basename(dba_segment_files(i)[0]) for i in chunk])
+                chunk_names.append(os.path.basename(data_file))
+                os.remove(data_file)
+                os.remove(pro_file)
+
+                load_slocum_dba_list.append((dba_df, pro_meta_df))
+                logger.info(f'Checkpoint: {n_done + k + len(chunk)} of ' + 
+                            f'{len(dba_files_list)} dba files parsed')
+
+    return load_slocum_dba_list
+
+
+def amlr_load_dba_chunked(dba_files_list, numcores, data_file, chunk_files=500, 
+                          prefetch=False, scratch_path=None, storage=None, 
+                          pool=None):
+    """
+    Read dba files out of core: read chunks of chunk_files files, 
+    writing the data of each chunk, sorted by time, to a parquet file, 
+    and then merge the chunk files into data_file. 
+    data_file is identical to the data returned by amlr_load_dba 
+    written to a parquet file
+
+    Args:
+        dba_files_list (list): paths to dba files
+        numcores (int): number of cores to use
+        data_file (str): local parquet file to which to write the data
+        chunk_files (int, optional): number of files per chunk. 
+            Defaults to 500.
+        prefetch (bool, optional): copy dba files to local scratch 
+            ahead of parsing them? Defaults to False.
+        scratch_path (str, optional): directory for prefetched and 
+            chunk files. Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for dba files. 
+            Defaults to None, meaning LocalStorage.
+        pool (mp.Pool, optional): existing worker pool to use, 
+            rather than creating one. Defaults to None.
+
+    Returns:
+        DataFrame: profiles, sorted by time index
+    """
+    from amlrgliders.chunked import parquet_merge_sorted
+    pro_meta_list = []
+    with tempfile.TemporaryDirectory(prefix='amlr-chunks-', dir=scratch_path) as tmp_path:
+        chunk_files_list = []
+        with (nullcontext(pool) if pool is not None or numcores == 1 
+              else amlr_pool(numcores)) as pool_curr, \
+                (Prefetcher(dba_files_list, scratch_path, storage=storage) 
+                 if prefetch else nullcontext()) as prefetcher:
+            files_iter = iter(prefetcher if prefetch else dba_files_list)
+            release = prefetcher.release if prefetch else None
+            for k in range(0, len(dba_files_list), chunk_files):
+                chunk = dba_files_list[k:(k+chunk_files)]
+                chunk_list = amlr_load_dba_files(
+                    islice(files_iter, len(chunk)), numcores, release, pool_curr, 
+                    2 * numcores if prefetch else None)
+                dba_zip, pro_meta_zip = zip(*chunk_list)
+                chunk_file = os.path.join(
+                    tmp_path, f'dba-{len(chunk_files_list):05d}.parquet')
+                pd.concat(dba_zip).sort_index(kind='stable').to_parquet(
+                    chunk_file, version="2.6", index=True)
+                chunk_files_list.append(chunk_file)
+                pro_meta_list.append(pd.concat(pro_meta_zip))
+                del chunk_list, dba_zip, pro_meta_zip
+                logger.info(f'{k + len(chunk)} of {len(dba_files_list)} ' + 
+                            'dba files read')
+
+        logger.info(f'Merging {len(chunk_files_list)} chunk files, sorted by time')
+        parquet_merge_sorted(chunk_files_list, data_file)
+
+    return pd.concat(pro_meta_list).sort_index(kind='stable')
+
+
+def amlr_load_dba_files(dba_files, numcores, release=None, pool=None, 
+                        max_pending=None):
+    """
+    Read dba files using amlr_load_slocum_dba, 
+    in parallel (via mp.Pool.imap) if numcores is greater than 1.
+    With max_pending, files are instead handed to the pool 
+    as earlier files are read, eg so that at most max_pending 
+    local copies from a Prefetcher are held until they are released
+
+    Args:
+        dba_files (iterable): paths to dba files, eg a list or a Prefetcher
+        numcores (int): number of cores to use
+        release (function, optional): called with each path 
+            after that file has been read. Defaults to None.
+        pool (mp.Pool, optional): existing worker pool to use, 
+            rather than creating one. Defaults to None.
+        max_pending (int, optional): maximum number of files handed to 
+            the pool that have not yet been read and released. 
+            Defaults to None, meaning no limit.
+
+    Returns:
+        list: (dba, profiles) tuples from load_slocum_dba
+    """
+    # Paths in the order they were handed out, to match imap output
+    files_read = []
+    def files_iter():
+        for i in dba_files:
+            files_read.append(i)
+            yield i
+
+    if pool is not None or numcores > 1:
+        logger.debug('Reading dba files in parallel')
+        with (nullcontext(pool) if pool is not None 
+              else amlr_pool(numcores)) as pool_curr:
+            load_slocum_dba_list = []
+            if max_pending is None:
+                for j, dba_out in enumerate(
+                        pool_curr.imap(amlr_load_slocum_dba, files_iter())):
+                    load_slocum_dba_list.append(dba_out)
+                    if release is not None:
+                        release(files_read[j])
+            else:
+                # Files are handed out from this thread, rather than by the 
+                #   imap task thread, so that waiting for reads cannot block 
+                #   the pool (eg its termination after an error)
+                pending = deque()
+                def read_next():
+                    i, result = pending.popleft()
+                    load_slocum_dba_list.append(result.get())
+                    if release is not None:
+                        release(i)
+                for i in dba_files:
+                    pending.append(
+                        (i, pool_curr.apply_async(amlr_load_slocum_dba, (i,))))
+                    if len(pending) >= max_pending:
+                        read_next()
+                while pending:
+                    read_next()
+
+    else:
+        logger.debug(f'Reading dba files in for loop')
+        load_slocum_dba_list = []
+        for i in files_iter():
+            logger.debug(f'dba file: {i}')
+            load_slocum_dba_list.append(amlr_load_slocum_dba(i))
+            if release is not None:
+                release(i)
+
+    return load_slocum_dba_list
+
+
+def dba_parse_ratio(dba_file, file_size, scratch_path=None, storage=None):
+    """
+    Measure the in-memory size of the parsed data of dba_file, 
+    relative to its (possibly compressed) file size
+
+    Args:
+        dba_file (str or tuple): path to dba file, eg the largest of 
+            a deployment, or an unmerged segment (see dba_segments)
+        file_size (int): size of dba_file in bytes
+        scratch_path (str, optional): directory to which to copy dba_file, 
+            if storage is not local. Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for dba_file. 
+            Defaults to None, meaning LocalStorage.
+
+    Returns:
+        float: parse expansion ratio
+    """
+    if storage is None:
+        storage = LocalStorage()
+
+    logger.info('Measuring the parsed size of ' + 
+                os.path.basename(dba_segment_files(dba_file)[0]))
+    with tempfile.TemporaryDirectory(dir=scratch_path) as tmp_path:
+        if not storage.is_local:
+            local_files = []
+            for i in dba_segment_files(dba_file):
+                local_files.append(os.path.join(tmp_path, os.path.basename(i)))
+                storage.get(i, local_files[-1])
+            dba_file = tuple(local_files) if isinstance(dba_file, tuple) \
+                else local_files[0]
+        dba, pro_meta = amlr_load_slocum_dba(dba_file)
+    parsed_bytes = dba.memory_usage(deep=True).sum() + \
+        pro_meta.memory_usage(deep=True).sum()
+
+    parse_ratio = parsed_bytes / max(file_size, 1)
+    logger.info(f'Parse expansion ratio: {parse_ratio:.1f} ' + 
+                f'({file_size / 1e6:.1f} MB file, {parsed_bytes / 1e6:.1f} MB parsed)')
+    return parse_ratio
+
+
+def amlr_load_slocum_dba(dba_file):
+    """
+    Wrapper around load_slocum_dba that also reads gzip or zstd 
+    compressed dba files, and unmerged flight and science dba files. 
+    Compressed files are streamed (decompressed) to a local temporary 
+    file, which is read and then removed. Unmerged files are merged 
+    in memory (see amlr_dba_merge), and written to a local temporary 
+    file for load_slocum_dba
+
+    Args:
+        dba_file (str or tuple): path to dba file, which may be compressed, 
+            or (flight, science) paths of an unmerged segment (see dba_segments)
+
+    Returns:
+        Tuple of dba (data) and profiles data frames, from load_slocum_dba
+    """
+    from gdm.gliders.slocum import load_slocum_dba
+    if isinstance(dba_file, tuple):
+        from amlrgliders.slocum import read_dba, write_dba, amlr_dba_merge
+        flight_file, science_file = dba_file
+        merged = amlr_dba_merge(read_dba(flight_file), read_dba(science_file))
+        flight_name = os.path.basename(flight_file)
+        if dba_is_compressed(flight_name):
+            flight_name = os.path.splitext(flight_name)[0]
+        with tempfile.TemporaryDirectory() as tmp_path:
+            tmp_file = os.path.join(tmp_path, flight_name)
+            write_dba(merged, tmp_file)
+            del merged
+            return load_slocum_dba(tmp_file)
+
+    if not dba_is_compressed(dba_file):
+        return load_slocum_dba(dba_file)
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        tmp_file = os.path.join(
+            tmp_path, os.path.basename(os.path.splitext(dba_file)[0]))
+        with dba_open(dba_file, 'rb') as f_in, open(tmp_file, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        return load_slocum_dba(tmp_file)
+
+
+def amlr_write_trajectory(gdm, deployment, mode, glider_path, write_full = True, 
+                          scratch_path = None, storage = None, catalog = None, 
+                          windows = None, start = None, end = None):
     """
     From gdm file, write trajectory two nc files, 
-    one with commonly used variables and the other with all variables
+    one with commonly used variables and the other with all variables.
+    Files are written to local staging, and then uploaded
     
     Args:
         gdm (GliderDataModel): gdm object created by amlr_gdm
         deployment (str): deployment string, eg amlr##-YYYYmmdd
         mode (str): mode string, eg delayed
         glider_path (str): path to glider folder
+        write_full (bool, optional): write the full trajectory file? 
+            Defaults to True.
+        scratch_path (str, optional): directory for local staging. 
+            Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for glider_path. 
+            Defaults to None, meaning LocalStorage.
+        catalog (AmlrCatalog, optional): deployment catalog in which 
+            to record the written files. Defaults to None.
+        windows (GdmWindows, optional): if given, the data are written 
+            one time window at a time (see amlr_write_trajectory_windows), 
+            rather than from gdm.data. Defaults to None.
+        start (Timestamp, optional): if start or end are given, gdm.data 
+            are those of the time window [start, end) (see amlr_gdm), 
+            and replace the window in the existing trajectory files 
+            (see nc_splice_window). Defaults to None.
+        end (Timestamp, optional): end of the time window. Defaults to None.
         
-    Returns: 0
+    Returns: 0, or None if any file could not be written or uploaded
     """
 
+    from amlrgliders.timeseries import amlr_sensor_defs
+
     deployment_mode = f'{deployment}-{mode}'
     nc_trajectory_path = os.path.join(glider_path, 'data', 'nc', 'trajectory')
 
-    if not os.path.exists(nc_trajectory_path):
-            logger.info(f'Creating directory at: {nc_trajectory_path}')
-            os.makedirs(nc_trajectory_path)
+    # Datasets are created from the sensor definitions if possible, 
+    #   rather than with gdm.to_timeseries_dataset
+    sensor_defs = amlr_sensor_defs(
+        os.path.join(glider_path, 'data', 'data-config'), storage)
+    if sensor_defs is None:
+        logger.warning('Creating trajectory datasets with gdm')
+
+    if windows is not None:
+        nc_names = [f'{deployment_mode}-trajectory.nc']
+        if write_full:
+            nc_names.append(f'{deployment_mode}-trajectory-full.nc')
+        try:
+            with OutputStager(nc_trajectory_path, scratch_path, storage=storage) as stager:
+                failed = amlr_write_trajectory_windows(
+                    gdm, windows, [stager.path(i) for i in nc_names], sensor_defs)
+        except Exception as e:
+            logger.error(f'Unable to write the trajectory files by time window: {e}')
+            return None
+        return amlr_trajectory_recorded(
+            deployment, mode, nc_trajectory_path, stager, catalog, len(failed) == 0)
 
     logger.info("Creating full timeseries")
-    ds = gdm.to_timeseries_dataset()
+    with step('to_timeseries_dataset') as s:
+        ds, ds_subset = amlr_trajectory_datasets(gdm, sensor_defs, write_full)
+        s.data(ds_subset if ds is None else ds)
 
     # # Note: to_timeseries_dataset uses nc_var_name in sensor_defs,
     # #   hence it changes ilatitude to lat and ilongitude to lon 
@@ -293,57 +1029,197 @@ def amlr_write_trajectory(gdm, deployment, mode, glider_path, write_full = True)
     #     'oxy4_temp', 'sci_flbbcd_therm', 'ctd41cp_timestamp', 
     #     'm_final_water_vx', 'm_final_water_vy', 'c_wpt_lat', 'c_wpt_lon']
 
-    subset = sorted(set(amlr_ds_varnames).intersection(list(ds.keys())), 
-                    key = amlr_ds_varnames.index)
     logger.debug(f"Length of vars_list: {len(amlr_ds_varnames)}")
-    logger.debug(f"Number of variables in subset: {len(subset)}")
-    ds_subset = ds[subset]
+    logger.debug(f"Number of variables in subset: {len(ds_subset.data_vars)}")
+
+    if start is not None or end is not None:
+        from amlrgliders.chunked import nc_splice_window
+        if storage is None:
+            storage = LocalStorage()
+        nc_names = {f'{deployment_mode}-trajectory.nc': ds_subset}
+        if write_full:
+            nc_names[f'{deployment_mode}-trajectory-full.nc'] = ds
+        written = True
+        with step('to_netcdf'), \
+                OutputStager(nc_trajectory_path, scratch_path, storage=storage) as stager:
+            for nc_name, ds_file in nc_names.items():
+                nc_file = os.path.join(nc_trajectory_path, nc_name)
+                if not storage.exists(nc_file):
+                    logger.error(f'{nc_file} does not exist, and thus its ' + 
+                                 'time window cannot be replaced')
+                    written = False
+                    continue
+                storage.get(nc_file, stager.path(nc_name))
+                try:
+                    nc_splice_window(stager.path(nc_name), ds_file, start, end)
+                    logger.info(f'Time window of {nc_name} replaced')
+                except:
+                    logger.error(f'Unable to replace the time window of {nc_name}')
+                    written = False
+                    # Do not upload a partially written file
+                    os.remove(stager.path(nc_name))
+        return amlr_trajectory_recorded(
+            deployment, mode, nc_trajectory_path, stager, catalog, written)
     
-    logger.info("Writing trajectory timeseries for most commonly used variables to nc file")
-    try:
-        ds_subset.to_netcdf(
-            os.path.join(nc_trajectory_path, f'{deployment_mode}-trajectory.nc'))
-        logger.info("Subset trajectory timeseries written to nc file")
-    except:
-        logger.warning("Unable to write subset trajectory timeseries to nc file")
-
-    if write_full:
-        logger.info("Writing full trajectory timeseries to nc file")
+    written = True
+    with step('to_netcdf'), \
+            OutputStager(nc_trajectory_path, scratch_path, storage=storage) as stager:
+        logger.info("Writing trajectory timeseries for most commonly used variables to nc file")
         try:
-            ds.to_netcdf(os.path.join(
-                nc_trajectory_path, f'{deployment_mode}-trajectory-full.nc'
-            ))
-            logger.info("Full trajectory timeseries written to nc file")
+            ds_subset.to_netcdf(
+                stager.path(f'{deployment_mode}-trajectory.nc'))
+            logger.info("Subset trajectory timeseries written to nc file")
         except:
-            logger.warning("Unable to write full trajectory timeseries to nc file")
-    else:
-        logger.info("Not trying to write full trajectory timeseries to nc file")
-        
+            logger.error("Unable to write subset trajectory timeseries to nc file")
+            written = False
+
+        if write_full:
+            logger.info("Writing full trajectory timeseries to nc file")
+            try:
+                ds.to_netcdf(
+                    stager.path(f'{deployment_mode}-trajectory-full.nc'))
+                logger.info("Full trajectory timeseries written to nc file")
+            except:
+                logger.error("Unable to write full trajectory timeseries to nc file")
+                written = False
+        else:
+            logger.info("Not trying to write full trajectory timeseries to nc file")
+
+    return amlr_trajectory_recorded(
+        deployment, mode, nc_trajectory_path, stager, catalog, written)
+
+
+def amlr_trajectory_recorded(deployment, mode, nc_trajectory_path, stager, 
+                             catalog = None, written = True):
+    """
+    Record the uploaded trajectory files in the catalog, and check 
+    that all trajectory files were written and uploaded
+
+    Returns: 0, or None if any file could not be written or uploaded
+    """
+    if catalog is not None:
+        catalog.record_files(
+            deployment, mode, 'trajectory', nc_trajectory_path, stager.uploaded)
+    if not written or len(stager.failed) > 0:
+        logger.error(f'Not all trajectory files were written to {nc_trajectory_path}')
+        return None
     return 0
 
 
-def amlr_write_ngdac(gdm, deployment, mode, nc_path):
+def amlr_trajectory_datasets(gdm, sensor_defs = None, write_full = True):
     """
-    From gdm object, 
+    Create the full and subset (amlr_ds_varnames) trajectory timeseries 
+    datasets. With sensor_defs, the datasets are created directly from 
+    the data, and the subset dataset only has its variables 
+    (see amlr_timeseries_dataset). Otherwise, the subset is selected from 
+    the full dataset of gdm.to_timeseries_dataset
+
+    Args:
+        gdm (GliderDataModel): gdm object
+        sensor_defs (dict, optional): sensor definitions. Defaults to None.
+        write_full (bool, optional): create the full dataset? Without 
+            sensor_defs, it is always created. Defaults to True.
+
+    Returns:
+        Tuple of the full dataset (None if not created) and the subset dataset
+    """
+    if sensor_defs is not None:
+        from amlrgliders.timeseries import amlr_timeseries_dataset
+        ds_subset = amlr_timeseries_dataset(gdm, sensor_defs, amlr_ds_varnames)
+        ds = amlr_timeseries_dataset(gdm, sensor_defs) if write_full else None
+        return ds, ds_subset
+
+    ds = gdm.to_timeseries_dataset()
+    subset = sorted(set(amlr_ds_varnames).intersection(list(ds.keys())), 
+                    key = amlr_ds_varnames.index)
+    return ds, ds[subset]
+
+
+def amlr_write_trajectory_windows(gdm, windows, nc_files, sensor_defs = None):
+    """
+    Write trajectory nc files one time window at a time: the timeseries 
+    dataset of each window is appended to the nc files along time. 
+    Data and attributes are identical to those written from the whole 
+    data by amlr_write_trajectory, but time is an unlimited dimension
+
+    Args:
+        gdm (GliderDataModel): gdm object
+        windows (GdmWindows): windows of the gdm data
+        nc_files (list): local paths of the subset trajectory file, 
+            and optionally the full trajectory file
+        sensor_defs (dict, optional): sensor definitions, 
+            see amlr_trajectory_datasets. Defaults to None.
+
+    Returns:
+        set: local paths of the nc files that could not be written
+    """
+    from amlrgliders.chunked import nc_write_window
+    failed = set()
+    for data, profiles in windows:
+        gdm.data = data
+        gdm.profiles = profiles
+        ds, ds_subset = amlr_trajectory_datasets(
+            gdm, sensor_defs, len(nc_files) > 1)
+        for nc_file, ds_file in zip(nc_files, [ds_subset, ds]):
+            if nc_file in failed:
+                continue
+            try:
+                nc_write_window(ds_file, nc_file, windows.time_units)
+            except:
+                logger.error(f"Unable to write trajectory timeseries to {os.path.basename(nc_file)}")
+                failed.add(nc_file)
+        del ds
+
+    # Do not upload partially written files
+    for nc_file in failed:
+        if os.path.exists(nc_file):
+            os.remove(nc_file)
+    logger.info(f'{len(nc_files) - len(failed)} trajectory timeseries written to nc file(s)')
+    return failed
+
+
+def amlr_write_ngdac(gdm, deployment, mode, nc_path, scratch_path = None, 
+                     storage = None, catalog = None, checkpoint = None, 
+                     windows = None):
+    """
+    From gdm object, write one NGDAC nc file per profile. 
+    Files are written to local staging, and then uploaded in parallel batches
     
     Args:
         gdm (GliderDataModel): gdm object
         deployment (str): deployment string, eg amlr##-YYYYmmdd
         mode (str): mode string, eg delayed
         nc_path (str): path to which to write the profile nc files
+        scratch_path (str, optional): directory for local staging. 
+            Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for nc_path. 
+            Defaults to None, meaning LocalStorage.
+        catalog (AmlrCatalog, optional): deployment catalog in which 
+            to record the written files. Defaults to None.
+        checkpoint (Checkpoint, optional): checkpoint in which to record 
+            written files, every checkpoint.every files. Files recorded 
+            by a previous run are not written again. Defaults to None.
+        windows (GdmWindows, optional): if given, profiles are written 
+            one time window at a time, rather than from gdm.data. 
+            Window boundaries do not split profiles. Defaults to None.
 
-    Returns: 0
+    Returns: 0, or None if any file could not be uploaded
     """
     
     # nc_ngdac_path = os.path.join(glider_path, 'data', 'out', 'nc', 'ngdac', mode)
+    # Directory is created by OutputStager, if necessary
     logger.debug(f'NGDAC nc path: {nc_path}')
-    if not os.path.exists(nc_path):
-        logger.info(f'Creating directory at: {nc_path}')
-        os.makedirs(nc_path)
 
-    subset = sorted(set(amlr_gdm_varnames).intersection(list(gdm.data.columns)), 
-                        key = amlr_gdm_varnames.index)
-    gdm.data = gdm.data[subset]
+    def subset_data(data):
+        subset = sorted(set(amlr_gdm_varnames).intersection(list(data.columns)), 
+                            key = amlr_gdm_varnames.index)
+        return data[subset]
+
+    if windows is None:
+        gdm.data = subset_data(gdm.data)
+        n_profiles = len(gdm.profiles.index)
+    else:
+        n_profiles = len(windows.profiles.index)
     
     # TODO: make parallel?
     # if numcores > 1:
@@ -364,14 +1240,247 @@ def amlr_write_ngdac(gdm, deployment, mode, nc_path):
 
     # else:
     # NOTE: requires local gdm install with altered iter_profiles
-    logger.info(f"Writing {len(gdm.profiles.index)} ngdac nc files, serially")
-    for profile_time, row, pro_ds in gdm.iter_profiles():
-        logger.debug(f"profile time: {profile_time}")
-        pro_ds['profile_direction'] = row.direction
-
-        nc_name = f"{deployment}_{profile_time.strftime('%Y%m%dT%H%M%S')}_{mode}.nc"
-        nc_file = os.path.join(nc_path, nc_name)
-        logger.info('Writing {:}'.format(nc_file))
-        pro_ds.to_netcdf(nc_file)
+    nc_done = set(checkpoint.items('ngdac')) if checkpoint is not None else set()
+    if len(nc_done) > 0:
+        logger.info(f'{len(nc_done)} ngdac nc files were written by a previous run')
+    logger.info(f"Writing {n_profiles} ngdac nc files, serially")
+    nc_failed = []
+    with OutputStager(nc_path, scratch_path, storage=storage) as stager:
+        nc_staged = []
+        for data, profiles in (windows if windows is not None else [(None, None)]):
+            if data is not None:
+                gdm.data = subset_data(data)
+                gdm.profiles = profiles
+            for profile_time, row, pro_ds in gdm.iter_profiles():
+                logger.debug(f"profile time: {profile_time}")
+                nc_name = f"{deployment}_{profile_time.strftime('%Y%m%dT%H%M%S')}_{mode}.nc"
+                if nc_name in nc_done:
+                    continue
+
+                pro_ds['profile_direction'] = row.direction
+                logger.info('Writing {:}'.format(nc_name))
+                try:
+                    pro_ds.to_netcdf(stager.path(nc_name))
+                except:
+                    logger.error(f'Unable to write {nc_name}')
+                    nc_failed.append(nc_name)
+                    # Do not upload a partially written file
+                    if os.path.exists(stager.path(nc_name)):
+                        os.remove(stager.path(nc_name))
+                    continue
+                nc_staged.append(nc_name)
+
+                # Upload the files written so far, and record them
+                if checkpoint is not None and len(nc_staged) >= checkpoint.every:
+                    stager.upload()
+                    checkpoint.add_items(
+                        'ngdac', [i for i in nc_staged if i not in stager.files])
+                    nc_staged = [i for i in nc_staged if i in stager.files]
+
+        if checkpoint is not None:
+            stager.upload()
+            checkpoint.add_items(
+                'ngdac', [i for i in nc_staged if i not in stager.files])
+
+    if catalog is not None:
+        catalog.record_files(deployment, mode, 'ngdac', nc_path, stager.uploaded)
+    metric_set('profiles_written', len(stager.uploaded))
+    if len(nc_failed) > 0 or len(stager.failed) > 0:
+        logger.error(f'{len(nc_failed)} ngdac nc files could not be written, ' + 
+                     f'and {len(stager.failed)} could not be uploaded')
+        return None
             
     return 0
+
+
+def profile_rows(times, profiles):
+    """
+    Get the rows of the data in each profile, from its start_time to its 
+    end_time (inclusive, as in gdm.iter_profiles), in profile order
+
+    Args:
+        times (DatetimeIndex): sorted time index of the data
+        profiles (DataFrame): gdm profiles, with start_time and end_time
+
+    Returns:
+        Tuple of the row numbers of the data of all profiles, 
+        concatenated, and the number of rows of each profile
+    """
+    i_start = times.searchsorted(pd.DatetimeIndex(profiles['start_time']), 'left')
+    i_end = times.searchsorted(pd.DatetimeIndex(profiles['end_time']), 'right')
+    # Profiles without start or end times have no rows
+    valid = (profiles['start_time'].notna() & profiles['end_time'].notna()).values
+    row_size = np.where(valid, np.maximum(i_end - i_start, 0), 0)
+    offsets = np.cumsum(row_size) - row_size
+    rows = np.arange(row_size.sum()) - np.repeat(offsets - i_start, row_size)
+    return rows, row_size
+
+
+def amlr_profiles_dataset(gdm, data, profiles, profile_id_start=1, 
+                          sensor_defs=None):
+    """
+    Create the CF DSG contiguous ragged array dataset of profiles: 
+    the data of all profiles, concatenated along the obs dimension, 
+    and per profile (profile dimension) its id, time, mean interpolated 
+    position (as in the NGDAC files), direction, and rowSize, 
+    ie its number of obs
+
+    Args:
+        gdm (GliderDataModel): gdm object, for the variable attributes
+        data (DataFrame): gdm data, eg subset to amlr_gdm_varnames
+        profiles (DataFrame): gdm profiles, with start_time and end_time
+        profile_id_start (int, optional): profile_id of the first profile. 
+            Defaults to 1.
+        sensor_defs (dict, optional): sensor definitions. If given, the 
+            variables are created directly from the data 
+            (see amlr_timeseries_dataset), rather than with 
+            gdm.to_timeseries_dataset. Defaults to None.
+
+    Returns:
+        Dataset: ragged array dataset
+    """
+    rows, row_size = profile_rows(data.index, profiles)
+
+    # Variables, with attributes, of the data in any profile. 
+    #   Adjacent profiles may share rows, so the dataset is created from 
+    #   each row once, and then repeated
+    rows_unique, rows_obs = np.unique(rows, return_inverse=True)
+    data_profiles = data.iloc[rows_unique]
+    if sensor_defs is not None:
+        from amlrgliders.timeseries import amlr_timeseries_dataset
+        ds = amlr_timeseries_dataset(gdm, sensor_defs, data=data_profiles)
+    else:
+        gdm = copy.copy(gdm)
+        gdm.data = data_profiles
+        ds = gdm.to_timeseries_dataset()
+    ds = ds.isel(time=rows_obs)
+    ds = ds.swap_dims({'time': 'obs'}).reset_coords('time')
+
+    profile_number = np.repeat(np.arange(len(row_size)), row_size)
+    profile_vars = {
+        'profile_id': np.arange(len(row_size), dtype='int32') + profile_id_start, 
+        'profile_time': profiles.index.values, 
+    }
+    for i, j in [('profile_lat', 'ilatitude'), ('profile_lon', 'ilongitude')]:
+        if j in data.columns:
+            profile_vars[i] = pd.Series(data[j].values[rows]).groupby(profile_number) \
+                .mean().reindex(np.arange(len(row_size))).values
+    if 'direction' in profiles.columns:
+        profile_vars['profile_direction'] = profiles['direction'].values
+    profile_vars['rowSize'] = row_size.astype('int32')
+    for i, values in profile_vars.items():
+        ds[i] = ('profile', values)
+
+    ds['profile_id'].attrs.update(cf_role='profile_id', long_name='Profile ID')
+    ds['profile_time'].attrs.update(
+        standard_name='time', long_name='Profile time')
+    if 'profile_lat' in ds:
+        ds['profile_lat'].attrs.update(
+            standard_name='latitude', units='degrees_north', 
+            long_name='Profile mean latitude')
+    if 'profile_lon' in ds:
+        ds['profile_lon'].attrs.update(
+            standard_name='longitude', units='degrees_east', 
+            long_name='Profile mean longitude')
+    if 'profile_direction' in ds:
+        ds['profile_direction'].attrs.update(
+            long_name='Profile direction', comment='-1 = up, 1 = down')
+    ds['rowSize'].attrs.update(
+        long_name='Number of observations in the profile', sample_dimension='obs')
+
+    # The obs variables are located by their profile, and by depth
+    coordinates = ' '.join(
+        i for i in ['profile_time', 'profile_lat', 'profile_lon', 'depth'] if i in ds)
+    for i in ds.data_vars:
+        if 'obs' in ds[i].dims and i != 'depth':
+            ds[i].attrs['coordinates'] = coordinates
+    ds.attrs['featureType'] = 'profile'
+    return ds
+
+
+def amlr_write_profiles_ragged(gdm, deployment, mode, nc_path, scratch_path = None, 
+                               storage = None, catalog = None, windows = None, 
+                               sensor_defs = None):
+    """
+    From gdm object, write all profiles to one CF DSG contiguous ragged array 
+    nc file (see amlr_profiles_dataset), eg for opening all profiles 
+    at once, rather than one NGDAC file per profile. 
+    The file is written to local staging, and then uploaded
+
+    Args:
+        gdm (GliderDataModel): gdm object
+        deployment (str): deployment string, eg amlr##-YYYYmmdd
+        mode (str): mode string, eg delayed
+        nc_path (str): path to which to write the nc file
+        scratch_path (str, optional): directory for local staging. 
+            Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for nc_path. 
+            Defaults to None, meaning LocalStorage.
+        catalog (AmlrCatalog, optional): deployment catalog in which 
+            to record the written file. Defaults to None.
+        windows (GdmWindows, optional): if given, the profiles of each 
+            time window are appended to the file, rather than written 
+            from gdm.data. Window boundaries do not split profiles. 
+            Defaults to None.
+        sensor_defs (dict, optional): sensor definitions, 
+            see amlr_profiles_dataset. Defaults to None.
+
+    Returns: 0, or None if the file could not be written or uploaded
+    """
+    from amlrgliders.chunked import nc_append
+
+    deployment_mode = f'{deployment}-{mode}'
+    nc_name = f'{deployment_mode}-profiles.nc'
+
+    def subset_data(data):
+        subset = sorted(set(amlr_gdm_varnames).intersection(list(data.columns)), 
+                        key = amlr_gdm_varnames.index)
+        return data[subset]
+
+    profiles = gdm.profiles if windows is None else windows.profiles
+    if not {'start_time', 'end_time'}.issubset(profiles.columns):
+        logger.error('The gdm profiles do not have start_time and end_time, ' + 
+                     'and thus the ragged array profile file cannot be written')
+        return None
+
+    logger.info(f'Writing {len(profiles.index)} profiles to {nc_name}')
+    with OutputStager(nc_path, scratch_path, storage=storage) as stager:
+        nc_file = stager.path(nc_name)
+        written = True
+        try:
+            if windows is None:
+                ds = amlr_profiles_dataset(
+                    gdm, subset_data(gdm.data), gdm.profiles, sensor_defs=sensor_defs)
+                ds.to_netcdf(nc_file)
+            else:
+                n_profiles = 0
+                for data, window_profiles in windows:
+                    ds = amlr_profiles_dataset(
+                        gdm, subset_data(data), window_profiles, n_profiles + 1, 
+                        sensor_defs)
+                    if n_profiles == 0:
+                        for i in ['time', 'profile_time']:
+                            ds[i].encoding['units'] = windows.time_units
+                        ds.to_netcdf(nc_file, unlimited_dims=['profile', 'obs'])
+                    else:
+                        nc_append(nc_file, ds, 'obs')
+                        nc_append(nc_file, ds, 'profile')
+                    n_profiles += ds.sizes['profile']
+                    del ds
+        except:
+            logger.error(f'Unable to write {nc_name}')
+            written = False
+            # Do not upload a partially written file
+            if os.path.exists(nc_file):
+                os.remove(nc_file)
+
+    if catalog is not None:
+        catalog.record_files(deployment, mode, 'ragged', nc_path, stager.uploaded)
+    if not written:
+        return None
+    if len(stager.failed) > 0:
+        logger.error(f'{nc_name} could not be uploaded')
+        return None
+    logger.info(f'Ragged array profile file written for {deployment_mode}')
+
+    return 0
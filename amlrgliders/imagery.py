@@ -1,9 +1,12 @@
 import os
 import logging
 import datetime as dt
-import glob
+import numpy as np
 import pandas as pd
 
+from amlrgliders.staging import OutputStager
+from amlrgliders.storage import LocalStorage
+
 logger = logging.getLogger(__name__)
 
 
@@ -19,8 +22,39 @@ def solocam_filename_dt(filename, index_start):
 
 
 
+def imagery_match(imagery_df, data, vars_list):
+    """
+    Find the nearest glider data for each imagery datetime
+
+    Args:
+        imagery_df (DataFrame): imagery files, with datetimes in img_dt
+        data (DataFrame): gdm data, indexed by time
+        vars_list (list): columns of data to add to imagery_df
+
+    Returns:
+        DataFrame: imagery_df, with glider_dt, diff_dt_seconds, 
+        and vars_list columns
+    """
+    ds = data.to_xarray()
+    # ds_nona = ds.sel(time = ds.depth.dropna('time').time.values)
+    # TODO: check if any time values are NA
+    ds_slice = ds.sel(time=imagery_df.img_dt.values, method = 'nearest')
+
+    imagery_df = imagery_df.copy()
+    imagery_df['glider_dt'] = ds_slice.time.values
+    diff_dts = (imagery_df.img_dt - imagery_df.glider_dt).astype('timedelta64[s]')
+    imagery_df['diff_dt_seconds'] = diff_dts.dt.total_seconds()
+    for i in vars_list:
+        imagery_df[i] = ds_slice[i].values
+
+    return imagery_df
+
+
 def amlr_imagery_metadata(gdm, deployment, glider_path, imagery_path, 
-                          ext = 'jpg'):
+                          ext = 'jpg', scratch_path = None, 
+                          storage = None, imagery_storage = None, 
+                          catalog = None, windows = None, 
+                          start = None, end = None):
     """
     Matches up imagery files with data from gdm object by imagery filename
     Uses interpolated variables (hardcoded in function)
@@ -33,9 +67,31 @@ def amlr_imagery_metadata(gdm, deployment, glider_path, imagery_path,
         imagery_path (str): path to folder with images, 
             specifically the 'Dir####' folders
         ext (str, optional): Imagery file extension. Defaults to 'jpg'.
+        scratch_path (str, optional): directory for local staging 
+            of the metadata file. Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for glider_path. 
+            Defaults to None, meaning LocalStorage.
+        imagery_storage (Storage, optional): storage backend for 
+            imagery_path. Defaults to None, meaning LocalStorage.
+        catalog (AmlrCatalog, optional): deployment catalog. If given, 
+            imagery files are taken from the catalog rather than listed 
+            (they are listed and recorded the first time), 
+            and the metadata file is recorded. Defaults to None.
+        windows (GdmWindows, optional): if given, imagery files are 
+            matched with the data one time window at a time, 
+            rather than with gdm.data. Defaults to None.
+        start (Timestamp, optional): if start or end are given, gdm.data 
+            are those of the time window [start, end) (see amlr_gdm), 
+            and only the images in the window are matched, and replace 
+            those of the window in the existing metadata file. Images are 
+            matched with gdm.data_overlap, if present, so that the nearest 
+            data may be outside of the window. Defaults to None.
+        end (Timestamp, optional): end of the time window. Defaults to None.
 
     Returns:
-        DataFrame: DataFrame of imagery metadata
+        DataFrame: DataFrame of imagery metadata; if start or end are 
+        given, of the images in the time window. 
+        None if the metadata file could not be written or uploaded
     """
     
     logger.info(f'Creating imagery metadata file for {deployment}')
@@ -47,19 +103,39 @@ def amlr_imagery_metadata(gdm, deployment, glider_path, imagery_path,
     roll_column = 'imroll'
 
 
+    if storage is None:
+        storage = LocalStorage()
+    if imagery_storage is None:
+        imagery_storage = LocalStorage()
+
+
     #--------------------------------------------
     # Checks
     out_path = os.path.join(glider_path, 'data', 'out', 'cameras')
-    if not os.path.exists(out_path):
+    if not storage.exists(out_path):
         logger.info(f'Creating directory at: {out_path}')
-        os.makedirs(out_path)
+        storage.makedirs(out_path)
+
+    imagery_filepaths = None
+    if catalog is not None:
+        imagery_filepaths = catalog.files(deployment, '', 'imagery')
 
-    if not os.path.isdir(imagery_path):
+    if imagery_filepaths is None and not imagery_storage.isdir(imagery_path):
         logger.error(f'imagery_path ({imagery_path}) does not exist, and thus the ' + 
                         'CSV file with imagery metadata will not be created')
         return
     else:
-        imagery_filepaths = glob.glob(f'{imagery_path}/**/*.{ext}', recursive=True)
+        if imagery_filepaths is None:
+            if catalog is not None:
+                # Checksums of (many) image files are not needed
+                imagery_filepaths = catalog.scan_files(
+                    deployment, '', 'imagery', imagery_path, imagery_storage, 
+                    recursive=True, checksum=False)
+            else:
+                imagery_filepaths = imagery_storage.walk_files(imagery_path)
+        imagery_filepaths = [
+            i for i in imagery_filepaths if i.endswith(f'.{ext}')
+        ]
         imagery_files = [os.path.basename(x) for x in imagery_filepaths]
         imagery_files.sort()
 
@@ -71,13 +147,11 @@ def amlr_imagery_metadata(gdm, deployment, glider_path, imagery_path,
         depth_column, pitch_column, roll_column]
     imagery_vars_set = set(imagery_vars_list)
 
-    if not imagery_vars_set.issubset(gdm.data.columns):
+    data_columns = gdm.data.columns if windows is None else windows.columns
+    if not imagery_vars_set.issubset(data_columns):
         logger.error('gdm object does not contain all required columns. ' + 
-            f"Missing columns: {', '.join(imagery_vars_set.difference(gdm.data.columns))}")
-        return()
-
-    gdm.data = gdm.data[imagery_vars_list]
-    ds = gdm.data.to_xarray()
+            f"Missing columns: {', '.join(imagery_vars_set.difference(data_columns))}")
+        return None
 
 
     #--------------------------------------------
@@ -95,7 +169,7 @@ def amlr_imagery_metadata(gdm, deployment, glider_path, imagery_path,
     if space_index == -1:
         logger.error('The imagery file name year index could not be found, ' + 
             'and thus the imagery metadata file cannot be generated')
-        return()
+        return None
     yr_index = space_index + 1   
 
     try:
@@ -110,27 +184,74 @@ def amlr_imagery_metadata(gdm, deployment, glider_path, imagery_path,
     imagery_dict = {'img_file': imagery_files, 'img_dt': imagery_file_dts}
     imagery_df = pd.DataFrame(data = imagery_dict).sort_values('img_dt')
 
+    csv_name = f'{deployment}-imagery-metadata.csv'
+    time_range = start is not None or end is not None
+    if time_range:
+        if not imagery_storage.exists(os.path.join(imagery_path, csv_name)):
+            logger.error(f'{os.path.join(imagery_path, csv_name)} does not exist, ' + 
+                         'and thus its time window cannot be replaced')
+            return
+        in_window = np.ones(len(imagery_df.index), dtype=bool)
+        if start is not None:
+            in_window &= imagery_df.img_dt >= start
+        if end is not None:
+            in_window &= imagery_df.img_dt < end
+        imagery_df = imagery_df[in_window]
+        logger.info(f'{len(imagery_df.index)} images are in the time window')
+
     logger.info("Finding nearest glider data slice for each imagery datetime")
-    # ds_nona = ds.sel(time = ds.depth.dropna('time').time.values)
-    # TODO: check if any time values are NA
-    ds_slice = ds.sel(time=imagery_df.img_dt.values, method = 'nearest')
+    if windows is None:
+        # The data of a time window are matched with their overlap
+        data = getattr(gdm, 'data_overlap', gdm.data) if time_range else gdm.data
+        imagery_df = imagery_match(imagery_df, data[imagery_vars_list], imagery_vars_list)
+    else:
+        # Match the images in each window, using the window data read 
+        #   with its overlap, so that the nearest data may be in 
+        #   the adjacent window
+        imagery_windows = []
+        for start, end in windows.windows():
+            in_window = np.ones(len(imagery_df.index), dtype=bool)
+            if start is not None:
+                in_window &= imagery_df.img_dt >= start
+            if end is not None:
+                in_window &= imagery_df.img_dt < end
+            if not in_window.any():
+                continue
+            data = windows.read(start, end, overlap=True)[imagery_vars_list]
+            imagery_windows.append(
+                imagery_match(imagery_df[in_window], data, imagery_vars_list))
+            del data
+        imagery_df = pd.concat(imagery_windows)
 
-    imagery_df['glider_dt'] = ds_slice.time.values
-    diff_dts = (imagery_df.img_dt - imagery_df.glider_dt).astype('timedelta64[s]')
-    imagery_df['diff_dt_seconds'] = diff_dts.dt.total_seconds()
-    
-    imagery_df['latitude'] = ds_slice[lat_column].values
-    imagery_df['longitude'] = ds_slice[lon_column].values
-    imagery_df['depth'] = ds_slice[depth_column].values
-    imagery_df['pitch'] = ds_slice[pitch_column].values
-    imagery_df['roll'] = ds_slice[roll_column].values
+    imagery_df = imagery_df.rename(columns={
+        lat_column: 'latitude', lon_column: 'longitude', depth_column: 'depth', 
+        pitch_column: 'pitch', roll_column: 'roll'
+    })
 
     # csv_file = os.path.join(out_path, f'{deployment}-imagery-metadata.csv')
     # logger.info(f'Writing imagery metadata to: {csv_file}')
     # imagery_df.to_csv(csv_file, index=False)
     
-    csv_file = os.path.join(imagery_path, f'{deployment}-imagery-metadata.csv')
-    logger.info(f'Writing imagery metadata to: {csv_file}')
-    imagery_df.to_csv(csv_file, index=False)
+    logger.info(f'Writing imagery metadata to: {os.path.join(imagery_path, csv_name)}')
+    try:
+        with OutputStager(imagery_path, scratch_path, storage=imagery_storage) as stager:
+            if time_range:
+                from amlrgliders.chunked import csv_splice_window
+                imagery_storage.get(os.path.join(imagery_path, csv_name), stager.path(csv_name))
+                csv_splice_window(
+                    stager.path(csv_name), imagery_df, start, end, 
+                    lambda df: pd.to_datetime(df.img_dt), index=False)
+            else:
+                imagery_df.to_csv(stager.path(csv_name), index=False)
+    except Exception as e:
+        logger.error(f'Unable to write {csv_name}: {e}')
+        return None
+
+    if catalog is not None:
+        catalog.record_files(
+            deployment, '', 'imagery-metadata', imagery_path, stager.uploaded)
+    if len(stager.failed) > 0:
+        logger.error(f'{csv_name} could not be uploaded')
+        return None
 
     return imagery_df
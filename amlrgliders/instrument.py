@@ -0,0 +1,256 @@
+"""
+Instrumentation of processing stages and their steps, for a run report.
+
+A RunReport records the steps run while it is active: wall time,
+CPU time, memory, and (if set) the rows and bytes of the step's data.
+Steps are recorded with step(), which does nothing if no report is active,
+so that functions (eg amlr_load_dba) can be instrumented without
+passing a report to them:
+
+    with RunReport(deployment, mode, out_path, storage=storage) as report:
+        with step('gdm') as s:
+            gdm = amlr_gdm(...)
+            s.data(gdm.data)
+
+Steps within steps are recorded with their path, eg gdm/load_dba/parse.
+CPU time includes child processes only once they have exited,
+eg after a pool is closed, and so excludes the CPU time of long-lived
+pool workers
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import platform
+import resource
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from amlrgliders.staging import OutputStager
+
+logger = logging.getLogger(__name__)
+
+
+# The active report of the current thread (or task)
+_current_report = contextvars.ContextVar('amlr_run_report', default=None)
+
+
+def current_rss():
+    """
+    Get the current resident memory of this process in bytes,
+    or None if it is not available (ie not on Linux)
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss():
+    """
+    Get the peak resident memory of this process in bytes
+    """
+    # ru_maxrss is in bytes on macOS, and kilobytes elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def cpu_times():
+    """
+    Get the (self, children) CPU time of this process, in seconds
+    """
+    return tuple(
+        i.ru_utime + i.ru_stime for i in
+        [resource.getrusage(resource.RUSAGE_SELF),
+         resource.getrusage(resource.RUSAGE_CHILDREN)])
+
+
+class Step:
+    """
+    A step being recorded. Set the size of the step's data
+    with data(), or rows and bytes directly
+    """
+
+    def __init__(self, name, path, depth):
+        self.name = name
+        self.path = path
+        self.depth = depth
+        self.rows = None
+        self.bytes = None
+
+    def data(self, data):
+        """
+        Set rows and bytes from data: a DataFrame or xarray Dataset
+        """
+        if data is None:
+            return
+        if hasattr(data, 'memory_usage'):
+            self.rows = len(data.index)
+            self.bytes = int(data.memory_usage(index=True).sum())
+        elif hasattr(data, 'nbytes'):
+            self.rows = int(data.sizes.get('time', 0)) if hasattr(data, 'sizes') else None
+            self.bytes = int(data.nbytes)
+
+
+class RunReport:
+    """
+    Report of the steps of one run, eg of amlr-process for one deployment.
+    Use as a context manager, which makes it the active report.
+    On exit, the report is written to out_path, if given and if any 
+    steps were recorded (see write)
+
+    Args:
+        deployment (str): deployment name
+        mode (str): deployment mode
+        out_path (str, optional): directory to which to write the report 
+            on exit. Defaults to None, meaning it is not written.
+        scratch_path (str, optional): directory for local staging. 
+            Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for out_path. 
+            Defaults to None, meaning LocalStorage.
+        **info: additional run information to include in the report,
+            eg numcores
+    """
+
+    def __init__(self, deployment, mode, out_path=None, scratch_path=None, 
+                 storage=None, **info):
+        self.out_path = out_path
+        self.scratch_path = scratch_path
+        self.storage = storage
+        self.info = {
+            'deployment': deployment,
+            'mode': mode,
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+            'argv': sys.argv,
+            **info,
+        }
+        self.steps = []
+        self._stack = []
+        self._token = None
+
+    def __enter__(self):
+        self.info['started'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        self._t_start = time.perf_counter()
+        self._cpu_start = cpu_times()
+        self._token = _current_report.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_report.reset(self._token)
+        cpu_end = cpu_times()
+        self.info['seconds'] = time.perf_counter() - self._t_start
+        self.info['cpu_seconds'] = cpu_end[0] - self._cpu_start[0]
+        self.info['cpu_seconds_children'] = cpu_end[1] - self._cpu_start[1]
+        self.info['max_rss_bytes'] = max_rss()
+        logger.info(f'Run report steps:\n{self.summary()}')
+        # Runs that stopped before any step (eg failed checks) are not reported
+        if self.out_path is not None and len(self.steps) > 0:
+            # A report that cannot be written does not fail the run
+            try:
+                self.write(self.out_path, scratch_path=self.scratch_path, 
+                           storage=self.storage)
+            except Exception as e:
+                logger.error(f'Unable to write the run report: {e}')
+
+    @contextmanager
+    def step(self, name):
+        """
+        Record a step; see step()
+        """
+        path = '/'.join([i.name for i in self._stack] + [name])
+        s = Step(name, path, len(self._stack))
+        self._stack.append(s)
+        # Steps are listed in the order in which they started
+        record = {'name': name, 'path': path, 'depth': s.depth}
+        self.steps.append(record)
+        t_start = time.perf_counter()
+        cpu_start = cpu_times()
+        rss_start = current_rss()
+        status = 'failed'
+        try:
+            yield s
+            status = 'complete'
+        finally:
+            self._stack.pop()
+            cpu_end = cpu_times()
+            rss_end = current_rss()
+            record.update({
+                'status': status,
+                'seconds': time.perf_counter() - t_start,
+                'cpu_seconds': cpu_end[0] - cpu_start[0],
+                'cpu_seconds_children': cpu_end[1] - cpu_start[1],
+                'rss_bytes': rss_end,
+                'rss_change_bytes': rss_end - rss_start if rss_end is not None else None,
+                # The peak of the process so far, ie during or before the step
+                'max_rss_bytes': max_rss(),
+                'rows': s.rows,
+                'bytes': s.bytes,
+            })
+
+    def to_dict(self):
+        """
+        Get the report as a dict, with steps in the order in which they started
+        """
+        return {**self.info, 'steps': self.steps}
+
+    def summary(self):
+        """
+        Get a table of the steps, as a string
+        """
+        lines = [f"{'step':<40}{'seconds':>10}{'cpu':>10}{'max rss MB':>12}{'rows':>12}"]
+        for i in self.steps:
+            if 'seconds' not in i:
+                continue
+            rows = '' if i['rows'] is None else i['rows']
+            lines.append(
+                f"{'  ' * i['depth'] + i['name']:<40}{i['seconds']:>10.2f}" +
+                f"{i['cpu_seconds']:>10.2f}{i['max_rss_bytes'] / 1e6:>12.0f}{rows:>12}")
+        return '\n'.join(lines)
+
+    def write(self, out_path, file_name=None, scratch_path=None, storage=None):
+        """
+        Write the report as a json file to out_path
+
+        Args:
+            out_path (str): directory to which to write the report
+            file_name (str, optional): name of the report file.
+                Defaults to None, meaning deployment-mode-run-report.json
+            scratch_path (str, optional): directory for local staging.
+                Defaults to None, meaning $TMPDIR.
+            storage (Storage, optional): storage backend for out_path.
+                Defaults to None, meaning LocalStorage.
+
+        Returns:
+            str: path of the report file
+        """
+        if file_name is None:
+            file_name = f"{self.info['deployment']}-{self.info['mode']}-run-report.json"
+        logger.info(f'Writing run report to {os.path.join(out_path, file_name)}')
+        with OutputStager(out_path, scratch_path, storage=storage) as stager:
+            with open(stager.path(file_name), 'w') as f:
+                json.dump(self.to_dict(), f, indent=2)
+        return os.path.join(out_path, file_name)
+
+
+@contextmanager
+def step(name):
+    """
+    Record a step in the active run report, if there is one.
+    Yields a Step, whose data() sets the rows and bytes of the step
+
+        with step('sort') as s:
+            df = df.sort_index()
+            s.data(df)
+    """
+    report = _current_report.get()
+    if report is None:
+        yield Step(name, name, 0)
+    else:
+        with report.step(name) as s:
+            yield s
@@ -0,0 +1,234 @@
+"""
+Metrics of pipeline runs, for monitoring the (cron-driven) real-time
+pipeline: scrape, then conversion to dba files, then nc files.
+
+Metrics are recorded while an AmlrMetrics is active, with metric_inc and
+metric_set, which do nothing if there is none; this lets functions such as
+rt_files_mgmt and amlr_gdm record metrics without being passed a recorder.
+On exit, the metrics of the run are written to metrics_path:
+    amlr-metrics.jsonl: one json line per run, appended
+    amlr_<job>_<deployment>_<mode>.prom: the metrics of the latest run,
+        for the node_exporter textfile collector
+
+    with AmlrMetrics(metrics_path, 'dba_to_nc', deployment, mode):
+        ...
+        metric_set('success', 1)
+
+Scripts add the --metrics_path argument with metrics_options,
+and get their AmlrMetrics (or a null context) with script_metrics
+"""
+
+import os
+import json
+import time
+import socket
+import logging
+import contextvars
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+
+metrics_jsonl_name = 'amlr-metrics.jsonl'
+
+# Metric descriptions, for the Prometheus HELP lines.
+#   Metrics are gauges of the latest run of each job
+amlr_metrics_help = {
+    'success': 'Did the run complete successfully (1) or not (0)',
+    'run_timestamp_seconds': 'Unix time at which the run started',
+    'run_duration_seconds': 'Duration of the run',
+    'files_scraped': 'Files rsynced from the SFMC',
+    'files_uploaded': 'Files uploaded to the bucket, by kind',
+    'bytes_uploaded': 'Bytes uploaded to the bucket, by kind',
+    'segments_arrived': 'New flight and science segment files uploaded to the bucket',
+    'segment_arrival_timestamp_seconds': 'Unix time at which the newest segments were uploaded',
+    'segments_converted': 'New dba files written by processDbds',
+    'segments_pending': 'Binary segments without a dba file, ie the conversion backlog',
+    'dba_files': 'dba files of the deployment',
+    'rows_parsed': 'Rows of data read from dba files',
+    'profiles': 'Profiles of the deployment',
+    'profiles_written': 'NGDAC profile nc files written',
+    'ngdac_latency_seconds': 'Seconds from the arrival of the newest segments ' +
+        'to the writing of NGDAC files',
+}
+
+
+# The active metrics recorder of the current thread (or task)
+_current_metrics = contextvars.ContextVar('amlr_metrics', default=None)
+
+
+def metric_inc(name, value=1, **labels):
+    """
+    Increment a metric of the active AmlrMetrics, if there is one
+    """
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.inc(name, value, **labels)
+
+
+def metric_set(name, value, **labels):
+    """
+    Set a metric of the active AmlrMetrics, if there is one
+    """
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.set(name, value, **labels)
+
+
+def last_metric(metrics_path, job, deployment, mode, name):
+    """
+    Get the value of metric name from the latest run of job for deployment
+    and mode that recorded it, from the json lines file in metrics_path
+
+    Returns:
+        float: metric value, or None if no run recorded it
+    """
+    jsonl_file = os.path.join(metrics_path, metrics_jsonl_name)
+    if not os.path.isfile(jsonl_file):
+        return None
+    value = None
+    with open(jsonl_file, 'r') as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if (run.get('job'), run.get('deployment'), run.get('mode')) != \
+                    (job, deployment, mode):
+                continue
+            for i in run.get('metrics', []):
+                if i['name'] == name and not i['labels']:
+                    value = i['value']
+    return value
+
+
+def metric_ngdac_latency(metrics_path, deployment, mode):
+    """
+    Set the ngdac_latency_seconds metric of the active AmlrMetrics: 
+    the seconds since the arrival of the newest segments of deployment, 
+    as recorded in metrics_path by amlr_scrape_sfmc.py. 
+    Not set if no segment arrival was recorded
+    """
+    arrival = last_metric(metrics_path, 'scrape_sfmc', deployment, mode,
+                          'segment_arrival_timestamp_seconds')
+    if arrival is not None:
+        metric_set('ngdac_latency_seconds', time.time() - arrival)
+
+
+class AmlrMetrics:
+    """
+    Metrics of one run of a pipeline job, for one deployment and mode.
+    Use as a context manager, which makes it the active recorder;
+    on exit, the metrics are written to metrics_path (see the module docstring)
+
+    Args:
+        metrics_path (str): local directory to which to write metrics,
+            eg the node_exporter textfile collector directory
+        job (str): pipeline job, eg 'scrape_sfmc'
+        deployment (str): deployment name
+        mode (str, optional): deployment mode. Defaults to ''.
+    """
+
+    def __init__(self, metrics_path, job, deployment, mode=''):
+        self.metrics_path = metrics_path
+        self.job = job
+        self.deployment = deployment
+        self.mode = mode
+        self.values = {}
+        self._token = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def __enter__(self):
+        self._t_start = time.time()
+        self.set('run_timestamp_seconds', self._t_start)
+        self.set('success', 0)
+        self._token = _current_metrics.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_metrics.reset(self._token)
+        self.set('run_duration_seconds', time.time() - self._t_start)
+        # Metrics must not fail the run
+        try:
+            self.write()
+        except Exception as e:
+            logger.error(f'Unable to write metrics to {self.metrics_path}: {e}')
+
+    def _labels(self, labels):
+        labels = [('job', self.job), ('deployment', self.deployment),
+                  ('mode', self.mode)] + list(labels)
+        return ','.join(f'{i}="{j}"' for i, j in labels)
+
+    def write(self):
+        """
+        Append the metrics to the json lines file, and write the
+        Prometheus textfile, in metrics_path
+        """
+        os.makedirs(self.metrics_path, exist_ok=True)
+        metrics = [
+            {'name': name, 'labels': dict(labels), 'value': value}
+            for (name, labels), value in sorted(self.values.items())
+        ]
+        logger.info(f'Writing {len(metrics)} metrics to {self.metrics_path}')
+
+        run = {
+            'job': self.job, 'deployment': self.deployment, 'mode': self.mode,
+            'host': socket.gethostname(), 'metrics': metrics
+        }
+        with open(os.path.join(self.metrics_path, metrics_jsonl_name), 'a') as f:
+            f.write(json.dumps(run) + '\n')
+
+        lines = []
+        for name in sorted(set(i['name'] for i in metrics)):
+            lines.append(f'# HELP amlr_{name} {amlr_metrics_help.get(name, name)}')
+            lines.append(f'# TYPE amlr_{name} gauge')
+            for (i, labels), value in sorted(self.values.items()):
+                if i == name:
+                    lines.append(f'amlr_{name}{{{self._labels(labels)}}} {value}')
+
+        # Written atomically, so that the collector never reads a partial file
+        prom_name = '_'.join(
+            i for i in ['amlr', self.job, self.deployment, self.mode] if i != '')
+        prom_file = os.path.join(self.metrics_path, f'{prom_name}.prom')
+        with open(f'{prom_file}.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f'{prom_file}.tmp', prom_file)
+
+
+def metrics_options(arg_parser):
+    """
+    Add the metrics (--metrics_path) argument to a script's arg_parser
+
+    Returns:
+        ArgumentParser: arg_parser
+    """
+    arg_parser.add_argument('--metrics_path',
+        type=str,
+        help='Local directory to which to write run metrics, as json lines ' +
+            'and a Prometheus textfile, eg the node_exporter textfile ' +
+            'collector directory. If empty (the default), metrics are not written',
+        default='')
+
+    return arg_parser
+
+
+def script_metrics(args, job, deployment, mode=''):
+    """
+    Get the AmlrMetrics for a script run with the metrics_options argument,
+    or a null context if args.metrics_path is empty
+
+    Args:
+        args (Namespace): parsed script arguments
+        job (str): pipeline job, eg 'scrape_sfmc'
+        deployment (str): deployment name
+        mode (str, optional): deployment mode. Defaults to ''.
+    """
+    if args.metrics_path == '':
+        return nullcontext()
+    return AmlrMetrics(args.metrics_path, job, deployment, mode)
@@ -0,0 +1,130 @@
+"""
+Memory-aware choice of the number of worker processes (numcores), 
+and creation of worker pools
+"""
+
+import os
+import logging
+import multiprocessing as mp
+
+from amlrgliders.profiling import pool_initializer
+
+logger = logging.getLogger(__name__)
+
+
+# Approximate resident memory of an idle worker process (python, pandas, gdm)
+worker_base_bytes = 200e6
+
+# Peak memory while parsing a file, relative to its parsed (in-memory) size
+parse_peak_factor = 2
+
+# Rough size of dba files relative to binary files, and in-memory size of 
+#   parsed data relative to dba files, for estimates before dba files exist
+binary_dba_ratio = 4
+default_parse_ratio = 1.5
+
+
+def available_memory():
+    """
+    Get the available memory in bytes: MemAvailable from /proc/meminfo,
+    limited by the cgroup memory limit if there is one (eg in a container)
+    """
+    available = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    if available is None:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+    # cgroup v2, then v1
+    for limit_file, usage_file in [
+            ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+            ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+             '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(limit_file, 'r') as f:
+                limit = f.read().strip()
+            with open(usage_file, 'r') as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if limit.isdigit() and int(limit) < 2**60:
+            available = min(available, int(limit) - usage)
+        break
+
+    return available
+
+
+def amlr_numcores_plan(file_sizes, parse_ratio, memory_budget=None, max_workers=None):
+    """
+    Choose the number of workers for each stage, within a memory budget.
+
+    While reading dba files, the parent process holds the parsed data of all
+    files (and a copy when concatenating), and each worker holds one file
+    being parsed. Decompressing and compressing files uses little memory,
+    and so those stages use all cores
+
+    Args:
+        file_sizes (list): sizes in bytes of the dba files to parse
+        parse_ratio (float): in-memory size of parsed data, relative to
+            the file size, eg from dba_parse_ratio
+        memory_budget (float, optional): memory budget in bytes.
+            Defaults to None, meaning 80% of available memory
+        max_workers (int, optional): maximum number of workers.
+            Defaults to None, meaning mp.cpu_count()
+
+    Returns:
+        dict: numcores for the 'decompress', 'parse', and 'compress' stages,
+        and the memory estimates used to choose them
+    """
+    if memory_budget is None or memory_budget <= 0:
+        memory_budget = 0.8 * available_memory()
+    if max_workers is None:
+        max_workers = mp.cpu_count()
+
+    data_bytes = sum(file_sizes) * parse_ratio
+    per_worker_bytes = worker_base_bytes + \
+        parse_peak_factor * parse_ratio * max(file_sizes, default=0)
+    workers_budget = memory_budget - 2 * data_bytes
+    parse_numcores = int(max(1, min(max_workers, workers_budget // per_worker_bytes)))
+    if workers_budget < per_worker_bytes:
+        logger.warning(f'The estimated parsed data ({data_bytes / 1e9:.1f} GB) ' +
+                       'may not fit in the memory budget ' +
+                       f'({memory_budget / 1e9:.1f} GB); using 1 core')
+
+    return {
+        'decompress': max_workers,
+        'parse': parse_numcores,
+        'compress': max_workers,
+        'memory_budget': memory_budget,
+        'data_bytes': data_bytes,
+        'per_worker_bytes': per_worker_bytes,
+    }
+
+
+def amlr_pool(numcores):
+    """
+    Create a worker pool of numcores processes. 
+    Workers are profiled if a Profiler is active (see profiling.py)
+
+    Returns:
+        mp.Pool: worker pool
+    """
+    initializer, initargs = pool_initializer()
+    return mp.Pool(numcores, initializer, initargs)
+
+
+def log_numcores_plan(plan):
+    """
+    Log the plan from amlr_numcores_plan
+    """
+    logger.info(
+        f"numcores plan: parse {plan['parse']}, decompress {plan['decompress']}, " +
+        f"compress {plan['compress']} (memory budget {plan['memory_budget'] / 1e9:.1f} GB, " +
+        f"estimated parsed data {plan['data_bytes'] / 1e9:.2f} GB, " +
+        f"{plan['per_worker_bytes'] / 1e6:.0f} MB per parse worker)")
@@ -0,0 +1,157 @@
+"""
+Read-ahead prefetching of input files, eg from gcsfuse-mounted buckets,
+to a local scratch directory
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+
+from amlrgliders.storage import LocalStorage
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """
+    Copy files to a local scratch directory ahead of when they are needed,
+    using a bounded thread pool, so that network I/O overlaps with parsing.
+    At most 'depth' files are copied but not yet requested at any time.
+    Requested copies are kept until they are released, and so consumers 
+    should bound the copies they hold (eg amlr_load_dba_files max_pending).
+
+    Use as a context manager. On exit, the scratch directory is removed,
+    and the hit and miss counts and copy throughput are logged.
+    A hit is a file that was already local when requested;
+    a miss is a file whose copy had to be waited for
+
+    Args:
+        files_list (list): paths of files to prefetch, in the order
+            in which they will be requested. Items may also be tuples of
+            paths, eg unmerged dba files, which are copied together
+        scratch_path (str, optional): directory in which to make the
+            scratch directory. Defaults to None,
+            meaning $TMPDIR (or the system default temporary directory)
+        max_workers (int, optional): number of copy threads. Defaults to 4.
+        depth (int, optional): maximum number of files to read ahead.
+            Defaults to None, meaning 2 * max_workers
+        storage (Storage, optional): storage backend from which to read
+            files. Defaults to None, meaning LocalStorage
+    """
+
+    def __init__(self, files_list, scratch_path=None, max_workers=4, depth=None,
+                 storage=None):
+        self.files_list = list(files_list)
+        self.storage = storage if storage is not None else LocalStorage()
+        self.scratch_path = scratch_path
+        self.max_workers = max_workers
+        self.depth = depth if depth is not None else 2 * max_workers
+
+        self.hits = 0
+        self.misses = 0
+        self.n_bytes = 0
+        self.tmp_path = None
+        self._futures = {}
+        self._next = 0
+        self._requested = set()
+        self._counter = count()
+        self._lock = threading.Lock()
+        self._t_start = None
+        self._t_end = None
+
+    def __enter__(self):
+        self.tmp_path = tempfile.mkdtemp(
+            prefix='amlr-prefetch-', dir=self.scratch_path)
+        logger.debug(f'Prefetching {len(self.files_list)} files to {self.tmp_path}')
+        self._executor = ThreadPoolExecutor(self.max_workers)
+        self._t_start = time.perf_counter()
+        self._fill()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        self.log_stats()
+
+    def __iter__(self):
+        for i in self.files_list:
+            yield self.get(i)
+
+    def _copy(self, file):
+        with self._lock:
+            index = next(self._counter)
+        # Each copy in its own subdirectory, to keep the original file name
+        local_path = os.path.join(self.tmp_path, str(index))
+        os.mkdir(local_path)
+        local_files = []
+        for i in (file if isinstance(file, tuple) else [file]):
+            local_files.append(os.path.join(local_path, os.path.basename(i)))
+            self.storage.get(i, local_files[-1])
+        with self._lock:
+            self.n_bytes += sum(os.path.getsize(i) for i in local_files)
+            self._t_end = time.perf_counter()
+        return tuple(local_files) if isinstance(file, tuple) else local_files[0]
+
+    def _fill(self):
+        while len(self._futures) < self.depth and self._next < len(self.files_list):
+            file = self.files_list[self._next]
+            self._next += 1
+            if file not in self._futures and file not in self._requested:
+                self._futures[file] = self._executor.submit(self._copy, file)
+
+    def get(self, file):
+        """
+        Get the local path of file, waiting for its copy if necessary.
+        If its copy failed and storage is local, the original path is returned
+
+        Args:
+            file (str): path to file, from files_list
+
+        Returns:
+            str: path to local copy of file
+        """
+        self._requested.add(file)
+        future = self._futures.pop(file, None)
+        if future is None:
+            future = self._executor.submit(self._copy, file)
+
+        if future.done():
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        try:
+            local_file = future.result()
+        except OSError as e:
+            if not self.storage.is_local:
+                raise
+            logger.warning(f'Unable to prefetch {file}, reading it directly: {e}')
+            local_file = file
+
+        self._fill()
+        return local_file
+
+    def release(self, local_file):
+        """
+        Remove a local copy once it is no longer needed.
+        Paths that are not in the scratch directory are not touched
+        """
+        if isinstance(local_file, tuple):
+            local_file = local_file[0]
+        local_path = os.path.dirname(local_file)
+        if os.path.dirname(local_path) == self.tmp_path:
+            shutil.rmtree(local_path, ignore_errors=True)
+
+    def log_stats(self):
+        """
+        Log hit and miss counts, and copy throughput
+        """
+        t_elapsed = (self._t_end or self._t_start) - self._t_start
+        mb_per_sec = self.n_bytes / 1e6 / t_elapsed if t_elapsed > 0 else 0
+        logger.info(f'Prefetch: {self.hits} hits, {self.misses} misses, ' +
+                    f'{self.n_bytes / 1e6:.1f} MB copied at {mb_per_sec:.1f} MB/s')
@@ -0,0 +1,514 @@
+"""
+Single-process processing pipeline (amlr-process): conversion of binary
+files to dba files, gdm creation, and writing of output files,
+run as stages in one process that pass data in memory
+and share one worker pool (or, if numcores is 0, size worker pools
+per stage within a memory budget; see parallel.py).
+Stages are only rerun if their inputs have changed (see stages.py)
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+from contextlib import contextmanager, nullcontext
+
+from amlrgliders.utils import amlr_year_path
+from amlrgliders.storage import amlr_storage
+from amlrgliders.catalog import AmlrCatalog
+from amlrgliders.binary_to_dba import amlr_binary_to_dba
+from amlrgliders.stages import (amlr_process_stages, amlr_stage_plan, 
+                                amlr_stage_fingerprints, StageState)
+from amlrgliders.checkpoint import Checkpoint
+from amlrgliders.parallel import amlr_pool
+from amlrgliders.instrument import RunReport, step
+from amlrgliders.metrics import metrics_options, script_metrics, metric_set, \
+    metric_ngdac_latency
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimer:
+    """
+    Record the wall time and outcome of each processing stage
+
+        timer = StageTimer()
+        with timer.stage('gdm'):
+            ...
+        logger.info(timer.summary())
+    """
+
+    def __init__(self):
+        self.timings = []
+
+    @contextmanager
+    def stage(self, name):
+        logger.info(f'Starting stage {name}')
+        t_start = time.perf_counter()
+        status = 'failed'
+        try:
+            yield
+            status = 'complete'
+        finally:
+            t_elapsed = time.perf_counter() - t_start
+            self.timings.append((name, t_elapsed, status))
+            logger.info(f'Stage {name} {status} in {t_elapsed:.1f} seconds')
+
+    def summary(self):
+        """
+        Get a table of the per-stage timings, as a string
+        """
+        lines = [f"{'stage':<16}{'seconds':>10}  status"]
+        lines.extend(f'{name:<16}{t:>10.1f}  {status}'
+                     for name, t, status in self.timings)
+        lines.append(f"{'total':<16}{sum(i[1] for i in self.timings):>10.1f}")
+        return '\n'.join(lines)
+
+
+class StageError(Exception):
+    """
+    Raised when a stage fails, to stop the remaining stages
+    """
+    pass
+
+
+def amlr_process(args, pool=None, cache=None):
+    """
+    Run processing stages for one deployment and mode.
+    The requested stages, and their upstream stages, are run if they are 
+    stale, ie if their input fingerprints differ from their last 
+    successful run; stages downstream of a stale stage are also stale. 
+    If the gdm stage is up to date but a later stage must be run, 
+    the gdm object is loaded from the tmp parquet files.
+    A run report of the stages and their steps (see instrument.py) 
+    is written to the deployment data/out directory
+
+    Args:
+        args (Namespace): parsed arguments, from amlr_process_parser
+        pool (mp.Pool, optional): existing worker pool to use for all 
+            stages, eg shared by deployments processed by amlr-batch. 
+            Defaults to None.
+        cache (DeploymentCache, optional): cache of gdm objects, used 
+            rather than the tmp files if the gdm stage is up to date, 
+            eg by amlr-worker (see worker.py). Defaults to None.
+
+    Returns:
+        StageTimer: per-stage timings, or None if a stage failed
+    """
+
+    deployment = args.deployment
+    project = args.project
+    mode = args.mode
+    deployments_path = args.deployments_path
+    stages = [i for i in amlr_process_stages if i in args.stages]
+
+    # With numcores of 0, each stage chooses its number of cores, 
+    #   eg gdm within the memory budget, rather than sharing a pool
+    numcores = args.numcores
+    memory_budget = args.memory_budget * 1e9 if args.memory_budget > 0 else None
+    scratch_path = args.scratch_path if args.scratch_path != '' else None
+
+    storage = amlr_storage(deployments_path, args.deployments_bucket)
+    imagery_storage = amlr_storage(args.imagery_path, args.imagery_bucket)
+
+    deployment_split = deployment.split('-')
+    year = amlr_year_path(project, deployment_split)
+    glider_path = os.path.join(deployments_path, project, year, deployment)
+    deployment_mode = f'{deployment}-{mode}'
+
+    tmp_path = os.path.join(glider_path, 'data', 'tmp')
+    paths = {
+        'binary': os.path.join(glider_path, 'data', 'binary', mode), 
+        'cache': os.path.join(deployments_path, 'cache'), 
+        'config': os.path.join(glider_path, 'data', 'data-config'), 
+    }
+    params = {
+        'binary_to_dba': {
+            'sensor_filter': args.sensor_filter, 'compress_dba': args.compress_dba, 
+            'unmerged_dba': args.unmerged_dba
+        }, 
+        'imagery': {'ugh_imagery_year': args.ugh_imagery_year}, 
+    }
+    if 'imagery' in stages:
+        imagery_path = os.path.join(
+            args.imagery_path, 'gliders', args.ugh_imagery_year, deployment)
+        paths['imagery_files'] = imagery_storage.walk_files(imagery_path) \
+            if imagery_storage.isdir(imagery_path) else []
+    # The gdm stage must be rerun if its tmp files are missing
+    outputs_ok = {
+        'gdm': all(storage.exists(os.path.join(tmp_path, f'{deployment_mode}-{i}.parquet')) 
+                   for i in ['data', 'profiles'])
+    }
+
+    stage_state = StageState(
+        os.path.join(tmp_path, f'{deployment_mode}-stages.json'), storage)
+    stages_run, fingerprints = amlr_stage_plan(
+        stages, storage, stage_state, paths, params, args.force, outputs_ok)
+    # Load an up-to-date gdm object from tmp, if a later stage needs it.
+    #   If gdm is up to date, then so is binary_to_dba
+    if 'gdm' not in stages_run and any(
+            i not in ['binary_to_dba', 'gdm'] for i in stages_run):
+        stages_run.insert(0, 'gdm_load')
+    stage_state.save()
+
+    # Completed stages are recorded in stage_state; 
+    #   the checkpoint records progress within the dba load and ngdac stages
+    checkpoint = None
+    if args.checkpoint_every > 0:
+        checkpoint = Checkpoint(
+            os.path.join(tmp_path, f'checkpoint-{deployment_mode}'), storage, 
+            args.resume, args.checkpoint_every)
+    elif args.resume:
+        logger.warning('resume is ignored, because checkpoint_every is 0')
+
+    timer = StageTimer()
+    state = {
+        'ascii_path': None, 'gdm': None, 'checkpoint': checkpoint, 
+        'cache': cache, 'gdm_fingerprint': fingerprints.get('gdm')
+    }
+    if len(stages_run) == 0:
+        logger.info(f'All requested stages are up to date for {deployment_mode}')
+        return timer
+    logger.info(f"Running stages {', '.join(stages_run)} for {deployment_mode}, " +
+                (f'using {numcores} core(s)' if numcores > 0 else 
+                 'choosing the number of cores for each stage'))
+
+    with (AmlrCatalog(deployments_path, storage, scratch_path) if args.catalog
+          else nullcontext()) as catalog, \
+            RunReport(deployment, mode, os.path.join(glider_path, 'data', 'out'), 
+                      scratch_path, storage, stages=stages_run, 
+                      numcores=numcores), \
+            script_metrics(args, 'process', deployment, mode), \
+            tempfile.TemporaryDirectory(
+                prefix='amlr-process-', dir=scratch_path) as work_path, \
+            (nullcontext(pool) if pool is not None or numcores <= 1 
+             else amlr_pool(numcores)) as pool:
+        try:
+            for name in stages_run:
+                with timer.stage(name), step(name):
+                    amlr_process_stage(
+                        name, state, args, storage, imagery_storage, catalog,
+                        glider_path, work_path, scratch_path, numcores, pool,
+                        memory_budget)
+                if name == 'binary_to_dba':
+                    # Decompression and cac2lower add and rename binary and 
+                    #   cac files, so fingerprint the inputs after the stage
+                    fingerprints = amlr_stage_fingerprints(
+                        list(fingerprints), storage, stage_state, paths, params)
+                    state['gdm_fingerprint'] = fingerprints.get('gdm')
+                if name in fingerprints:
+                    stage_state.set_complete(name, fingerprints[name])
+        except StageError as e:
+            logger.error(f'{e}; remaining stages will not be run')
+            if catalog is not None:
+                catalog.set_status(deployment, mode, name, 'failed', str(e))
+            logger.info(f'Stage timings:\n{timer.summary()}')
+            return None
+        if 'ngdac' in stages_run and args.metrics_path != '':
+            metric_ngdac_latency(args.metrics_path, deployment, mode)
+        metric_set('success', 1)
+
+    if checkpoint is not None:
+        checkpoint.clear()
+    logger.info(f'Processing complete for {deployment_mode}. ' +
+                f'Stage timings:\n{timer.summary()}')
+    return timer
+
+
+def amlr_process_stage(name, state, args, storage, imagery_storage, catalog,
+                       glider_path, work_path, scratch_path, numcores, pool,
+                       memory_budget=None):
+    """
+    Run one processing stage. Stages read from and add to state,
+    eg the gdm stage adds the gdm object used by the output stages.
+    Stage modules are imported by their stage, so that runs of eg only 
+    binary_to_dba do not load gdm, xarray, and pandas
+    """
+    deployment = args.deployment
+    mode = args.mode
+
+    if name == 'binary_to_dba':
+        ascii_path = amlr_binary_to_dba(
+            deployment, args.project, mode, args.deployments_path,
+            args.processDbds_file, args.cac2lower_file, args.linuxbin_path,
+            sensor_filter=args.sensor_filter, numcores=numcores,
+            compress_dba=args.compress_dba, scratch_path=scratch_path,
+            storage=storage, catalog=catalog, work_path=work_path, pool=pool, 
+            unmerged=args.unmerged_dba
+        )
+        if ascii_path is None:
+            raise StageError('Conversion of binary files to dba files failed')
+        # For non-local storage, read the local dba files in the gdm stage
+        if not storage.is_local:
+            state['ascii_path'] = ascii_path
+
+    elif name in ['gdm', 'gdm_load']:
+        # gdm_load reads the tmp files of an up-to-date gdm stage; 
+        #   gdm (re)creates the gdm object from dba files, and clobbers them
+        loadfromtmp = name == 'gdm_load'
+        # Cached gdm objects are only used, and kept, for in-memory processing
+        cache = state['cache'] if args.window_rows <= 0 else None
+        cache_key = (glider_path, mode)
+        if loadfromtmp and cache is not None:
+            gdm = cache.get(cache_key, state['gdm_fingerprint'])
+            if gdm is not None:
+                logger.info('Using the cached gdm object, rather than the tmp files')
+                state['gdm'] = gdm
+                return
+
+        from amlrgliders.glider import amlr_gdm
+        gdm = amlr_gdm(
+            deployment, args.project, mode, glider_path, numcores,
+            loadfromtmp, not loadfromtmp, args.prefetch, scratch_path,
+            storage, catalog, pool, state['ascii_path'], state['checkpoint'],
+            memory_budget, args.window_rows, work_path
+        )
+        if gdm is None:
+            raise StageError('gdm processing failed')
+        # Out of core, amlr_gdm returns the windows of the data
+        if args.window_rows > 0:
+            state['windows'] = gdm
+            gdm = gdm.gdm
+        state['gdm'] = gdm
+        if cache is not None:
+            cache.put(cache_key, state['gdm_fingerprint'], gdm)
+
+    else:
+        gdm = state['gdm']
+        windows = state.get('windows')
+        if gdm is None:
+            raise StageError(f'Stage {name} requires the gdm stage')
+
+        if name == 'trajectory':
+            from amlrgliders.glider import amlr_write_trajectory
+            out = amlr_write_trajectory(gdm, deployment, mode, glider_path,
+                                        scratch_path=scratch_path, storage=storage,
+                                        catalog=catalog, windows=windows)
+
+        elif name == 'ngdac':
+            from amlrgliders.glider import amlr_write_ngdac
+            nc_ngdac_path = os.path.join(glider_path, 'data', 'nc', 'ngdac', mode)
+            out = amlr_write_ngdac(gdm, deployment, mode, nc_ngdac_path, scratch_path,
+                                   storage, catalog, state['checkpoint'], windows)
+
+        elif name == 'ragged':
+            from amlrgliders.glider import amlr_write_profiles_ragged
+            from amlrgliders.timeseries import amlr_sensor_defs
+            nc_ragged_path = os.path.join(glider_path, 'data', 'nc', 'profiles')
+            sensor_defs = amlr_sensor_defs(
+                os.path.join(glider_path, 'data', 'data-config'), storage)
+            out = amlr_write_profiles_ragged(gdm, deployment, mode, nc_ragged_path,
+                                             scratch_path, storage, catalog, windows,
+                                             sensor_defs)
+
+        elif name == 'acoustics':
+            from amlrgliders.acoustics import amlr_acoustics_metadata
+            out = amlr_acoustics_metadata(gdm, f'{deployment}-{mode}', glider_path,
+                                          scratch_path, storage, catalog, windows)
+
+        elif name == 'imagery':
+            from amlrgliders.imagery import amlr_imagery_metadata
+            out = amlr_imagery_metadata(
+                gdm, deployment, glider_path,
+                os.path.join(args.imagery_path, 'gliders', args.ugh_imagery_year,
+                             deployment),
+                scratch_path=scratch_path, storage=storage,
+                imagery_storage=imagery_storage, catalog=catalog, windows=windows
+            )
+
+        # Writers return None if any output was not written or uploaded
+        if out is None:
+            raise StageError(f'Writing the {name} files failed')
+
+    if catalog is not None and name in amlr_process_stages:
+        catalog.set_status(deployment, mode, name, 'complete')
+
+
+def amlr_process_parser():
+    """
+    Get the argument parser for amlr-process
+    """
+    arg_parser = argparse.ArgumentParser(
+        description='Process AMLR glider data for one deployment and mode, ' +
+            'from binary files to output files, in a single process',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        allow_abbrev=False)
+
+    arg_parser.add_argument('deployment',
+        type=str,
+        help='Deployment name, eg amlr03-20220425')
+
+    arg_parser.add_argument('project',
+        type=str,
+        help='Glider project name',
+        choices=['FREEBYRD', 'REFOCUS', 'SANDIEGO'])
+
+    arg_parser.add_argument('mode',
+        type=str,
+        help="Deployment mode. 'delayed' means [de]bd files will be used, " +
+            "and 'rt' means [st]bd files will be used",
+        choices=['delayed', 'rt'])
+
+    arg_parser.add_argument('deployments_path',
+        type=str,
+        help='Path to glider deployments directory. ' +
+            'In GCP, this will be the mounted bucket path')
+
+    return amlr_process_options(arg_parser)
+
+
+def amlr_process_options(arg_parser):
+    """
+    Add the optional arguments of amlr-process to arg_parser, 
+    eg for amlr-batch
+
+    Returns:
+        ArgumentParser: arg_parser
+    """
+    arg_parser.add_argument('--stages',
+        type=str,
+        nargs='+',
+        help='Processing stages to make. Stages are always run in the order ' +
+            f"{', '.join(amlr_process_stages)}. " + 
+            'Stale upstream stages are also run, and up-to-date stages ' + 
+            'are skipped',
+        choices=amlr_process_stages,
+        default=['binary_to_dba', 'gdm', 'trajectory'])
+
+    arg_parser.add_argument('--numcores',
+        type=int,
+        help='Number of cores in the worker pool shared by all stages. ' +
+            'If 0 (the default), the number of cores is chosen for each stage: ' +
+            'all possible cores to convert and compress files, and ' +
+            'as many cores as fit in --memory_budget to read dba files',
+        default=0)
+
+    arg_parser.add_argument('--memory_budget',
+        type=float,
+        help='Memory budget in GB, used to choose the number of cores ' +
+            'to read dba files when --numcores is 0. ' +
+            'If 0 (the default), 80%% of available memory',
+        default=0)
+
+    arg_parser.add_argument('--window_rows',
+        type=int,
+        help='If greater than 0, process the data out of core, in time ' +
+            'windows of about this many rows, for deployments whose data ' +
+            'do not fit in memory. Outputs are identical to those of ' +
+            'in-memory processing (0, the default)',
+        default=0)
+
+    arg_parser.add_argument('--processDbds_file',
+        type=str,
+        help='Path to processDbds shell script',
+        default='/opt/amlr-gliders/resources/slocum/processDbds-usamlr.sh')
+
+    arg_parser.add_argument('--cac2lower_file',
+        type=str,
+        help='Path to cac2lower shell script',
+        default='/opt/amlr-gliders/resources/slocum/cac2lower.sh')
+
+    arg_parser.add_argument('--linuxbin_path',
+        type=str,
+        help='Path to linux-bin directory',
+        default='/opt/amlr-gliders/resources/slocum/linux-bin_8_6')
+
+    arg_parser.add_argument('--sensor_filter',
+        help='flag; indicates if dba files should only contain the sensors ' +
+            'in the deployment sensor_defs.yml file and amlr_gdm_varnames',
+        action='store_true')
+
+    arg_parser.add_argument('--compress_dba',
+        type=str,
+        help='Compression for dba files written to the ascii directory',
+        choices=['none', 'gzip', 'zstd'],
+        default='none')
+
+    arg_parser.add_argument('--unmerged_dba',
+        help='flag; write the flight and science dba files of each segment ' +
+            'unmerged, and merge them when they are read by the gdm stage',
+        action='store_true')
+
+    arg_parser.add_argument('--force',
+        help='flag; run the requested stages even if they are up to date',
+        action='store_true')
+
+    arg_parser.add_argument('--resume',
+        help='flag; resume the dba load and ngdac stages of a run that ' +
+            'stopped (eg a preempted VM) from its checkpoint. ' +
+            'Completed stages are always skipped, as they are up to date. ' +
+            'Requires --checkpoint_every, in both the stopped and resumed runs',
+        action='store_true')
+
+    arg_parser.add_argument('--checkpoint_every',
+        type=int,
+        help='Number of dba files parsed, or ngdac files written, between ' +
+            'checkpoints. If 0, no checkpoints are saved. ' +
+            'Checkpoints add storage writes, and so are opt-in; eg use 500 ' +
+            'for long runs on preemptible VMs',
+        default=0)
+
+    arg_parser.add_argument('--prefetch',
+        help='flag; indicates if dba (or tmp parquet) files should be ' +
+            'copied to local scratch ahead of being read',
+        action='store_true')
+
+    arg_parser.add_argument('--scratch_path',
+        type=str,
+        help='Local directory for intermediate and staged files. ' +
+            'If empty (the default), $TMPDIR is used',
+        default='')
+
+    arg_parser.add_argument('--deployments_bucket',
+        type=str,
+        help='GCS bucket that is mounted at deployments_path. ' +
+            'If specified, files are read and written with the native ' +
+            'GCS client rather than through gcsfuse',
+        default='')
+
+    arg_parser.add_argument('--catalog',
+        help='flag; indicates if the deployment catalog in deployments_path ' +
+            'should be used and updated',
+        action='store_true')
+
+    arg_parser.add_argument('--imagery_path',
+        type=str,
+        help='Path to imagery bucket, for the imagery stage',
+        default='')
+
+    arg_parser.add_argument('--imagery_bucket',
+        type=str,
+        help='GCS bucket that is mounted at imagery_path',
+        default='')
+
+    arg_parser.add_argument('--ugh_imagery_year',
+        type=str,
+        help='temporary workaround',
+        default='2023')
+
+    arg_parser.add_argument('-l', '--loglevel',
+        type=str,
+        help='Verbosity level',
+        choices=['debug', 'info', 'warning', 'error', 'critical'],
+        default='info')
+
+    return metrics_options(arg_parser)
+
+
+def main(argv=None):
+    """
+    Entry point for amlr-process
+    """
+    args = amlr_process_parser().parse_args(argv)
+
+    log_level = getattr(logging, args.loglevel.upper())
+    log_format = '%(module)s:%(levelname)s:%(message)s [line %(lineno)d]'
+    logging.basicConfig(format=log_format, level=log_level)
+
+    return 0 if amlr_process(args) is not None else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,324 @@
+"""
+Profiling of script runs (--profile): cProfile stats, and optionally
+sampled stacks and tracemalloc snapshots, of the main process and of
+pool workers created with amlr_pool (see parallel.py) while the profiler
+is active. Worker profiles are merged with the main process profile:
+
+    with Profiler(os.path.join(glider_path, 'scripts'), 'amlr03-20220425-dba_to_nc'):
+        ...
+
+writes, for name-YYYYmmddTHHMMSS:
+    name.pstats: merged cProfile stats, eg for snakeviz or flameprof
+    name-profile.txt: the top functions by cumulative time
+    name.collapsed: sampled stacks in the collapsed (folded) format of
+        flamegraph.pl and speedscope, if sampling
+    name-tracemalloc.txt: top allocations of each process, if tracing memory
+
+cProfile only profiles the thread that enabled it, ie the main thread
+of each process; sampling includes all threads
+"""
+
+import os
+import sys
+import signal
+import pstats
+import shutil
+import logging
+import cProfile
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing.util
+from collections import Counter
+from contextlib import nullcontext
+from datetime import datetime
+
+from amlrgliders.staging import OutputStager
+
+logger = logging.getLogger(__name__)
+
+
+# The active profiler of this process, used by pool_initializer
+_active_profiler = None
+
+
+class StackSampler:
+    """
+    Sample the stacks of all threads (other than its own) every interval
+    seconds, and count them as collapsed stacks: 'prefix;outer;...;inner'
+    """
+
+    def __init__(self, interval, prefix):
+        self.interval = interval
+        self.prefix = prefix
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='amlr-stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)})')
+                    frame = frame.f_back
+                self.counts[';'.join([self.prefix] + stack[::-1])] += 1
+
+    def write(self, collapsed_file):
+        with open(collapsed_file, 'a') as f:
+            for stack, count in self.counts.items():
+                f.write(f'{stack} {count}\n')
+
+
+def tracemalloc_top(snapshot, title, limit=25):
+    """
+    Format the top allocations of a tracemalloc snapshot, by line
+    """
+    stats = snapshot.statistics('lineno')
+    lines = [f'{title}: {sum(i.size for i in stats) / 1e6:.1f} MB ' +
+             f'in {sum(i.count for i in stats)} blocks']
+    lines.extend(f'  {i}' for i in stats[:limit])
+    return '\n'.join(lines) + '\n'
+
+
+class _ProcessProfile:
+    """
+    Profile of one process: cProfile, and optionally a stack sampler
+    and tracemalloc
+    """
+
+    def __init__(self, prefix, sample_interval, trace_memory):
+        self.prefix = prefix
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(sample_interval, prefix) \
+            if sample_interval else None
+        self.trace_memory = trace_memory
+
+    def start(self):
+        if self.trace_memory:
+            # Forked workers inherit the traces of the parent
+            tracemalloc.stop()
+            tracemalloc.start()
+        if self.sampler is not None:
+            self.sampler.start()
+        self.profile.enable()
+
+    def stop(self, out_path, name):
+        """
+        Stop profiling, and write the profile files to out_path
+        """
+        self.profile.disable()
+        self.profile.dump_stats(os.path.join(out_path, f'{name}.pstats'))
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.write(os.path.join(out_path, f'{name}.collapsed'))
+        if self.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            with open(os.path.join(out_path, f'{name}-tracemalloc.txt'), 'w') as f:
+                f.write(tracemalloc_top(snapshot, name))
+
+
+def _worker_start(stats_path, sample_interval, trace_memory):
+    """
+    Pool worker initializer: profile the worker until it exits,
+    or is terminated (eg when a pool context manager exits)
+    """
+    name = f'worker-{os.getpid()}'
+    process_profile = _ProcessProfile('worker', sample_interval, trace_memory)
+    stopped = []
+
+    def stop(*args):
+        # If the worker is already stopping as it exits, and is then 
+        #   terminated, let it finish writing its profile
+        if stopped:
+            return
+        stopped.append(True)
+        process_profile.stop(stats_path, name)
+        if args:
+            # Called as the SIGTERM handler
+            os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    multiprocessing.util.Finalize(None, stop, exitpriority=100)
+    process_profile.start()
+
+
+def pool_initializer():
+    """
+    Get the (initializer, initargs) with which to create pools,
+    ie profile workers if a Profiler is active in this process
+    """
+    if _active_profiler is None:
+        return None, ()
+    return _worker_start, (
+        _active_profiler.stats_path, _active_profiler.sample_interval,
+        _active_profiler.trace_memory)
+
+
+class Profiler:
+    """
+    Profile the main process and pool workers while active,
+    and on exit write the merged profile files (see the module docstring)
+    to out_path
+
+    Args:
+        out_path (str): directory to which to write the profile files,
+            eg the deployment scripts directory
+        name (str): base name of the profile files, to which the start
+            time is appended
+        sample_interval (float, optional): seconds between stack samples.
+            Defaults to None, meaning no sampling.
+        trace_memory (bool, optional): trace memory allocations with
+            tracemalloc? Defaults to False.
+        scratch_path (str, optional): directory for local staging.
+            Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for out_path.
+            Defaults to None, meaning LocalStorage.
+    """
+
+    def __init__(self, out_path, name, sample_interval=None, trace_memory=False,
+                 scratch_path=None, storage=None):
+        self.out_path = out_path
+        self.name = f"{name}-{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+        self.sample_interval = sample_interval
+        self.trace_memory = trace_memory
+        self.scratch_path = scratch_path
+        self.storage = storage
+        self.stats_path = None
+        self._process_profile = None
+
+    def __enter__(self):
+        global _active_profiler
+        if _active_profiler is not None:
+            raise RuntimeError('A profiler is already active in this process')
+        self.stats_path = tempfile.mkdtemp(prefix='amlr-profile-', dir=self.scratch_path)
+        logger.info(f'Profiling, with profile files to be written to {self.out_path}')
+        _active_profiler = self
+        self._process_profile = _ProcessProfile(
+            'main', self.sample_interval, self.trace_memory)
+        self._process_profile.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active_profiler
+        self._process_profile.stop(self.stats_path, 'main')
+        _active_profiler = None
+        try:
+            self._merge()
+        finally:
+            shutil.rmtree(self.stats_path, ignore_errors=True)
+
+    def _merge(self):
+        files = os.listdir(self.stats_path)
+        # Main process first
+        names = ['main'] + sorted(
+            i[:-len('.pstats')] for i in files
+            if i.endswith('.pstats') and i != 'main.pstats')
+        logger.info('Merging the profiles of the main process and ' +
+                    f'{len(names) - 1} pool worker(s)')
+
+        with OutputStager(self.out_path, self.scratch_path, storage=self.storage) as stager:
+            stats = pstats.Stats(
+                *[os.path.join(self.stats_path, f'{i}.pstats') for i in names],
+                stream=open(stager.path(f'{self.name}-profile.txt'), 'w'))
+            stats.dump_stats(stager.path(f'{self.name}.pstats'))
+            stats.stream.write(f'Merged profile of {len(names)} process(es): ' +
+                               f"{', '.join(names)}\n")
+            stats.sort_stats('cumulative').print_stats(50)
+            stats.stream.close()
+
+            if self.sample_interval:
+                # Sum the counts of stacks sampled in multiple workers
+                counts = Counter()
+                for i in names:
+                    collapsed_file = os.path.join(self.stats_path, f'{i}.collapsed')
+                    if not os.path.exists(collapsed_file):
+                        continue
+                    with open(collapsed_file, 'r') as f:
+                        for line in f:
+                            stack, count = line.rstrip('\n').rsplit(' ', 1)
+                            counts[stack] += int(count)
+                with open(stager.path(f'{self.name}.collapsed'), 'w') as f:
+                    for stack, count in sorted(counts.items()):
+                        f.write(f'{stack} {count}\n')
+
+            if self.trace_memory:
+                with open(stager.path(f'{self.name}-tracemalloc.txt'), 'w') as f_out:
+                    for i in names:
+                        tracemalloc_file = os.path.join(
+                            self.stats_path, f'{i}-tracemalloc.txt')
+                        if os.path.exists(tracemalloc_file):
+                            with open(tracemalloc_file, 'r') as f_in:
+                                f_out.write(f_in.read() + '\n')
+
+
+def profile_options(arg_parser):
+    """
+    Add the profiling (--profile) arguments to a script's arg_parser
+
+    Returns:
+        ArgumentParser: arg_parser
+    """
+    arg_parser.add_argument('--profile',
+        help='flag; profile the run with cProfile, including pool workers, ' +
+            'and write the merged profile to the deployment scripts directory',
+        action='store_true')
+
+    arg_parser.add_argument('--profile_sample',
+        type=float,
+        help='If greater than 0, and --profile, also sample the stacks of ' +
+            'all threads every this many milliseconds, and write them in the ' +
+            'collapsed format of flamegraph.pl and speedscope',
+        default=0)
+
+    arg_parser.add_argument('--profile_memory',
+        help='flag; if --profile, also trace memory allocations ' +
+            'with tracemalloc, which slows the run',
+        action='store_true')
+
+    arg_parser.add_argument('--profile_path',
+        type=str,
+        help='Local directory to which to write profile files. ' +
+            'If empty (the default), the deployment scripts directory is used',
+        default='')
+
+    return arg_parser
+
+
+def script_profiler(args, out_path, name, scratch_path=None, storage=None):
+    """
+    Get the Profiler for a script run with the profile_options arguments,
+    or a null context if args.profile is False
+
+    Args:
+        args (Namespace): parsed script arguments
+        out_path (str): default directory for the profile files,
+            eg the deployment scripts directory
+        name (str): base name of the profile files
+        scratch_path (str, optional): directory for local staging.
+            Defaults to None, meaning $TMPDIR.
+        storage (Storage, optional): storage backend for out_path.
+            Defaults to None, meaning LocalStorage.
+    """
+    if not args.profile:
+        return nullcontext()
+    if args.profile_path != '':
+        out_path = args.profile_path
+        storage = None
+    sample_interval = args.profile_sample / 1000 if args.profile_sample > 0 else None
+    return Profiler(out_path, name, sample_interval, args.profile_memory,
+                    scratch_path, storage)
@@ -5,7 +5,10 @@ Scraping and organizing AMLR glider data from the SFMC
 import os
 import logging
 import re
-from subprocess import call, run
+from subprocess import call
+
+from amlrgliders.metrics import metric_inc
+from amlrgliders.storage import UploadError
 
 logger = logging.getLogger(__name__)
 
@@ -48,11 +51,25 @@ def access_secret_version(project_id, secret_id, version_id = 'latest'):
     return response.payload.data.decode("UTF-8")
 
 
-def rt_files_mgmt(sfmc_ext_all, ext_regex, subdir_name, local_path, bucket_path):
+def rt_files_metrics(subdir_path, subdir_name, uploaded):
+    """
+    Record the number and size of the uploaded real-time files
+    """
+    metric_inc('files_uploaded', len(uploaded), kind=subdir_name)
+    metric_inc('bytes_uploaded', sum(
+        os.path.getsize(os.path.join(subdir_path, os.path.basename(i)))
+        for i in uploaded), kind=subdir_name)
+
+
+def rt_files_mgmt(sfmc_ext_all, ext_regex, subdir_name, local_path, bucket_path, 
+                  storage):
     """
     Copy real-time files from the local sfmc folder (local_path)
     to their subdirectory (subdir_path), 
     and then rsync to their place in the bucket (bucket_path)
+    using the storage backend (eg GCSStorage). 
+    Only new files, or files with changed sizes, are uploaded.
+    Returns the bucket paths of the uploaded files, or None if there was an error
 
     ext_regex_path does include * for copying files (eg is '.[st]bd')
     """
@@ -77,16 +94,21 @@ def rt_files_mgmt(sfmc_ext_all, ext_regex, subdir_name, local_path, bucket_path)
 
         logging.info(f'Rsyncing {subdir_name} subdirectory with bucket directory')
         logging.debug(f'Bucket directory: {bucket_path}')
-        retcode = run(['gsutil', '-m', 'rsync', subdir_path, bucket_path], 
-            capture_output = True)
-        if retcode.returncode != 0:
+        try:
+            uploaded = storage.upload_dir(subdir_path, bucket_path)
+        except Exception as e:
             logging.error(f'Error copying {subdir_name} files to bucket')
-            logging.error(f'Args: {retcode.args}')
-            logging.error(f'stderr: {retcode.stderr}')
+            logging.error(f'Error: {e}')
+            # Count the files that were uploaded; 
+            #   the others are retried by the next scrape
+            if isinstance(e, UploadError):
+                rt_files_metrics(subdir_path, subdir_name, e.uploaded)
             return
         else:
-            logging.info(f'Successfully copied {subdir_name} files to {bucket_path}')
-            logging.debug(f'Args: {retcode.args}')
-            logging.debug(f'stderr: {retcode.stdout}')
+            logging.info(f'Successfully copied {len(uploaded)} {subdir_name} ' + 
+                         f'files to {bucket_path}')
+            rt_files_metrics(subdir_path, subdir_name, uploaded)
+            return uploaded
     else: 
         logging.info(f'No {subdir_name} files to copy')
+        return []
@@ -0,0 +1,684 @@
+"""
+Handling of Slocum glider binary and dba files
+"""
+
+import io
+import os
+import gzip
+import shutil
+import logging
+import datetime as dt
+from itertools import repeat
+from contextlib import nullcontext
+
+from amlrgliders.parallel import amlr_pool
+
+logger = logging.getLogger(__name__)
+
+
+# Raw dba sensors that gdm needs to derive time, position, depth, and
+#   CTD-derived (salinity, density) variables, regardless of sensor_defs
+amlr_dba_sensors_required = [
+    'm_present_time', 'sci_m_present_time',
+    'm_lat', 'm_lon', 'm_gps_lat', 'm_gps_lon',
+    'm_depth', 'm_pressure', 'm_pitch', 'm_roll', 'm_heading',
+    'sci_water_pressure', 'sci_water_cond', 'sci_water_temp'
+]
+
+
+# Compressed Slocum file extensions, and the extensions of the
+#   corresponding standard (decompressed) files
+slocum_compressed_ext = {
+    '.dcd': '.dbd', '.ecd': '.ebd', '.mcd': '.mbd', '.ncd': '.nbd',
+    '.scd': '.sbd', '.tcd': '.tbd', '.ccc': '.cac'
+}
+
+
+# Supported dba file compression types, and their file extensions
+dba_compression_ext = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+# Flight dba file types, and the corresponding science file types, 
+#   eg of unmerged dba files written by processDbds -u
+dba_science_types = {'dbd': 'ebd', 'mbd': 'nbd', 'sbd': 'tbd'}
+
+
+def amlr_sensor_filter(config_path, filter_file):
+    """
+    Create the sensor filter file used by processDbds (-f FILE)
+    so that dba files only contain sensors that are used downstream.
+    Sensors are the keys of sensor_defs.yml in config_path,
+    plus amlr_gdm_varnames and amlr_dba_sensors_required
+
+    Args:
+        config_path (str): path to deployment data-config folder
+        filter_file (str): path of the sensor filter file to write
+
+    Returns:
+        list: sorted list of sensor names written to filter_file
+    """
+
+    sensor_defs_file = os.path.join(config_path, 'sensor_defs.yml')
+    if not os.path.isfile(sensor_defs_file):
+        logger.error(f'The sensor_defs file ({sensor_defs_file}) does not exist, ' +
+                     'and thus the sensor filter cannot be created')
+        return
+
+    # Local imports, so gdm and yaml are only loaded when a filter is requested
+    import yaml
+    from amlrgliders.glider import amlr_gdm_varnames
+
+    with open(sensor_defs_file, 'r') as f:
+        sensor_defs = yaml.safe_load(f)
+
+    sensors = set(sensor_defs.keys())
+    sensors.update(amlr_gdm_varnames)
+    sensors.update(amlr_dba_sensors_required)
+    sensors = sorted(sensors)
+
+    logger.info(f'Writing sensor filter with {len(sensors)} sensors ' +
+                f'to {filter_file}')
+    with open(filter_file, 'w') as f:
+        f.write('\n'.join(sensors) + '\n')
+
+    return sensors
+
+
+def dba_open(dba_file, mode='rb', fileobj=None):
+    """
+    Open a dba file, with transparent (streaming) decompression 
+    if the file is gzip (.gz) or zstd (.zst) compressed
+
+    Args:
+        dba_file (str): path to dba file
+        mode (str, optional): file mode, eg 'rb', 'rt', or 'wb'. 
+            Defaults to 'rb'.
+        fileobj (file object, optional): binary file object of dba_file, 
+            eg opened with Storage.open, to read rather than dba_file. 
+            Defaults to None.
+
+    Returns:
+        file object
+    """
+
+    source = dba_file if fileobj is None else fileobj
+    if dba_file.endswith(dba_compression_ext['gzip']):
+        return gzip.open(source, mode)
+    elif dba_file.endswith(dba_compression_ext['zstd']):
+        # Optional dependency, only needed for zstd compressed files
+        import zstandard
+        return zstandard.open(source, mode)
+    elif fileobj is not None:
+        return io.TextIOWrapper(fileobj) if 't' in mode else fileobj
+    else:
+        return open(dba_file, mode)
+
+
+def dba_is_compressed(dba_file):
+    """
+    Is dba_file compressed, based on its extension
+    """
+    return dba_file.endswith(tuple(dba_compression_ext.values()))
+
+
+def dba_compress(dba_file, compression):
+    """
+    Compress a dba file, and remove the uncompressed file
+
+    Args:
+        dba_file (str): path to uncompressed dba file
+        compression (str): compression type; one of 'gzip' or 'zstd'
+
+    Returns:
+        str: path to compressed dba file
+    """
+
+    out_file = f'{dba_file}{dba_compression_ext[compression]}'
+    with open(dba_file, 'rb') as f_in, dba_open(out_file, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(dba_file)
+
+    return out_file
+
+
+def dba_compress_files(ascii_path, compression, numcores=1, pool=None):
+    """
+    Compress all uncompressed dba files in ascii_path. 
+    Existing compressed files for the same dba files are clobbered
+
+    Args:
+        ascii_path (str): path to ascii (dba) files
+        compression (str): compression type; one of 'gzip' or 'zstd'
+        numcores (int, optional): number of cores to use. Defaults to 1.
+        pool (mp.Pool, optional): existing worker pool to use, 
+            rather than creating one. Defaults to None.
+
+    Returns:
+        list: paths to compressed dba files
+    """
+
+    if compression not in dba_compression_ext:
+        logger.error('compression must be one of ' + 
+                     f"{', '.join(dba_compression_ext.keys())}")
+        return
+
+    dba_files_list = [
+        os.path.join(ascii_path, i) for i in sorted(os.listdir(ascii_path))
+        if not dba_is_compressed(i)
+    ]
+    logger.info(f'Compressing {len(dba_files_list)} dba files ' + 
+                f'with {compression} using {numcores} core(s)')
+    if pool is not None:
+        out_files = pool.starmap(
+            dba_compress, zip(dba_files_list, repeat(compression)))
+    elif numcores > 1 and len(dba_files_list) > 1:
+        with amlr_pool(numcores) as pool:
+            out_files = pool.starmap(
+                dba_compress, zip(dba_files_list, repeat(compression)))
+    else:
+        out_files = [dba_compress(i, compression) for i in dba_files_list]
+
+    return out_files
+
+
+def dba_header(dba_file, storage=None):
+    """
+    Read the ascii header tags from a dba file
+
+    Args:
+        dba_file (str): path to dba file
+        storage (Storage, optional): storage backend of dba_file, 
+            from which only the header is read. Defaults to None, 
+            meaning a local file.
+
+    Returns:
+        dict: header tag names and values, as strings
+    """
+
+    header = {}
+    remote = storage is not None and not storage.is_local
+    with (storage.open(dba_file, 'rb') if remote else nullcontext()) as f_raw, \
+            dba_open(dba_file, 'rt', f_raw) as f:
+        line = f.readline()
+        while ':' in line:
+            key, value = line.split(':', 1)
+            header[key.strip()] = value.strip()
+            if 'num_ascii_tags' in header and \
+                    len(header) >= int(header['num_ascii_tags']):
+                break
+            line = f.readline()
+
+    return header
+
+
+def dba_open_time(dba_file, storage=None):
+    """
+    Get the time at which a dba file (segment) was opened on the glider, 
+    from its fileopen_time header tag, eg 'Thu_Feb__2_21:55:57_2023'
+
+    Args:
+        dba_file (str): path to dba file
+        storage (Storage, optional): storage backend of dba_file. 
+            Defaults to None, meaning a local file.
+
+    Returns:
+        datetime: file open time, or None if it could not be read
+    """
+
+    try:
+        fileopen_time = dba_header(dba_file, storage)['fileopen_time']
+        return dt.datetime.strptime(
+            fileopen_time.replace('_', ' '), '%a %b %d %H:%M:%S %Y')
+    except (OSError, KeyError, ValueError, UnicodeDecodeError):
+        logger.debug(f'Unable to read fileopen_time from {dba_file}')
+        return None
+
+
+def dba_summary(ascii_path):
+    """
+    Summarize the dba files in ascii_path:
+    the number of files, total size, and sensors per file
+
+    Args:
+        ascii_path (str): path to ascii (dba) files
+
+    Returns:
+        dict: with keys n_files, n_bytes, and n_sensors (max sensors_per_cycle)
+    """
+
+    dba_files_list = [os.path.join(ascii_path, i) for i in os.listdir(ascii_path)]
+    dba_files_list = [i for i in dba_files_list if os.path.isfile(i)]
+
+    n_sensors = 0
+    for i in dba_files_list:
+        try:
+            n_sensors = max(n_sensors, int(dba_header(i)['sensors_per_cycle']))
+        except (KeyError, ValueError, UnicodeDecodeError):
+            logger.debug(f'Unable to read sensors_per_cycle from {i}')
+
+    return {
+        'n_files': len(dba_files_list),
+        'n_bytes': sum(os.path.getsize(i) for i in dba_files_list),
+        'n_sensors': n_sensors
+    }
+
+
+def read_dba(dba_file):
+    """
+    Read a dba file into a data frame, without any processing. 
+    Column names are the sensor names from the dba label lines. 
+    The header tags, and the units and bytes label lines, are kept in 
+    the data frame attrs (dba_header, dba_units, and dba_bytes), 
+    for write_dba
+
+    Args:
+        dba_file (str): path to dba file
+
+    Returns:
+        DataFrame: dba data, with one column per sensor
+    """
+    # Local imports, so that eg scraping and decompressing files 
+    #   do not load numpy and pandas
+    import numpy as np
+    import pandas as pd
+
+    header = dba_header(dba_file)
+    n_tags = int(header['num_ascii_tags'])
+    n_label = int(header.get('num_label_lines', 3))
+
+    with dba_open(dba_file, 'rt') as f:
+        for _ in range(n_tags):
+            f.readline()
+        labels = [f.readline().split() for _ in range(n_label)]
+    sensors = labels[0]
+
+    with dba_open(dba_file, 'rt') as f:
+        data = pd.read_csv(
+            f, sep=r'\s+', header=None, names=sensors, 
+            skiprows=n_tags + n_label, dtype=np.float64
+        )
+    data.attrs['dba_header'] = header
+    if n_label >= 3:
+        data.attrs['dba_units'] = labels[1]
+        data.attrs['dba_bytes'] = labels[2]
+    return data
+
+
+def dba_segment_files(segment):
+    """
+    Get the list of dba files of a segment from dba_segments
+    """
+    return list(segment) if isinstance(segment, tuple) else [segment]
+
+
+def write_dba(data, dba_file):
+    """
+    Write dba data, eg merged by amlr_dba_merge, to a dba file, 
+    with the header tags and label lines of its attrs (see read_dba). 
+    Values are written with the shortest representation that 
+    reads back as the same float, so that the file parses to data
+
+    Args:
+        data (DataFrame): dba data, eg from read_dba
+        dba_file (str): path of the dba file
+    """
+    header = dict(data.attrs.get('dba_header', {}))
+    header['sensors_per_cycle'] = str(len(data.columns))
+    n_columns = len(data.columns)
+    units = data.attrs.get('dba_units', ['nodim'] * n_columns)
+    n_bytes = data.attrs.get('dba_bytes', ['8'] * n_columns)
+    with open(dba_file, 'w') as f:
+        for key, value in header.items():
+            f.write(f'{key}: {value}\n')
+        for i in [list(data.columns), units, n_bytes]:
+            f.write(' '.join(i) + ' \n')
+        data.to_csv(f, sep=' ', header=False, index=False, na_rep='NaN')
+
+
+def dba_segments(dba_files):
+    """
+    Group dba files by segment. Merged dba files, and unmerged flight 
+    files without a science file, are their own segment; unmerged 
+    flight and science files (eg amlr08_2022_338_0_0_sbd.dat and 
+    amlr08_2022_338_0_0_tbd.dat) are a (flight, science) tuple. 
+    Science files without a flight file are not included
+
+    Args:
+        dba_files (list): dba file names or paths, possibly compressed
+
+    Returns:
+        list: segments, in the order of their (flight) files in dba_files
+    """
+    def split_name(dba_file):
+        # eg ('amlr08_2022_338_0_0', 'sbd') for amlr08_2022_338_0_0_sbd.dat.gz
+        name = dba_file
+        for i in dba_compression_ext.values():
+            if name.endswith(i):
+                name = name[:-len(i)]
+        stem, _ = os.path.splitext(name)
+        if '_' not in stem:
+            return stem, None
+        segment, dba_type = stem.rsplit('_', 1)
+        return segment, dba_type.lower()
+
+    science_types = set(dba_science_types.values())
+    science_files = {}
+    for i in dba_files:
+        segment, dba_type = split_name(i)
+        if dba_type in science_types:
+            science_files[(segment, dba_type)] = i
+
+    segments = []
+    for i in dba_files:
+        segment, dba_type = split_name(i)
+        if dba_type in science_types:
+            continue
+        science_file = science_files.pop(
+            (segment, dba_science_types.get(dba_type)), None)
+        segments.append(i if science_file is None else (i, science_file))
+
+    if len(science_files) > 0:
+        logger.warning(f'{len(science_files)} science dba files do not have ' + 
+                       'a flight dba file, and are not read')
+    return segments
+
+
+def amlr_dba_merge(flight, science, 
+                   flight_time='m_present_time', 
+                   science_time='sci_m_present_time'):
+    """
+    Merge flight (eg sbd) and science (eg tbd) dba data, 
+    as done by dba_merge, but in memory on already-parsed data.
+    
+    The merged data contain all flight and science columns, 
+    and are sorted by time. Science rows with a timestamp equal to a 
+    flight row timestamp are merged into that flight row; 
+    all other science rows are added as their own rows, 
+    with missing (NaN) flight values other than flight_time, 
+    which is the science timestamp. 
+    Science columns that are also flight columns are named sci_dup_{name}
+
+    Args:
+        flight (DataFrame): flight controller dba data, eg from read_dba
+        science (DataFrame): science controller dba data
+        flight_time (str, optional): flight timestamp column. 
+            Defaults to 'm_present_time'.
+        science_time (str, optional): science timestamp column. 
+            Defaults to 'sci_m_present_time'.
+
+    Returns:
+        DataFrame: merged dba data
+    """
+    import numpy as np
+    import pandas as pd
+
+    flight = flight.sort_values(flight_time, kind='stable')
+    science = science.sort_values(science_time, kind='stable')
+    t_f = flight[flight_time].to_numpy()
+    t_s = science[science_time].to_numpy()
+    n_f = len(t_f)
+
+    # Exact timestamp matches, via searchsorted on the sorted flight times
+    pos = np.searchsorted(t_f, t_s, side='left')
+    pos_clip = np.minimum(pos, max(n_f - 1, 0))
+    is_match = (pos < n_f) & (t_f[pos_clip] == t_s) if n_f > 0 \
+        else np.zeros(len(t_s), dtype=bool)
+    # Only the first science row for each flight row is merged
+    match_idx = np.flatnonzero(is_match)
+    _, match_first = np.unique(pos[match_idx], return_index=True)
+    is_match = np.zeros(len(t_s), dtype=bool)
+    is_match[match_idx[match_first]] = True
+    n_extra = (~is_match).sum()
+
+    # Row order: flight rows, then unmatched science rows, sorted by time
+    t_all = np.concatenate([t_f, t_s[~is_match]])
+    order = np.argsort(t_all, kind='stable')
+    n_all = len(t_all)
+
+    columns = {}
+    for col in flight.columns:
+        x = np.full(n_all, np.nan)
+        x[:n_f] = flight[col].to_numpy()
+        columns[col] = x
+    match_rows = pos[is_match]
+    for col in science.columns:
+        y = science[col].to_numpy()
+        x = np.full(n_all, np.nan)
+        x[match_rows] = y[is_match]
+        x[n_f:] = y[~is_match]
+        # As with dba_merge, science columns also in flight are renamed
+        columns[f'sci_dup_{col}' if col in columns else col] = x
+    # As with dba_merge, science-only rows are timestamped by the science time
+    if flight_time in columns:
+        columns[flight_time][n_f:] = t_s[~is_match]
+
+    logger.debug(f'Merged {n_f} flight rows and {len(t_s)} science rows, ' + 
+                 f'{len(t_s) - n_extra} of which matched flight timestamps')
+
+    merged = pd.DataFrame(columns).iloc[order].reset_index(drop=True)
+    # The header is that of the flight file, and the label lines are 
+    #   those of the flight and then the science columns, as with dba_merge
+    merged.attrs['dba_header'] = dict(flight.attrs.get('dba_header', {}))
+    for i in ['dba_units', 'dba_bytes']:
+        if i in flight.attrs and i in science.attrs:
+            merged.attrs[i] = flight.attrs[i] + science.attrs[i]
+    return merged
+
+
+def lz4_block_decompress(src):
+    """
+    Decompress a single LZ4 block (no frame header)
+    https://github.com/lz4/lz4/blob/dev/doc/lz4_Block_format.md
+
+    Args:
+        src (bytes): LZ4-compressed block
+
+    Returns:
+        bytes: decompressed block
+    """
+
+    out = bytearray()
+    pos = 0
+    n_src = len(src)
+    while pos < n_src:
+        token = src[pos]
+        pos += 1
+
+        # Literals
+        n_lit = token >> 4
+        if n_lit == 15:
+            while True:
+                b = src[pos]
+                pos += 1
+                n_lit += b
+                if b != 255:
+                    break
+        out += src[pos:pos+n_lit]
+        pos += n_lit
+        if pos >= n_src:
+            # The last sequence only contains literals
+            break
+
+        # Match
+        offset = src[pos] | (src[pos+1] << 8)
+        pos += 2
+        if offset == 0 or offset > len(out):
+            raise ValueError('Invalid LZ4 match offset')
+        n_match = token & 15
+        if n_match == 15:
+            while True:
+                b = src[pos]
+                pos += 1
+                n_match += b
+                if b != 255:
+                    break
+        n_match += 4
+
+        start = len(out) - offset
+        if n_match <= offset:
+            out += out[start:start+n_match]
+        else:
+            # Overlapping match: repeat the last offset bytes
+            pattern = bytes(out[start:])
+            reps, rem = divmod(n_match, offset)
+            out += pattern * reps + pattern[:rem]
+
+    return bytes(out)
+
+
+def slocum_decompressed_name(filename):
+    """
+    Get the standard file name for a compressed Slocum file name,
+    eg 01230045.scd to 01230045.sbd, or abcd1234.ccc to abcd1234.cac.
+    The case of the extension is preserved
+
+    Args:
+        filename (str): compressed file name or path
+
+    Returns:
+        str: decompressed file name, or None if not a compressed file
+    """
+
+    root, ext = os.path.splitext(filename)
+    ext_new = slocum_compressed_ext.get(ext.lower())
+    if ext_new is None:
+        return
+
+    if ext.isupper():
+        ext_new = ext_new.upper()
+    return f'{root}{ext_new}'
+
+
+def slocum_decompress(in_file, out_path):
+    """
+    Decompress a compressed Slocum file (eg .scd, .tcd, .dcd, .ecd, .ccc).
+    These files are a series of LZ4 blocks, 
+    each preceded by its size as a two-byte big-endian integer
+
+    Args:
+        in_file (str): path to compressed file
+        out_path (str): directory to which to write the decompressed file
+
+    Returns:
+        str: path to decompressed file, or None if decompression failed
+    """
+
+    out_file = os.path.join(
+        out_path, os.path.basename(slocum_decompressed_name(in_file)))
+
+    try:
+        with open(in_file, 'rb') as f:
+            data = f.read()
+
+        out = bytearray()
+        pos = 0
+        while pos + 2 <= len(data):
+            n = int.from_bytes(data[pos:pos+2], 'big')
+            pos += 2
+            out += lz4_block_decompress(data[pos:pos+n])
+            pos += n
+    except (OSError, ValueError, IndexError) as e:
+        logger.error(f'Unable to decompress {in_file}: {e}')
+        return
+
+    with open(out_file, 'wb') as f:
+        f.write(out)
+
+    return out_file
+
+
+def slocum_binary_cac(binary_file, storage=None):
+    """
+    Get the name of the cac file needed to read a Slocum binary file, 
+    from the sensor_list_crc tag of its ascii header, eg 'abcd1234.cac'. 
+    For compressed binary files (eg .scd), only the first LZ4 block, 
+    which contains the header, is decompressed
+
+    Args:
+        binary_file (str): path to binary file, eg .sbd or .scd
+        storage (Storage, optional): storage backend of binary_file, 
+            from which only the start of the file is read. 
+            Defaults to None, meaning a local file.
+
+    Returns:
+        str: cac file name, or None if it could not be read
+    """
+
+    remote = storage is not None and not storage.is_local
+    try:
+        with (storage.open(binary_file, 'rb') if remote 
+              else open(binary_file, 'rb')) as f:
+            if slocum_decompressed_name(binary_file) is not None:
+                n = int.from_bytes(f.read(2), 'big')
+                data = lz4_block_decompress(f.read(n))
+            else:
+                data = f.read(4096)
+    except (OSError, ValueError, IndexError) as e:
+        logger.debug(f'Unable to read the header of {binary_file}: {e}')
+        return
+
+    for line in data.decode('latin-1').split('\n'):
+        key, sep, value = line.partition(':')
+        if sep == '':
+            break
+        if key.strip() == 'sensor_list_crc':
+            return f'{value.strip().lower()}.cac'
+
+    logger.debug(f'{binary_file} does not have a sensor_list_crc tag')
+    return
+
+
+def amlr_decompress_files(in_path, out_path, numcores=1, clobber=False, 
+                          pool=None):
+    """
+    Decompress all compressed Slocum files in in_path, 
+    and write the standard files to out_path. 
+    Files that have already been decompressed are skipped, 
+    unless clobber is True
+
+    Args:
+        in_path (str): path to directory with compressed files
+        out_path (str): path to directory to write decompressed files
+        numcores (int, optional): number of cores to use. Defaults to 1.
+        clobber (bool, optional): should existing decompressed files be 
+            clobbered? Defaults to False.
+        pool (mp.Pool, optional): existing worker pool to use, 
+            rather than creating one. Defaults to None.
+
+    Returns:
+        list: paths of decompressed files that were written
+    """
+
+    files_list = sorted(
+        i for i in os.listdir(in_path) 
+        if slocum_decompressed_name(i) is not None
+    )
+    if not clobber:
+        files_list = [
+            i for i in files_list
+            if not os.path.exists(
+                os.path.join(out_path, slocum_decompressed_name(i)))
+        ]
+
+    if len(files_list) == 0:
+        logger.info(f'No compressed files to decompress in {in_path}')
+        return []
+
+    files_list = [os.path.join(in_path, i) for i in files_list]
+    logger.info(f'Decompressing {len(files_list)} compressed files ' + 
+                f'using {numcores} core(s)')
+    if pool is not None:
+        out_files = pool.starmap(
+            slocum_decompress, zip(files_list, repeat(out_path)))
+    elif numcores > 1:
+        with amlr_pool(numcores) as pool:
+            out_files = pool.starmap(
+                slocum_decompress, zip(files_list, repeat(out_path)))
+    else:
+        out_files = [slocum_decompress(i, out_path) for i in files_list]
+
+    out_files = [i for i in out_files if i is not None]
+    logger.info(f'Decompressed {len(out_files)} of {len(files_list)} files ' + 
+                f'to {out_path}')
+
+    return out_files
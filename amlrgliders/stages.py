@@ -0,0 +1,273 @@
+"""
+Stage dependency graph and content fingerprints, for make-style
+reprocessing: a stage is rerun only if the fingerprint of its inputs
+(eg binary files, cac files, configs, code version, and the fingerprints
+of its upstream stages) differs from that of its last successful run
+"""
+
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime, timezone
+from importlib.metadata import version, PackageNotFoundError
+
+from amlrgliders.storage import LocalStorage, file_md5
+from amlrgliders.slocum import (slocum_binary_cac, slocum_compressed_ext, 
+                                slocum_decompressed_name)
+
+logger = logging.getLogger(__name__)
+
+
+# Stages, in the order in which they are run
+amlr_process_stages = [
+    'binary_to_dba', 'gdm', 'trajectory', 'ngdac', 'ragged', 'acoustics', 'imagery'
+]
+
+# The upstream stages of each stage
+amlr_stage_deps = {
+    'binary_to_dba': [],
+    'gdm': ['binary_to_dba'],
+    'trajectory': ['gdm'],
+    'ngdac': ['gdm'],
+    'ragged': ['gdm'],
+    'acoustics': ['gdm'],
+    'imagery': ['gdm'],
+}
+
+
+# Extensions of Slocum binary files, including compressed binary files
+amlr_binary_ext = [
+    i for k, v in slocum_compressed_ext.items() if v != '.cac' for i in (k, v)
+]
+
+
+def code_version():
+    """
+    Get the installed versions of amlr-gliders and gdm
+    """
+    versions = {}
+    for i in ['amlr-gliders', 'gdm']:
+        try:
+            versions[i] = version(i)
+        except PackageNotFoundError:
+            versions[i] = None
+    return versions
+
+
+def fingerprint(*parts):
+    """
+    Get the sha256 hex digest of JSON-serializable parts
+    """
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def amlr_stage_ancestors(stage):
+    """
+    Get all upstream stages of stage, in run order
+    """
+    ancestors = set()
+    to_visit = list(amlr_stage_deps[stage])
+    while to_visit:
+        i = to_visit.pop()
+        if i not in ancestors:
+            ancestors.add(i)
+            to_visit.extend(amlr_stage_deps[i])
+    return [i for i in amlr_process_stages if i in ancestors]
+
+
+class StageState:
+    """
+    Persisted fingerprints of successfully completed stages,
+    for one deployment and mode, stored as a JSON file via storage.
+    Also caches the checksums of local files by size and modification time,
+    and the cac file names of binary files by size and checksum, 
+    so that unchanged files are not read again to fingerprint them
+
+    Args:
+        state_file (str): path to the JSON state file
+        storage (Storage, optional): storage backend for state_file.
+            Defaults to None, meaning LocalStorage
+    """
+
+    def __init__(self, state_file, storage=None):
+        self.state_file = state_file
+        self.storage = storage if storage is not None else LocalStorage()
+        self.stages = {}
+        self.checksums = {}
+        self.cacs = {}
+        if self.storage.exists(state_file):
+            with self.storage.open(state_file, 'r') as f:
+                state = json.load(f)
+            self.stages = state.get('stages', {})
+            self.checksums = state.get('checksums', {})
+            self.cacs = state.get('cacs', {})
+
+    def save(self):
+        with self.storage.open(self.state_file, 'w') as f:
+            json.dump({'stages': self.stages, 'checksums': self.checksums, 
+                       'cacs': self.cacs}, f, indent=2, sort_keys=True)
+
+    def fingerprint(self, stage):
+        return self.stages.get(stage, {}).get('fingerprint')
+
+    def set_complete(self, stage, stage_fingerprint):
+        """
+        Record the fingerprint of a successfully completed stage, and save
+        """
+        self.stages[stage] = {
+            'fingerprint': stage_fingerprint,
+            'completed': datetime.now(timezone.utc).isoformat(timespec='seconds')
+        }
+        self.save()
+
+    def local_stats(self, path):
+        """
+        Get (name, size, md5) of the files directly within local path,
+        reusing cached checksums of files whose size and mtime are unchanged
+        """
+        stats = []
+        for i in LocalStorage().walk_files(path, recursive=False):
+            file = os.path.join(path, i)
+            st = os.stat(file)
+            cached = self.checksums.get(file)
+            if cached is None or cached[:2] != [st.st_size, st.st_mtime]:
+                cached = [st.st_size, st.st_mtime, file_md5(file)]
+                self.checksums[file] = cached
+            stats.append((i, cached[0], cached[2]))
+        return stats
+
+    def binary_cacs(self, storage, path, stats):
+        """
+        Get the names of the cac files referenced by the binary files 
+        in path, given their (name, size, md5) stats. 
+        Only the headers of new or changed binary files are read
+        """
+        cacs = set()
+        for name, size, md5 in stats:
+            if os.path.splitext(name)[1].lower() not in amlr_binary_ext:
+                continue
+            file = os.path.join(path, name)
+            cached = self.cacs.get(file)
+            if cached is None or cached[:2] != [size, md5]:
+                cached = [size, md5, slocum_binary_cac(file, storage)]
+                self.cacs[file] = cached
+            if cached[2] is not None:
+                cacs.add(cached[2])
+        return cacs
+
+
+def amlr_stage_inputs(stage, storage, state, paths, params):
+    """
+    Get the inputs of stage, not including upstream stages, to fingerprint
+
+    Args:
+        stage (str): stage name
+        storage (Storage): storage backend for paths
+        state (StageState): stage state, for cached local checksums
+        paths (dict): 'binary', 'cache', and 'config' paths,
+            and optionally 'imagery_files', the list of imagery file names
+        params (dict): stage parameters that affect outputs,
+            eg {'binary_to_dba': {'sensor_filter': True}}
+
+    Returns:
+        dict: JSON-serializable inputs
+    """
+    def stats(path):
+        if not storage.isdir(path):
+            return []
+        if storage.is_local:
+            return state.local_stats(path)
+        return storage.walk_stats(path, recursive=False)
+
+    inputs = {'code': code_version(), 'params': params.get(stage, {})}
+    if stage == 'binary_to_dba':
+        inputs['binary'] = stats(paths['binary'])
+        # Only the cac files referenced by the binary files, 
+        #   whose names are derived from their contents, are inputs. 
+        #   Names are those after decompression and cac2lower
+        cacs = state.binary_cacs(storage, paths['binary'], inputs['binary'])
+        cache = storage.walk_files(paths['cache'], recursive=False) \
+            if storage.isdir(paths['cache']) else []
+        inputs['cache'] = sorted(
+            {(slocum_decompressed_name(i) or i).lower() for i in cache} & cacs)
+        # Only the sensor filter depends on a config file
+        if inputs['params'].get('sensor_filter'):
+            inputs['sensor_defs'] = [
+                i for i in stats(paths['config']) if i[0] == 'sensor_defs.yml'
+            ]
+    elif stage in ['trajectory', 'ngdac', 'ragged']:
+        inputs['config'] = stats(paths['config'])
+    elif stage == 'imagery':
+        inputs['imagery'] = paths.get('imagery_files')
+
+    return inputs
+
+
+def amlr_stage_fingerprints(stages, storage, state, paths, params):
+    """
+    Get the fingerprints of stages, from their inputs 
+    and the fingerprints of their upstream stages
+
+    Args:
+        stages (list): stages, in run order, including their upstream stages
+        storage (Storage): storage backend for paths
+        state (StageState): stage state, for cached local checksums
+        paths (dict): paths, see amlr_stage_inputs
+        params (dict): stage parameters, see amlr_stage_inputs
+
+    Returns:
+        dict: fingerprints, keyed by stage
+    """
+    fingerprints = {}
+    for i in stages:
+        inputs = amlr_stage_inputs(i, storage, state, paths, params)
+        fingerprints[i] = fingerprint(
+            inputs, [fingerprints[j] for j in amlr_stage_deps[i]])
+    return fingerprints
+
+
+def amlr_stage_plan(targets, storage, state, paths, params, force=False,
+                    outputs_ok=None):
+    """
+    Determine which stages to run: the targets and their upstream stages
+    whose fingerprints have changed, plus all stages downstream of them
+
+    Args:
+        targets (list): requested stages
+        storage (Storage): storage backend for paths
+        state (StageState): persisted stage state
+        paths (dict): paths, see amlr_stage_inputs
+        params (dict): stage parameters, see amlr_stage_inputs
+        force (bool, optional): run all targets, regardless of fingerprints.
+            Defaults to False.
+        outputs_ok (dict, optional): stage name to bool; if False, the
+            stage is run even if its fingerprint is unchanged,
+            eg because its outputs are missing. Defaults to None.
+
+    Returns:
+        Tuple of the list of stages to run, in run order,
+        and dict of fingerprints of all considered stages
+    """
+    outputs_ok = outputs_ok or {}
+    considered = set(targets)
+    for i in targets:
+        considered.update(amlr_stage_ancestors(i))
+    considered = [i for i in amlr_process_stages if i in considered]
+
+    fingerprints = amlr_stage_fingerprints(considered, storage, state, paths, params)
+    stale = set()
+    for i in considered:
+        upstream_stale = any(j in stale for j in amlr_stage_deps[i])
+        if (force and i in targets) or upstream_stale or \
+                not outputs_ok.get(i, True) or \
+                state.fingerprint(i) != fingerprints[i]:
+            stale.add(i)
+
+    to_run = [i for i in considered if i in stale]
+    for i in considered:
+        status = 'stale' if i in stale else 'up to date'
+        logger.info(f'Stage {i}: {status}')
+
+    return to_run, fingerprints
@@ -0,0 +1,167 @@
+"""
+Local staging of output files, with parallel batched upload
+to their destination, eg a gcsfuse-mounted bucket
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from amlrgliders.storage import LocalStorage, file_md5
+
+logger = logging.getLogger(__name__)
+
+
+class OutputStager:
+    """
+    Write output files to local disk first, then copy them to out_path
+    in parallel batches, and verify the copies by file size.
+    Writing many small files directly to a gcsfuse mount costs several
+    round-trips per file; staging moves those round-trips into
+    concurrent copies.
+
+    Use as a context manager. Files are uploaded on exit, unless an
+    error was raised, so that partially written files do not replace
+    good copies in out_path (verification only compares sizes);
+    files uploaded within the context are kept.
+    upload can also be called within the context, eg every N files,
+    to upload the files staged so far and remove their local copies.
+    The scratch directory is then removed, and the names, sizes, and
+    md5 checksums of the uploaded files are available in stager.uploaded,
+    eg for recording in the deployment catalog, and the names of files
+    that could not be uploaded in stager.failed.
+
+        with OutputStager(nc_path) as stager:
+            ds.to_netcdf(stager.path('file.nc'))
+
+    Args:
+        out_path (str): destination directory. Created if necessary
+        scratch_path (str, optional): directory in which to make the
+            staging directory. Defaults to None,
+            meaning $TMPDIR (or the system default temporary directory)
+        max_workers (int, optional): number of upload threads.
+            Defaults to 16.
+        batch_size (int, optional): number of files per upload batch.
+            Defaults to 256.
+        storage (Storage, optional): storage backend to which to upload
+            files. Defaults to None, meaning LocalStorage
+    """
+
+    def __init__(self, out_path, scratch_path=None, max_workers=16,
+                 batch_size=256, storage=None):
+        self.out_path = out_path
+        self.storage = storage if storage is not None else LocalStorage()
+        self.scratch_path = scratch_path
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.tmp_path = None
+        self.files = []
+        self.uploaded = []
+        self.failed = []
+
+    def __enter__(self):
+        self.tmp_path = tempfile.mkdtemp(
+            prefix='amlr-staging-', dir=self.scratch_path)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.upload()
+            else:
+                self.failed = list(dict.fromkeys(self.files))
+                logger.error(f'Not uploading {len(self.failed)} staged files ' +
+                             f'to {self.out_path}, because of an error')
+        finally:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def path(self, name):
+        """
+        Get the local staging path for output file name
+
+        Args:
+            name (str): output file name, relative to out_path
+
+        Returns:
+            str: local path to which to write the file
+        """
+        self.files.append(name)
+        local_file = os.path.join(self.tmp_path, name)
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        return local_file
+
+    def _upload_one(self, name):
+        self.storage.put(
+            os.path.join(self.tmp_path, name), os.path.join(self.out_path, name))
+        return name
+
+    def _verify(self, name):
+        local_file = os.path.join(self.tmp_path, name)
+        out_file = os.path.join(self.out_path, name)
+        return self.storage.size(out_file) == os.path.getsize(local_file)
+
+    def upload(self):
+        """
+        Copy all staged files that were written, and not yet uploaded, 
+        to out_path, in parallel batches, and verify them. 
+        Failed copies are retried once. 
+        Local copies of uploaded files are removed
+
+        Returns:
+            list: paths of files in out_path that were uploaded and verified
+        """
+        names = [
+            i for i in dict.fromkeys(self.files)
+            if os.path.isfile(os.path.join(self.tmp_path, i))
+        ]
+        self.files = []
+        self.failed = []
+        if len(names) == 0:
+            return []
+
+        if not self.storage.exists(self.out_path):
+            logger.info(f'Creating directory at: {self.out_path}')
+            self.storage.makedirs(self.out_path)
+
+        logger.info(f'Uploading {len(names)} staged files to {self.out_path}')
+        t_start = time.perf_counter()
+        to_upload = names
+        for attempt in range(2):
+            with ThreadPoolExecutor(self.max_workers) as executor:
+                for k in range(0, len(to_upload), self.batch_size):
+                    batch = to_upload[k:(k+self.batch_size)]
+                    for i, future in zip(batch, [executor.submit(self._upload_one, i)
+                                                 for i in batch]):
+                        try:
+                            future.result()
+                        except Exception as e:
+                            logger.debug(f'Error uploading {i}: {e}')
+
+                verified = list(executor.map(self._verify, to_upload))
+
+            to_upload = [i for i, ok in zip(to_upload, verified) if not ok]
+            if len(to_upload) == 0:
+                break
+            logger.warning(f'{len(to_upload)} staged files failed verification' +
+                           (', retrying' if attempt == 0 else ''))
+
+        if len(to_upload) > 0:
+            logger.error(f'{len(to_upload)} files could not be uploaded to ' +
+                         f"{self.out_path}: {', '.join(to_upload)}")
+        failed = set(to_upload)
+        uploaded = [i for i in names if i not in failed]
+        for i in uploaded:
+            local_file = os.path.join(self.tmp_path, i)
+            self.uploaded.append(
+                (i, os.path.getsize(local_file), file_md5(local_file)))
+            os.remove(local_file)
+        # Failed files stay staged, to be retried by the next upload
+        self.files = to_upload
+        self.failed = list(to_upload)
+        logger.info(f'Uploaded and verified {len(uploaded)} files in ' +
+                    f'{time.perf_counter() - t_start:.1f} seconds')
+
+        return [os.path.join(self.out_path, i) for i in uploaded]
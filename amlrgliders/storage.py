@@ -0,0 +1,526 @@
+"""
+Storage backends for pipeline I/O: a local directory backend,
+and a native Google Cloud Storage (GCS) backend that avoids gcsfuse.
+
+Both backends are addressed with the same paths the pipeline already uses,
+eg os.path.join(deployments_path, project, year, deployment, ...).
+The GCS backend maps paths under mount_path to object names in its bucket,
+so that deployments_path can be the (unmounted) gcsfuse mount path.
+"""
+
+import os
+import base64
+import shutil
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(OSError):
+    """
+    Raised by upload_dir when some files could not be uploaded
+
+    Args:
+        message (str): error message
+        uploaded (list): paths of files that were uploaded
+        failed (list): paths of files that could not be uploaded
+    """
+
+    def __init__(self, message, uploaded, failed):
+        super().__init__(message)
+        self.uploaded = uploaded
+        self.failed = failed
+
+
+class Storage(ABC):
+    """
+    Abstract base class for storage backends, with parallel batch operations.
+    Backends implement the abstract methods: list, walk_files, walk_stats, 
+    exists, isdir, size, open, get, put, move, remove, makedirs, 
+    and the conditional get_generation and put_if_generation.
+    Batch operations return one result per item, with None for errors
+
+    Args:
+        max_workers (int, optional): number of threads for batch operations.
+            Defaults to 16.
+    """
+
+    is_local = False
+
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+
+    @abstractmethod
+    def list(self, path):
+        """
+        List the names directly within path
+        """
+
+    @abstractmethod
+    def walk_files(self, path, recursive=True):
+        """
+        List the paths of files under path, relative to path
+        """
+
+    @abstractmethod
+    def walk_stats(self, path, recursive=True, checksum=True):
+        """
+        List (relative path, size, md5 hex digest) of files under path.
+        The md5 is None if checksum is False
+        """
+
+    @abstractmethod
+    def exists(self, path):
+        pass
+
+    @abstractmethod
+    def isdir(self, path):
+        pass
+
+    @abstractmethod
+    def size(self, path):
+        pass
+
+    @abstractmethod
+    def open(self, path, mode='rb'):
+        """
+        Open path as a file object
+        """
+
+    @abstractmethod
+    def get(self, path, local_file):
+        """
+        Download path to local_file, and return local_file
+        """
+
+    @abstractmethod
+    def put(self, local_file, path):
+        """
+        Upload local_file to path, and return path
+        """
+
+    @abstractmethod
+    def move(self, src, dst):
+        """
+        Move (rename) src to dst, and return dst
+        """
+
+    @abstractmethod
+    def remove(self, path):
+        pass
+
+    @abstractmethod
+    def makedirs(self, path):
+        pass
+
+    def _map(self, fn, args_list):
+        """
+        Call fn(*args) for each args in args_list using a thread pool.
+        Returns a list of results, with None for calls that raised an error
+        """
+        def fn_safe(args):
+            try:
+                return fn(*args)
+            except Exception as e:
+                logger.error(f'Error in {fn.__name__}{args}: {e}')
+                return None
+
+        args_list = list(args_list)
+        if len(args_list) == 0:
+            return []
+        with ThreadPoolExecutor(min(self.max_workers, len(args_list))) as executor:
+            return list(executor.map(fn_safe, args_list))
+
+    def get_many(self, pairs):
+        """
+        Download (path, local_file) pairs in parallel
+        """
+        return self._map(self.get, pairs)
+
+    def put_many(self, pairs):
+        """
+        Upload (local_file, path) pairs in parallel
+        """
+        return self._map(self.put, pairs)
+
+    def move_many(self, pairs):
+        """
+        Move (src, dst) pairs in parallel
+        """
+        return self._map(self.move, pairs)
+
+    def remove_many(self, paths):
+        """
+        Remove paths in parallel
+        """
+        return self._map(self.remove, [(i,) for i in paths])
+
+    def download_dir(self, path, local_path):
+        """
+        Download the files directly within path to local_path
+
+        Returns:
+            list: local paths of downloaded files
+        """
+        os.makedirs(local_path, exist_ok=True)
+        files = self.walk_files(path, recursive=False)
+        self.get_many(
+            (os.path.join(path, i), os.path.join(local_path, i)) for i in files)
+        return [os.path.join(local_path, i) for i in files]
+
+    @abstractmethod
+    def get_generation(self, path, local_file):
+        """
+        Download path to local_file, for a later put_if_generation
+
+        Returns:
+            generation of the downloaded file, or None if path does not exist
+            (and nothing was downloaded)
+        """
+
+    @abstractmethod
+    def put_if_generation(self, local_file, path, generation):
+        """
+        Upload local_file to path, only if path is still at generation
+        (from get_generation); if generation is None, path must not exist
+
+        Returns:
+            bool: True if uploaded, or False if path was changed by another
+            writer, and nothing was uploaded
+        """
+
+    def upload_dir(self, local_path, path, clobber=False):
+        """
+        Upload the files directly within local_path to path, like rsync:
+        files that already exist in path with the same size are skipped,
+        unless clobber is True
+
+        Returns:
+            list: paths of uploaded files
+
+        Raises:
+            UploadError: if any file could not be uploaded; the other files
+                are still uploaded
+        """
+        files = sorted(
+            i for i in os.listdir(local_path)
+            if os.path.isfile(os.path.join(local_path, i))
+        )
+        if not clobber:
+            existing = self._map(
+                lambda i: self.size(os.path.join(path, i)), [(i,) for i in files])
+            files = [
+                i for i, n in zip(files, existing)
+                if n != os.path.getsize(os.path.join(local_path, i))
+            ]
+
+        self.makedirs(path)
+        out = self.put_many(
+            (os.path.join(local_path, i), os.path.join(path, i)) for i in files)
+        uploaded = [os.path.join(path, i) for i, j in zip(files, out) if j is not None]
+        failed = [os.path.join(path, i) for i, j in zip(files, out) if j is None]
+        if len(failed) > 0:
+            raise UploadError(
+                f'Unable to upload {len(failed)} of {len(files)} files ' + 
+                f'from {local_path} to {path}', uploaded, failed)
+        return uploaded
+
+
+def file_md5(file):
+    """
+    Get the hex md5 checksum of a local file
+    """
+    md5 = hashlib.md5()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class LocalStorage(Storage):
+    """
+    Storage backend for local (or gcsfuse-mounted) directories.
+    Paths are used as-is
+    """
+
+    is_local = True
+
+    def list(self, path):
+        return sorted(os.listdir(path))
+
+    def walk_files(self, path, recursive=True):
+        if not recursive:
+            return sorted(
+                i for i in os.listdir(path)
+                if os.path.isfile(os.path.join(path, i))
+            )
+        files = []
+        for root, _, names in os.walk(path):
+            files.extend(
+                os.path.relpath(os.path.join(root, i), path) for i in names)
+        return sorted(files)
+
+    def walk_stats(self, path, recursive=True, checksum=True):
+        # Checksums require reading each file
+        return [
+            (i, os.path.getsize(os.path.join(path, i)),
+             file_md5(os.path.join(path, i)) if checksum else None)
+            for i in self.walk_files(path, recursive)
+        ]
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def size(self, path):
+        return os.path.getsize(path) if os.path.isfile(path) else None
+
+    def open(self, path, mode='rb'):
+        if any(i in mode for i in 'wa'):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, mode)
+
+    def get(self, path, local_file):
+        shutil.copyfile(path, local_file)
+        return local_file
+
+    def put(self, local_file, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(local_file, path)
+        return path
+
+    def move(self, src, dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.move(src, dst)
+        return dst
+
+    def remove(self, path):
+        os.remove(path)
+
+    def makedirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def _generation(path):
+        # A replaced file has a new inode and modification time
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get_generation(self, path, local_file):
+        with self._path_lock(path):
+            generation = self._generation(path)
+            if generation is not None:
+                shutil.copyfile(path, local_file)
+        return generation
+
+    def put_if_generation(self, local_file, path, generation):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.copyfile(local_file, tmp_file)
+        try:
+            with self._path_lock(path):
+                if self._generation(path) != generation:
+                    return False
+                os.replace(tmp_file, path)
+                return True
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    @contextmanager
+    def _path_lock(self, path):
+        # Lock file next to path, for other processes on this host
+        #   (flock is not shared across hosts through gcsfuse)
+        import fcntl
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class GCSStorage(Storage):
+    """
+    Native GCS storage backend, using one google.cloud.storage client
+    (and thus connection pool) for all operations.
+    Paths under mount_path are mapped to object names in bucket_name,
+    eg '{mount_path}/FREEBYRD/2022-23' to 'FREEBYRD/2022-23'
+
+    Args:
+        bucket_name (str): GCS bucket name
+        mount_path (str, optional): local path corresponding to the
+            bucket root, eg the gcsfuse mount path. Defaults to ''.
+        project (str, optional): GCP project ID. Defaults to None.
+        max_workers (int, optional): number of threads for batch operations.
+            Defaults to 16.
+    """
+
+    def __init__(self, bucket_name, mount_path='', project=None, max_workers=16):
+        super().__init__(max_workers)
+        self.bucket_name = bucket_name
+        self.mount_path = mount_path
+        self.project = project
+        self._client = None
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        # Create the client once, on first use, and share it across threads
+        with self._lock:
+            if self._bucket is None:
+                # Local import, so google-cloud-storage is only required
+                #   when this backend is used
+                from google.cloud import storage
+                self._client = storage.Client(project=self.project)
+                # Size the connection pool to the number of threads;
+                #   the requests default (10) serializes larger batches
+                from requests.adapters import HTTPAdapter
+                adapter = HTTPAdapter(
+                    pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                self._client._http.mount('https://', adapter)
+                self._bucket = self._client.bucket(self.bucket_name)
+        return self._bucket
+
+    def _key(self, path):
+        if path.startswith(f'gs://{self.bucket_name}'):
+            key = path[len(f'gs://{self.bucket_name}'):]
+        else:
+            key = os.path.relpath(path, self.mount_path or os.sep)
+            if key.startswith('..'):
+                raise ValueError(f'{path} is not within {self.mount_path}')
+            key = key.replace(os.sep, '/')
+        key = key.strip('/')
+        return '' if key == '.' else key
+
+    def _prefix(self, path):
+        key = self._key(path)
+        return f'{key}/' if key else ''
+
+    def list(self, path):
+        prefix = self._prefix(path)
+        blobs = self.bucket.client.list_blobs(
+            self.bucket, prefix=prefix, delimiter='/')
+        names = [i.name[len(prefix):] for i in blobs if i.name != prefix]
+        # Prefixes are only populated once the iterator has been consumed
+        names.extend(i[len(prefix):].rstrip('/') for i in blobs.prefixes)
+        return sorted(names)
+
+    def walk_files(self, path, recursive=True):
+        prefix = self._prefix(path)
+        blobs = self.bucket.client.list_blobs(
+            self.bucket, prefix=prefix, delimiter=None if recursive else '/')
+        return sorted(
+            i.name[len(prefix):] for i in blobs
+            if i.name != prefix and not i.name.endswith('/')
+        )
+
+    def walk_stats(self, path, recursive=True, checksum=True):
+        # Sizes and md5 hashes are returned by the listing
+        prefix = self._prefix(path)
+        blobs = self.bucket.client.list_blobs(
+            self.bucket, prefix=prefix, delimiter=None if recursive else '/')
+        return sorted(
+            (i.name[len(prefix):], i.size,
+             base64.b64decode(i.md5_hash).hex() if checksum and i.md5_hash else None)
+            for i in blobs
+            if i.name != prefix and not i.name.endswith('/')
+        )
+
+    def exists(self, path):
+        return self.bucket.blob(self._key(path)).exists() or self.isdir(path)
+
+    def isdir(self, path):
+        prefix = self._prefix(path)
+        if prefix == '':
+            return self.bucket.exists()
+        blobs = self.bucket.client.list_blobs(
+            self.bucket, prefix=prefix, max_results=1)
+        return any(True for _ in blobs)
+
+    def size(self, path):
+        blob = self.bucket.get_blob(self._key(path))
+        return None if blob is None else blob.size
+
+    def open(self, path, mode='rb'):
+        return self.bucket.blob(self._key(path)).open(mode)
+
+    def get(self, path, local_file):
+        self.bucket.blob(self._key(path)).download_to_filename(local_file)
+        return local_file
+
+    def put(self, local_file, path):
+        self.bucket.blob(self._key(path)).upload_from_filename(local_file)
+        return path
+
+    def move(self, src, dst):
+        blob = self.bucket.blob(self._key(src))
+        self.bucket.copy_blob(blob, self.bucket, self._key(dst))
+        blob.delete()
+        return dst
+
+    def remove(self, path):
+        self.bucket.blob(self._key(path)).delete()
+
+    def makedirs(self, path):
+        # GCS does not have directories; gcsfuse is run with --implicit-dirs
+        pass
+
+    def get_generation(self, path, local_file):
+        from google.api_core.exceptions import PreconditionFailed, NotFound
+        while True:
+            blob = self.bucket.get_blob(self._key(path))
+            if blob is None:
+                return None
+            try:
+                blob.download_to_filename(
+                    local_file, if_generation_match=blob.generation)
+                return blob.generation
+            except (PreconditionFailed, NotFound):
+                # Replaced during the download; get the new generation
+                continue
+
+    def put_if_generation(self, local_file, path, generation):
+        from google.api_core.exceptions import PreconditionFailed
+        # A generation of 0 means that the object must not exist
+        try:
+            self.bucket.blob(self._key(path)).upload_from_filename(
+                local_file, if_generation_match=generation or 0)
+        except PreconditionFailed:
+            return False
+        return True
+
+
+def amlr_storage(mount_path, bucket_name='', project=None):
+    """
+    Get the storage backend for pipeline I/O
+
+    Args:
+        mount_path (str): local path corresponding to the bucket root,
+            eg deployments_path
+        bucket_name (str, optional): GCS bucket name. If empty (the default),
+            a LocalStorage backend is returned, which reads and writes
+            directly to mount_path (eg through gcsfuse)
+        project (str, optional): GCP project ID. Defaults to None.
+
+    Returns:
+        Storage: LocalStorage or GCSStorage object
+    """
+    if bucket_name:
+        logger.info(f'Using GCS storage backend for bucket {bucket_name}, ' +
+                    f'mapped from {mount_path}')
+        return GCSStorage(bucket_name, mount_path, project)
+    else:
+        return LocalStorage()
@@ -0,0 +1,237 @@
+"""
+Synthetic glider deployments, for benchmarking (see scripts/amlr_benchmark.py).
+A synthetic deployment has the folder structure of a real deployment:
+merged dba files (as written by processDbds) of yo profiles, with the
+sensors that gdm needs plus filler sensors, data-config files from the
+config templates, and SoloCam image file names in Dir#### folders
+"""
+
+import os
+import logging
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from amlrgliders.utils import amlr_year_path
+from amlrgliders.slocum import amlr_dba_sensors_required
+
+logger = logging.getLogger(__name__)
+
+
+config_templates_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'resources', 'config-templates')
+
+# Units and bytes of the sensors with synthetic values;
+#   filler sensors are 'nodim', 4 bytes
+synthetic_sensor_units = {
+    'm_present_time': ('timestamp', 8), 'sci_m_present_time': ('timestamp', 8),
+    'm_lat': ('lat', 8), 'm_lon': ('lon', 8),
+    'm_gps_lat': ('lat', 8), 'm_gps_lon': ('lon', 8),
+    'm_depth': ('m', 4), 'm_pressure': ('bar', 4),
+    'm_pitch': ('rad', 4), 'm_roll': ('rad', 4), 'm_heading': ('rad', 4),
+    'sci_water_pressure': ('bar', 4), 'sci_water_cond': ('s/m', 4),
+    'sci_water_temp': ('degc', 4),
+}
+
+
+def decimal_to_ddmm(x):
+    """
+    Convert decimal degrees to the Slocum ddmm.mmmm format
+    """
+    degrees = np.trunc(x)
+    return degrees * 100 + (x - degrees) * 60
+
+
+def synthetic_dba_data(start_time, n_rows, sensors, rng, interval=4.0,
+                       max_depth=200.0, lat=-62.0, lon=-60.0):
+    """
+    Create the data of one dba file: yo profiles between the surface and
+    max_depth, at one row every interval seconds. GPS fixes are only
+    at the surface, and science sensors are sampled at every other row.
+    Filler sensors (not in synthetic_sensor_units) are mostly NaN,
+    as in merged dba files
+
+    Args:
+        start_time (float): m_present_time of the first row, in epoch seconds
+        n_rows (int): number of rows
+        sensors (list): sensor names, ie columns
+        rng (Generator): numpy random generator
+        interval (float, optional): seconds between rows. Defaults to 4.
+        max_depth (float, optional): maximum profile depth in meters.
+            Defaults to 200.
+        lat, lon (float, optional): approximate position in decimal degrees.
+            Defaults to the Antarctic Peninsula.
+
+    Returns:
+        DataFrame: dba data, with columns sensors
+    """
+    t = start_time + np.arange(n_rows) * interval
+    # Dive and climb at about 0.15 m/s
+    yo_rows = max(int(2 * max_depth / 0.15 / interval), 2)
+    phase = (np.arange(n_rows) % yo_rows) / yo_rows
+    depth = max_depth * (1 - np.abs(2 * phase - 1)) + rng.normal(0, 0.2, n_rows)
+    depth = np.clip(depth, 0, None)
+    climbing = phase >= 0.5
+
+    lat_dd = lat + np.cumsum(rng.normal(0, 1e-5, n_rows))
+    lon_dd = lon + np.cumsum(rng.normal(0, 1e-5, n_rows))
+    at_surface = depth < 0.5
+    science = np.arange(n_rows) % 2 == 0
+    temp = 2 - depth / max_depth * 3 + rng.normal(0, 0.01, n_rows)
+
+    values = {
+        'm_present_time': t,
+        'sci_m_present_time': np.where(science, t + rng.uniform(0, 1, n_rows), np.nan),
+        'm_lat': decimal_to_ddmm(lat_dd), 'm_lon': decimal_to_ddmm(lon_dd),
+        'm_gps_lat': np.where(at_surface, decimal_to_ddmm(lat_dd), np.nan),
+        'm_gps_lon': np.where(at_surface, decimal_to_ddmm(lon_dd), np.nan),
+        'm_depth': depth, 'm_pressure': depth / 10,
+        'm_pitch': np.radians(np.where(climbing, 26, -26) + rng.normal(0, 1, n_rows)),
+        'm_roll': np.radians(rng.normal(0, 2, n_rows)),
+        'm_heading': np.radians(rng.uniform(0, 360) + rng.normal(0, 5, n_rows)) % (2 * np.pi),
+        'sci_water_pressure': np.where(science, depth / 10, np.nan),
+        'sci_water_cond': np.where(science, 2.8 + temp * 0.06, np.nan),
+        'sci_water_temp': np.where(science, temp, np.nan),
+    }
+
+    data = {}
+    for i in sensors:
+        if i in values:
+            data[i] = values[i]
+        else:
+            filler = rng.normal(0, 1, n_rows)
+            filler[rng.uniform(0, 1, n_rows) > 0.1] = np.nan
+            data[i] = filler
+    return pd.DataFrame(data, columns=sensors)
+
+
+def write_synthetic_dba(dba_file, data, segment, mission='AMLR.MI'):
+    """
+    Write data as a merged dba file, with the header written by processDbds
+
+    Args:
+        dba_file (str): path of the dba file
+        data (DataFrame): dba data, eg from synthetic_dba_data
+        segment (str): segment file name, eg amlr08-2022-338-0-0
+        mission (str, optional): mission name. Defaults to 'AMLR.MI'.
+    """
+    open_time = dt.datetime.fromtimestamp(
+        data['m_present_time'].iloc[0], dt.timezone.utc)
+    units = [synthetic_sensor_units.get(i, ('nodim', 4)) for i in data.columns]
+    header = [
+        'dbd_label: DBD_ASC(dinkum_binary_data_ascii)file',
+        'encoding_ver: 2',
+        'num_ascii_tags: 14',
+        'all_sensors: 0',
+        f'filename: {segment}',
+        'the8x3_filename: 00000000',
+        'filename_extension: dbd',
+        f'filename_label: {segment}-dbd(00000000)',
+        f'mission_name: {mission}',
+        f"fileopen_time: {open_time.strftime('%a_%b_%d_%H:%M:%S_%Y')}",
+        f'sensors_per_cycle: {len(data.columns)}',
+        'num_label_lines: 3',
+        'num_segments: 1',
+        f'segment_filename_0: {segment}',
+        ' '.join(data.columns),
+        ' '.join(i[0] for i in units),
+        ' '.join(str(i[1]) for i in units),
+    ]
+    with open(dba_file, 'w') as f:
+        f.write(' \n'.join(header) + ' \n')
+        data.to_csv(f, sep=' ', header=False, index=False,
+                    na_rep='NaN', float_format='%.7g')
+
+
+def synthetic_deployment(deployments_path, project, deployment, mode='delayed',
+                         n_files=10, rows_per_file=5000, n_sensors=100,
+                         imagery_path=None, n_images=1000, seed=0,
+                         config_path=config_templates_path):
+    """
+    Create a synthetic deployment in deployments_path, with
+    n_files dba files of rows_per_file rows and n_sensors sensors,
+    data-config files from config_path, and (if imagery_path is given)
+    n_images SoloCam image files, which are empty
+
+    Args:
+        deployments_path (str): path to glider deployments directory
+        project (str): glider project name, eg FREEBYRD
+        deployment (str): deployment name, eg amlr08-20221205
+        mode (str, optional): deployment mode. Defaults to 'delayed'.
+        n_files (int, optional): number of dba files. Defaults to 10.
+        rows_per_file (int, optional): rows per dba file. Defaults to 5000.
+        n_sensors (int, optional): number of sensors in each dba file;
+            at least those in synthetic_sensor_units. Defaults to 100.
+        imagery_path (str, optional): path to imagery bucket, in which
+            images are written to gliders/year/deployment.
+            Defaults to None, meaning no images.
+        n_images (int, optional): number of images, spread over
+            the deployment. Defaults to 1000.
+        seed (int, optional): random seed. Defaults to 0.
+        config_path (str, optional): directory with config templates.
+            Defaults to the repository resources/config-templates.
+
+    Returns:
+        str: path to the deployment glider folder
+    """
+    rng = np.random.default_rng(seed)
+    glider, date_str = deployment.split('-')
+    year = amlr_year_path(project, [glider, date_str])
+    glider_path = os.path.join(deployments_path, project, year, deployment)
+    ascii_path = os.path.join(glider_path, 'data', 'ascii', mode)
+    config_out_path = os.path.join(glider_path, 'data', 'data-config')
+    os.makedirs(ascii_path, exist_ok=True)
+    os.makedirs(config_out_path, exist_ok=True)
+    os.makedirs(os.path.join(glider_path, 'data', 'tmp'), exist_ok=True)
+    os.makedirs(os.path.join(glider_path, 'scripts'), exist_ok=True)
+
+    # Config files, with the glider and deployment names filled in
+    for i in ['deployment.yml', 'global_attributes.yml', 'instruments.yml',
+              'sensor_defs.yml']:
+        with open(os.path.join(config_path, i), 'r') as f:
+            config = f.read()
+        if i == 'deployment.yml':
+            config = config.replace('amlr08-YYYYmmddThhmm', f'{deployment}T0000')
+            config = config.replace('amlr08', glider).replace('amlr06', glider)
+        with open(os.path.join(config_out_path, i), 'w') as f:
+            f.write(config)
+
+    # Sensors: required, then filler sensors named from sensor_defs
+    sensors = list(synthetic_sensor_units)
+    sensors.extend(i for i in amlr_dba_sensors_required if i not in sensors)
+    with open(os.path.join(config_path, 'sensor_defs.yml'), 'r') as f:
+        filler = [i.split(':')[0] for i in f if i[:1].isalpha()]
+    filler = [i for i in filler if i not in sensors]
+    filler.extend(f'x_synthetic_{k:04d}' for k in range(n_sensors))
+    sensors.extend(filler[:max(n_sensors - len(sensors), 0)])
+
+    start = dt.datetime.strptime(date_str, '%Y%m%d').replace(tzinfo=dt.timezone.utc)
+    interval = 4.0
+    logger.info(f'Writing {n_files} synthetic dba files of {rows_per_file} rows ' +
+                f'and {len(sensors)} sensors to {ascii_path}')
+    for k in range(n_files):
+        t0 = start.timestamp() + k * rows_per_file * interval
+        # Slocum segment names use the zero-based day of year
+        day = dt.datetime.fromtimestamp(t0, dt.timezone.utc).timetuple().tm_yday - 1
+        segment = f'{glider}-{start.year}-{day:03d}-0-{k}'
+        data = synthetic_dba_data(t0, rows_per_file, sensors, rng, interval)
+        ext = 'dbd' if mode == 'delayed' else 'sbd'
+        write_synthetic_dba(
+            os.path.join(ascii_path, f'{segment}_{ext}.dat'), data, segment)
+
+    if imagery_path is not None and n_images > 0:
+        deployment_seconds = n_files * rows_per_file * interval
+        img_times = start + pd.to_timedelta(
+            np.sort(rng.uniform(0, deployment_seconds, n_images)), unit='s')
+        images_path = os.path.join(imagery_path, 'gliders', year, deployment)
+        logger.info(f'Writing {n_images} synthetic image files to {images_path}')
+        # SoloCam writes up to 1000 images per Dir#### folder
+        for k, img_time in enumerate(img_times):
+            dir_path = os.path.join(images_path, f'Dir{k // 1000:04d}')
+            os.makedirs(dir_path, exist_ok=True)
+            img_name = f"SG01 {img_time.strftime('%Y%m%d-%H%M%S')}-{k % 1000:03d}.jpg"
+            open(os.path.join(dir_path, img_name), 'w').close()
+
+    return glider_path
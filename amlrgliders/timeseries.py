@@ -0,0 +1,136 @@
+"""
+Build the trajectory timeseries dataset directly from gdm.data, rather than
+with gdm.to_timeseries_dataset. Columns are mapped to nc variables using the
+nc_var_name, attrs, and dtype of the deployment sensor_defs.yml, only the
+requested variables are created, and the variables wrap the gdm.data
+column arrays rather than copies of them.
+
+The time coordinate, global attributes, and any variables that are not
+sensors (eg platform and instrument variables) are those of gdm: they are
+taken from the gdm dataset of only the timeseries_template_columns
+"""
+
+import os
+import logging
+import copy
+
+import numpy as np
+import xarray as xr
+
+from amlrgliders.storage import LocalStorage
+
+logger = logging.getLogger(__name__)
+
+
+# The gdm.data columns created by gdm, eg for the geospatial global attributes
+timeseries_template_columns = ['latitude', 'longitude', 'depth']
+
+
+def amlr_sensor_defs(config_path, storage=None):
+    """
+    Read the sensor definitions of a deployment
+
+    Args:
+        config_path (str): path to deployment data-config folder
+        storage (Storage, optional): storage backend for config_path.
+            Defaults to None, meaning LocalStorage.
+
+    Returns:
+        dict: sensor_defs.yml, keyed by sensor (gdm.data column) name,
+        or None if it could not be read
+    """
+    import yaml
+
+    if storage is None:
+        storage = LocalStorage()
+    sensor_defs_file = os.path.join(config_path, 'sensor_defs.yml')
+    if not storage.exists(sensor_defs_file):
+        logger.error(f'The sensor_defs file ({sensor_defs_file}) does not exist')
+        return None
+
+    # The sensor_defs file is large, so use the libyaml loader if available
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with storage.open(sensor_defs_file, 'rb') as f:
+        sensor_defs = yaml.load(f, Loader=loader)
+    if not isinstance(sensor_defs, dict):
+        logger.error(f'Unable to read the sensor definitions in {sensor_defs_file}')
+        return None
+    return sensor_defs
+
+
+def timeseries_variable(values, sensor_def):
+    """
+    Create the timeseries variable of one gdm.data column
+
+    Args:
+        values (ndarray): column values, which are wrapped rather than copied
+        sensor_def (dict): sensor definition, with attrs and dtype
+
+    Returns:
+        Variable: variable along time, with the sensor attributes,
+        and encoded as the sensor dtype
+    """
+    var = xr.Variable(
+        ('time',), values, attrs=copy.deepcopy(sensor_def.get('attrs', {})))
+    dtype = sensor_def.get('dtype')
+    if dtype is not None:
+        dtype = np.dtype(dtype)
+        # Integer sensors with missing values are kept as floats
+        if dtype.kind == 'f' or values.dtype.kind != 'f' or \
+                not np.isnan(values).any():
+            var.encoding['dtype'] = dtype
+    return var
+
+
+def amlr_timeseries_dataset(gdm, sensor_defs, varnames=None, data=None):
+    """
+    Create the timeseries dataset of gdm.data, with the variables of the
+    columns in sensor_defs, as done by gdm.to_timeseries_dataset
+
+    Args:
+        gdm (GliderDataModel): gdm object, for the time coordinate,
+            global attributes, and non-sensor variables
+        sensor_defs (dict): sensor definitions (see amlr_sensor_defs)
+        varnames (list, optional): nc variable names to create;
+            the variables are in this order. Defaults to None, meaning all
+            columns in sensor_defs, in the order of the gdm.data columns.
+        data (DataFrame, optional): data, eg of a time window.
+            Defaults to None, meaning gdm.data.
+
+    Returns:
+        Dataset: timeseries dataset
+    """
+    if data is None:
+        data = gdm.data
+
+    # Column of each nc variable
+    columns = {
+        sensor_defs[i].get('nc_var_name', i): i 
+        for i in data.columns if i in sensor_defs
+    }
+
+    # gdm creates the template columns, and everything that is not a sensor
+    gdm_template = copy.copy(gdm)
+    gdm_template.data = data[
+        [i for i in timeseries_template_columns if i in data.columns]]
+    ds_template = gdm_template.to_timeseries_dataset()
+    other_vars = [i for i in ds_template.data_vars if i not in columns]
+
+    subset = varnames is not None
+    if not subset:
+        varnames = list(columns) + other_vars
+    ds_vars = {}
+    for i in varnames:
+        if i in ds_template.data_vars:
+            ds_vars[i] = ds_template[i].variable
+        elif i in columns:
+            ds_vars[i] = timeseries_variable(
+                data[columns[i]].to_numpy(), sensor_defs[columns[i]])
+
+    logger.debug(f'Creating timeseries dataset with {len(ds_vars)} variables')
+    # Variables are ordered as in the gdm dataset, or a subset of it
+    if subset:
+        return xr.Dataset(ds_vars, coords=ds_template.coords, attrs=ds_template.attrs)
+    ds = xr.Dataset(coords=ds_template.coords, attrs=ds_template.attrs)
+    ds.update(ds_vars)
+    return ds
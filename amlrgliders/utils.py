@@ -1,6 +1,11 @@
 import os
+import logging
 import pathlib
 
+from amlrgliders.instrument import step
+
+logger = logging.getLogger(__name__)
+
 
 def find_extensions(dir_path): #,  excluded = ['', '.txt', '.lnk']):
     """
@@ -28,6 +33,55 @@ def amlr_interpolate(df):
         method='time', limit_direction='forward', limit_area='inside'
     )
 
+# Interpolated variables created by amlr_process_data, and their sources
+amlr_interp_vars = {
+    'idepth': 'depth', 'imdepth': 'm_depth', 
+    'impitch': 'm_pitch', 'imroll': 'm_roll'
+}
+
+def amlr_process_data(df):
+    """
+    Process gdm data read from dba files: make column names lowercase, 
+    remove invalid (1970-01-01) and duplicated timestamps, 
+    and create interpolated variables (amlr_interp_vars)
+    Args:
+        df (DataFrame): gdm data, sorted by time index
+    Returns:
+        Processed DataFrame
+    """
+    # Make columns lowercase to match sensor definitions yaml file
+    logger.info('Making sensor (data column) names lowercase')
+    df.columns = df.columns.str.lower()
+
+    with step('dedup') as s:
+        # Remove garbage data
+        #   Removing these timestamps is for situations when there is a " + 
+        #   'Not enough timestamps for yo interpolation' warning",
+        if any(df.index == '1970-01-01'):
+            n_toremove = sum(df.index == '1970-01-01')
+            logger.info(f'Removing {n_toremove} invalid (1970-01-01) timestamps')
+            df = df[df.index != '1970-01-01']
+        else:
+            logger.info('No invalid (1970-01-01) timestamps to remove')
+
+        # Remove duplicate timestamps
+        df_dup = df.index.duplicated(keep='last')
+        if any(df_dup):
+            logger.info('Removing duplicated timestamps')
+            df = df[~df_dup]
+            logger.info(f'Removed {df_dup.sum()} rows with duplicated timestamps')
+        else:
+            logger.info('No duplicated timestamps to remove')
+        s.data(df)
+
+    # Create interpolated variables
+    logger.info('Creating interpolated variables')
+    with step('interpolate'):
+        for i, j in amlr_interp_vars.items():
+            df[i] = amlr_interpolate(df[j])
+
+    return df
+
 def amlr_year_path(project, deployment_split):
     """
     Generate and return the year string to use in file paths
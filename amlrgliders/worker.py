@@ -0,0 +1,372 @@
+"""
+Long-lived processing worker (amlr-worker), for frequent runs such as the
+cron-driven real-time pipeline. The worker imports the processing modules
+(eg gdm and xarray) and creates its worker pool once, and then runs
+amlr-process jobs received on a local (Unix) socket, one at a time
+in the order received. The gdm objects of recently processed deployments
+are kept in a DeploymentCache, so that jobs whose gdm stage is up to date
+(eg only the ngdac stage is stale) do not reload the tmp parquet files.
+
+    amlr-worker serve --numcores 4 &
+    amlr-worker submit -- amlr03-20220425 FREEBYRD rt /deployments --stages ngdac
+
+Jobs and replies are json lines: a job is {"argv": [amlr-process arguments]},
+or {"command": "ping"} or {"command": "stop"}
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import importlib
+import socketserver
+from collections import OrderedDict
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+
+default_socket_path = os.path.join(tempfile.gettempdir(), 'amlr-worker.sock')
+
+# Modules imported when the worker starts, rather than by its first job
+worker_warm_modules = [
+    'gdm', 'amlrgliders.glider', 'amlrgliders.chunked', 'amlrgliders.timeseries',
+    'amlrgliders.acoustics', 'amlrgliders.imagery',
+]
+
+
+class DeploymentCache:
+    """
+    Cache of the gdm objects of the most recently processed deployments,
+    each with the fingerprint of the gdm stage that created it
+    (see stages.py). Cached gdm objects are only returned while their
+    fingerprint is current
+
+    Args:
+        max_items (int, optional): number of deployments (and modes) to cache.
+            Defaults to 2.
+    """
+
+    def __init__(self, max_items=2):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, fingerprint):
+        """
+        Get a copy of the cached gdm object for key, eg (glider_path, mode),
+        or None if there is none with fingerprint.
+        The copy shares the cached data and profiles, which output stages
+        replace (eg with a subset) rather than modify
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item['fingerprint'] != fingerprint:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            gdm = copy.copy(item['gdm'])
+            gdm.data = item['data']
+            gdm.profiles = item['profiles']
+            return gdm
+
+    def put(self, key, fingerprint, gdm):
+        """
+        Cache gdm, with its current data and profiles
+        """
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[key] = {
+                'fingerprint': fingerprint, 'gdm': copy.copy(gdm),
+                'data': gdm.data, 'profiles': gdm.profiles
+            }
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def keys(self):
+        with self._lock:
+            return list(self._items.keys())
+
+
+class _Job:
+    def __init__(self, argv):
+        self.argv = argv
+        self.t_queued = time.perf_counter()
+        self.result = None
+        self.done = threading.Event()
+
+
+class AmlrWorker:
+    """
+    Worker that runs amlr-process jobs with one warm pool and cache.
+    Jobs are run by run(), in the calling (main) thread, and are received
+    by a socket server in a background thread
+
+    Args:
+        socket_path (str): path of the Unix socket on which to listen
+        numcores (int): number of cores in the worker pool shared by all jobs
+        cache_size (int, optional): number of deployments whose gdm objects
+            are cached. Defaults to 2.
+    """
+
+    def __init__(self, socket_path, numcores, cache_size=2):
+        self.socket_path = socket_path
+        self.numcores = numcores
+        self.cache = DeploymentCache(cache_size)
+        self.jobs = queue.Queue()
+        self.n_jobs = 0
+
+    def warm(self):
+        """
+        Import the processing modules (eg gdm, xarray, and pandas) once, 
+        before the worker pool is started, so that jobs do not pay their 
+        import time, and forked pool processes inherit them
+        """
+        t_start = time.perf_counter()
+        for i in worker_warm_modules:
+            try:
+                importlib.import_module(i)
+            except ImportError as e:
+                logger.warning(f'Unable to import {i}: {e}')
+        logger.info('Imported processing modules in ' +
+                    f'{time.perf_counter() - t_start:.1f} seconds')
+
+    def submit(self, argv):
+        """
+        Queue a job, and wait for its result
+        """
+        job = _Job(argv)
+        self.jobs.put(job)
+        job.done.wait()
+        return job.result
+
+    def run_job(self, job, pool):
+        from amlrgliders.process import amlr_process, amlr_process_parser
+
+        t_start = time.perf_counter()
+        result = {'queued_seconds': t_start - job.t_queued}
+        try:
+            args = amlr_process_parser().parse_args(job.argv)
+        except SystemExit:
+            result.update(status='error', error='Invalid amlr-process arguments')
+            return result
+        # Jobs share the pool, so each uses all of its cores
+        if pool is not None:
+            args.numcores = self.numcores
+        logger.info(f'Running job for {args.deployment}-{args.mode}, ' +
+                    f"stages {', '.join(args.stages)}")
+        try:
+            timer = amlr_process(args, pool, self.cache)
+        except Exception as e:
+            logger.exception(f'Job failed for {args.deployment}-{args.mode}')
+            timer = None
+            result['error'] = str(e)
+        result.update(
+            status='complete' if timer is not None else 'failed',
+            seconds=time.perf_counter() - t_start,
+            timings=timer.timings if timer is not None else [])
+        return result
+
+    def run(self):
+        """
+        Serve jobs until a stop command is received
+        """
+        from amlrgliders.parallel import amlr_pool
+
+        self.warm()
+        worker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                except ValueError:
+                    reply = {'status': 'error', 'error': 'Invalid request'}
+                else:
+                    command = request.get('command', 'run')
+                    if command == 'ping':
+                        reply = {
+                            'status': 'ok', 'pid': os.getpid(),
+                            'jobs_run': worker.n_jobs,
+                            'jobs_queued': worker.jobs.qsize(),
+                            'cached': [list(i) for i in worker.cache.keys()]
+                        }
+                    elif command == 'stop':
+                        worker.jobs.put(None)
+                        reply = {'status': 'ok'}
+                    else:
+                        reply = worker.submit(request.get('argv', []))
+                self.wfile.write((json.dumps(reply) + '\n').encode())
+
+        if os.path.exists(self.socket_path):
+            if amlr_worker_ping(self.socket_path) is not None:
+                logger.error(f'A worker is already listening on {self.socket_path}')
+                return 1
+            os.remove(self.socket_path)
+
+        # The pool is created before any other thread, for forked workers
+        with (amlr_pool(self.numcores) if self.numcores > 1 else nullcontext()) as pool, \
+                socketserver.ThreadingUnixStreamServer(self.socket_path, Handler) as server:
+            server.daemon_threads = True
+            threading.Thread(
+                target=server.serve_forever, name='amlr-worker-server',
+                daemon=True).start()
+            logger.info(f'Listening for jobs on {self.socket_path}, ' +
+                        f'with a pool of {self.numcores} core(s)')
+            try:
+                while True:
+                    job = self.jobs.get()
+                    if job is None:
+                        break
+                    job.result = self.run_job(job, pool)
+                    self.n_jobs += 1
+                    job.done.set()
+            finally:
+                server.shutdown()
+                # Release clients of jobs that were not run
+                while not self.jobs.empty():
+                    job = self.jobs.get()
+                    if job is not None:
+                        job.result = {'status': 'error', 'error': 'Worker stopped'}
+                        job.done.set()
+                os.remove(self.socket_path)
+        logger.info(f'Worker stopped after {self.n_jobs} job(s)')
+        return 0
+
+
+def amlr_worker_request(socket_path, request, timeout=None):
+    """
+    Send a request to the worker listening on socket_path,
+    and wait for its reply
+
+    Args:
+        socket_path (str): path of the worker's Unix socket
+        request (dict): request, eg {'argv': [...]}
+        timeout (float, optional): seconds to wait for the reply.
+            Defaults to None, meaning no limit.
+
+    Returns:
+        dict: reply, or None if the worker could not be reached
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall((json.dumps(request) + '\n').encode())
+            with sock.makefile('rb') as f:
+                reply = f.readline()
+    except OSError as e:
+        logger.error(f'Unable to reach the worker on {socket_path}: {e}')
+        return None
+    return json.loads(reply) if reply else None
+
+
+def amlr_worker_ping(socket_path):
+    """
+    Get the status of the worker listening on socket_path,
+    or None if there is none
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(socket_path)
+            sock.sendall(b'{"command": "ping"}\n')
+            with sock.makefile('rb') as f:
+                return json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def amlr_worker_parser():
+    """
+    Get the argument parser for amlr-worker
+    """
+    arg_parser = argparse.ArgumentParser(
+        description='Long-lived worker that runs amlr-process jobs ' +
+            'with warm imports, worker pool, and gdm cache',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        allow_abbrev=False)
+
+    arg_parser.add_argument('--socket_path',
+        type=str,
+        help='Path of the Unix socket on which the worker listens',
+        default=default_socket_path)
+
+    arg_parser.add_argument('-l', '--loglevel',
+        type=str,
+        help='Verbosity level',
+        choices=['debug', 'info', 'warning', 'error', 'critical'],
+        default='info')
+
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve',
+        help='Start the worker, and run jobs until stopped',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    serve_parser.add_argument('--numcores',
+        type=int,
+        help='Number of cores in the worker pool shared by all jobs. ' +
+            'If 0 (the default), all possible cores will be used',
+        default=0)
+    serve_parser.add_argument('--cache_size',
+        type=int,
+        help='Number of deployments (and modes) whose gdm objects are ' +
+            'kept in memory between jobs. If 0, none are',
+        default=2)
+
+    submit_parser = subparsers.add_parser('submit',
+        help='Run an amlr-process job on the worker, and wait for it')
+    submit_parser.add_argument('process_args',
+        nargs=argparse.REMAINDER,
+        help='amlr-process arguments, after --')
+
+    subparsers.add_parser('ping', help='Print the status of the worker')
+    subparsers.add_parser('stop', help='Stop the worker, once its current job is done')
+
+    return arg_parser
+
+
+def main(argv=None):
+    """
+    Entry point for amlr-worker
+    """
+    args = amlr_worker_parser().parse_args(argv)
+
+    log_level = getattr(logging, args.loglevel.upper())
+    log_format = '%(threadName)s:%(module)s:%(levelname)s:%(message)s [line %(lineno)d]'
+    logging.basicConfig(format=log_format, level=log_level)
+
+    if args.command == 'serve':
+        numcores = args.numcores if args.numcores > 0 else os.cpu_count()
+        return AmlrWorker(args.socket_path, numcores, args.cache_size).run()
+
+    if args.command == 'ping':
+        reply = amlr_worker_ping(args.socket_path)
+    elif args.command == 'stop':
+        reply = amlr_worker_request(args.socket_path, {'command': 'stop'})
+    else:
+        process_args = args.process_args
+        if process_args[:1] == ['--']:
+            process_args = process_args[1:]
+        reply = amlr_worker_request(args.socket_path, {'argv': process_args})
+
+    if reply is None:
+        logger.error(f'No worker is listening on {args.socket_path}')
+        return 1
+    print(json.dumps(reply, indent=2))
+    return 0 if reply.get('status') in ['ok', 'complete'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
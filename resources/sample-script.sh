@@ -43,6 +43,9 @@ $AGSCRIPTS/amlr_binary_to_dba.py $DEPLOYMENT $PROJECT $MODE $PATH_DEPLOYMENTS \
 $AGSCRIPTS/amlr_dba_to_nc.py $DEPLOYMENT $PROJECT $MODE $PATH_DEPLOYMENTS \
   --clobbertmp --write_trajectory --logfile=$LOGFILE
 #--write_acoustics --write_imagery --imagery_path=$PATH_IMAGERY --loglevel=DEBUG
+#Alternatively, convert and create products in a single process:
+#amlr-process $DEPLOYMENT $PROJECT $MODE $PATH_DEPLOYMENTS \
+#  --stages trajectory
 
 # Cleanup: unmount buckets, copy log files to bucket
 fusermount -u $PATH_DEPLOYMENTS
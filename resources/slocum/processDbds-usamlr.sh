@@ -15,7 +15,7 @@ NAME
     $app - Convert and merge Slocum glider binary files
 
 SYNOPSIS
-    $app [hxm] [-c DIRECTORY] [-e DIRECTORY] [-f FILE] SOURCEDIR DESTDIR
+    $app [hxmu] [-c DIRECTORY] [-e DIRECTORY] [-f FILE] SOURCEDIR DESTDIR
 
 DESCRIPTION
     Convert and merge all binary *.[demnst]bd files in SOURCEDIR and write the
@@ -55,13 +55,18 @@ DESCRIPTION
     -m
         Output matlab formatted ascii files instead of dba format.
 
+    -u
+        Do not merge flight and science controller files: write the flight
+        and science dba files separately, eg SEGMENT_sbd.dat and
+        SEGMENT_tbd.dat, to be merged when they are read. Ignored with -m.
+
     -x
         Test configuration location and exist
 
 ";
 
 # Process options
-while getopts hrf:c:e:mx option
+while getopts hrf:c:e:mux option
 do
 
     case "$option" in
@@ -87,6 +92,9 @@ do
         "m")
             matlab=1;
             ;;
+        "u")
+            unmerged=1;
+            ;;
         "x")
             debug=1;
             ;;
@@ -455,7 +463,21 @@ do
             [ -f "$sciDba" ] && rm $sciDba;
 
         else
-            if [ -f "$sciDba" ]
+            if [ -f "$sciDba" -a -n "$unmerged" ]
+            then
+                # Keep the flight and science dba files, unmerged
+                sciAsciiExt=$(echo $sciExt | tr [[:upper:]] [[:lower:]]);
+                sciDatFile="${tmpDir}/${dbdSeg}_${sciAsciiExt}.dat";
+                mv $dbdDba $datFile && mv $sciDba $sciDatFile;
+
+                # Skip to the next file if an error occurred
+                [ "$?" -ne 0 ] && continue;
+
+                echo "Output File Created: $sciDatFile";
+
+                # Set convertOk to 1 for realtime switch processing
+                convertOk=1;
+            elif [ -f "$sciDba" ]
             then
                 $dbaMerge $dbdDba $sciDba > $datFile;
 
@@ -474,7 +496,7 @@ do
             convertedCount=$(( convertedCount + 1 ));
 
             # Delete the individual dba files
-            rm $dbdDba $sciDba;
+            rm -f $dbdDba $sciDba;
 
         fi
 
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import tracemalloc
+import subprocess
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from amlrgliders.synthetic import synthetic_deployment
+from amlrgliders.glider import amlr_load_dba, amlr_gdm, \
+    amlr_write_trajectory, amlr_write_ngdac
+from amlrgliders.acoustics import amlr_acoustics_metadata
+from amlrgliders.imagery import amlr_imagery_metadata
+
+
+benchmark_stages = ['load_dba', 'gdm', 'trajectory', 'ngdac', 'acoustics', 'imagery']
+
+scripts_path = os.path.dirname(os.path.abspath(__file__))
+
+# Entry points whose startup time is benchmarked (the startup stage), 
+#   as arguments to the python interpreter
+startup_entry_points = {
+    'amlr_scrape_sfmc': [os.path.join(scripts_path, 'amlr_scrape_sfmc.py')],
+    'amlr_binary_to_dba': [os.path.join(scripts_path, 'amlr_binary_to_dba.py')],
+    'amlr_dba_to_nc': [os.path.join(scripts_path, 'amlr_dba_to_nc.py')],
+    'amlr_bulk_move': [os.path.join(scripts_path, 'amlr_bulk_move.py')],
+    'amlr-process': ['-m', 'amlrgliders.process'],
+    'amlr-batch': ['-m', 'amlrgliders.batch'],
+    'amlr-worker': ['-m', 'amlrgliders.worker'],
+}
+
+# Modules that entry points should only import in the stages that use them
+startup_heavy_modules = [
+    'numpy', 'pandas', 'pyarrow', 'xarray', 'netCDF4', 'yaml', 'gdm', 'google.cloud'
+]
+
+
+def git_commit():
+    """
+    Get the commit of the amlrgliders source, with '-dirty' if there are
+    uncommitted changes, or '' if it is not in a git repository
+    """
+    repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path,
+            capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=repo_path, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    return commit + ('-dirty' if dirty.strip() != '' else '')
+
+
+def run_stage(name, func, use_tracemalloc):
+    """
+    Run func, and return its output and the wall time, CPU time
+    (including child processes), and peak memory of running it
+    """
+    if use_tracemalloc:
+        tracemalloc.start()
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    t_start = time.perf_counter()
+    try:
+        out = func()
+    finally:
+        seconds = time.perf_counter() - t_start
+        peak_bytes = tracemalloc.get_traced_memory()[1] if use_tracemalloc else None
+        if use_tracemalloc:
+            tracemalloc.stop()
+    usage_self_end = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds = sum(
+        getattr(end, i) - getattr(start, i)
+        for start, end in [(usage_self, usage_self_end),
+                           (usage_children, usage_children_end)]
+        for i in ['ru_utime', 'ru_stime'])
+
+    logging.info(f'Stage {name}: {seconds:.2f} seconds, ' +
+                 f'{cpu_seconds:.2f} CPU seconds' +
+                 (f', peak {peak_bytes / 1e6:.1f} MB' if use_tracemalloc else ''))
+    return out, {
+        'seconds': seconds, 'cpu_seconds': cpu_seconds, 'peak_bytes': peak_bytes,
+        # ru_maxrss is in kilobytes on Linux
+        'max_rss_bytes': usage_self_end.ru_maxrss * 1024,
+    }
+
+
+def startup_imports(cmd):
+    """
+    Get the heavy modules (startup_heavy_modules) imported by cmd,
+    from the output of python -X importtime
+    """
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + cmd, capture_output=True, text=True)
+    imported = set(
+        i.rsplit('|', 1)[-1].strip() for i in out.stderr.splitlines()
+        if i.startswith('import time:'))
+    return [i for i in startup_heavy_modules if i in imported]
+
+
+def benchmark_startup(args, run_info):
+    """
+    Time the startup of each entry point, ie importing its modules and 
+    building its argument parser, by running it with --help args.repeat times. 
+    The interpreter startup time (python -c pass) is included, 
+    and recorded as interpreter_seconds
+
+    Returns:
+        list: dicts of results, one per entry point
+    """
+    def median_seconds(cmd):
+        seconds = []
+        for _ in range(args.repeat):
+            t_start = time.perf_counter()
+            subprocess.run([sys.executable] + cmd, capture_output=True, check=True)
+            seconds.append(time.perf_counter() - t_start)
+        return statistics.median(seconds)
+
+    interpreter_seconds = median_seconds(['-c', 'pass'])
+    results = []
+    for name, cmd in startup_entry_points.items():
+        try:
+            seconds = median_seconds(cmd + ['--help'])
+        except subprocess.CalledProcessError as e:
+            logging.error(f'Entry point {name} failed to start: {e.stderr}')
+            continue
+        heavy = startup_imports(cmd + ['--help'])
+        logging.info(f'Startup {name}: {seconds:.3f} seconds' + 
+                     (f", imports {', '.join(heavy)}" if heavy else ''))
+        results.append(dict(
+            run_info, n_files=0, rows_per_file=0, n_sensors=0, 
+            stage=f'startup:{name}', repeat=0, seconds=seconds, 
+            interpreter_seconds=interpreter_seconds, heavy_modules=heavy, 
+            over_budget=seconds > args.startup_budget))
+    return results
+
+
+def benchmark_scale(args, n_files, work_path, run_info):
+    """
+    Create a synthetic deployment with n_files dba files,
+    and time each stage on it args.repeat times
+
+    Returns:
+        list: dicts of results, one per stage and repeat
+    """
+    project, deployment, mode = 'FREEBYRD', 'amlr08-20221205', 'delayed'
+    deployments_path = os.path.join(work_path, f'deployments-{n_files}')
+    imagery_path = os.path.join(work_path, f'imagery-{n_files}')
+    glider_path = synthetic_deployment(
+        deployments_path, project, deployment, mode, n_files=n_files,
+        rows_per_file=args.rows_per_file, n_sensors=args.n_sensors,
+        imagery_path=imagery_path, n_images=args.images_per_file * n_files,
+        seed=args.seed)
+    ascii_path = os.path.join(glider_path, 'data', 'ascii', mode)
+    images_path = os.path.join(
+        imagery_path, 'gliders', os.path.basename(os.path.dirname(glider_path)),
+        deployment)
+
+    scale = {
+        'n_files': n_files, 'rows_per_file': args.rows_per_file,
+        'n_sensors': args.n_sensors, 'n_images': args.images_per_file * n_files,
+        'dba_bytes': sum(os.path.getsize(os.path.join(ascii_path, i))
+                         for i in os.listdir(ascii_path)),
+    }
+    logging.info(f'Benchmarking scale {scale}')
+
+    results = []
+    for k in range(args.repeat):
+        gdm, gdm_data = None, None
+        for name in [i for i in benchmark_stages if i in args.stages]:
+            if name != 'load_dba' and name != 'gdm' and gdm is None:
+                logging.warning(f'Stage {name} requires the gdm stage; skipping')
+                continue
+            # Each output stage starts from the same gdm data
+            if gdm_data is not None:
+                gdm.data = gdm_data.copy()
+
+            if name == 'load_dba':
+                func = lambda: amlr_load_dba(ascii_path, args.numcores)
+            elif name == 'gdm':
+                func = lambda: amlr_gdm(
+                    deployment, project, mode, glider_path, args.numcores,
+                    loadfromtmp=False, clobbertmp=True)
+            elif name == 'trajectory':
+                func = lambda: amlr_write_trajectory(
+                    gdm, deployment, mode, glider_path)
+            elif name == 'ngdac':
+                func = lambda: amlr_write_ngdac(
+                    gdm, deployment, mode,
+                    os.path.join(glider_path, 'data', 'nc', 'ngdac', mode))
+            elif name == 'acoustics':
+                func = lambda: amlr_acoustics_metadata(
+                    gdm, f'{deployment}-{mode}', glider_path)
+            elif name == 'imagery':
+                func = lambda: amlr_imagery_metadata(
+                    gdm, deployment, glider_path, images_path)
+
+            out, result = run_stage(name, func, args.tracemalloc)
+            if name == 'gdm':
+                gdm = out
+                gdm_data = gdm.data.copy() if gdm is not None else None
+            results.append(dict(run_info, **scale, stage=name, repeat=k, **result))
+
+    return results
+
+
+def compare(results_file):
+    """
+    Print the median seconds of each stage and scale (rows)
+    for each commit (columns) in results_file
+    """
+    results = pd.read_json(results_file, lines=True)
+    table = results.pivot_table(
+        index=['n_files', 'rows_per_file', 'n_sensors', 'stage'],
+        columns='commit', values='seconds', aggfunc='median', sort=False)
+    # Commits in the order in which they were benchmarked
+    table = table[results.drop_duplicates('commit')['commit'].tolist()]
+    print(table.round(2).to_string())
+
+
+def main(args):
+    """
+    Benchmark the processing stages on synthetic deployments of several sizes.
+
+    Synthetic deployments (see amlrgliders.synthetic) are created in a
+    temporary directory, and the wall time, CPU time, and memory of each stage
+    are appended as json lines to results_file, tagged with the git commit,
+    so that results can be compared across commits with --compare.
+
+    The startup stage times the startup of each entry point; 
+    returns 1 if any entry point takes longer than startup_budget to start.
+    """
+
+    log_level = getattr(logging, args.loglevel.upper())
+    log_format = '%(module)s:%(levelname)s:%(message)s [line %(lineno)d]'
+    logging.basicConfig(format=log_format, level=log_level)
+
+    if args.compare:
+        compare(args.results_file)
+        return 0
+
+    run_info = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'numcores': args.numcores,
+    }
+    logging.info(f"Benchmarking commit {run_info['commit'] or '(unknown)'}")
+
+    exit_code = 0
+    if 'startup' in args.stages:
+        results = benchmark_startup(args, run_info)
+        with open(args.results_file, 'a') as f:
+            for i in results:
+                f.write(json.dumps(i) + '\n')
+        over_budget = [i['stage'] for i in results if i['over_budget']]
+        if len(over_budget) > 0 or len(results) < len(startup_entry_points):
+            logging.error(f'Startup is over the budget of {args.startup_budget} ' + 
+                          f"seconds, or failed, for: {', '.join(over_budget)}")
+            exit_code = 1
+
+    if any(i in benchmark_stages for i in args.stages):
+        work_path = args.work_path if args.work_path != '' else None
+        with tempfile.TemporaryDirectory(prefix='amlr-benchmark-', dir=work_path) as tmp_path:
+            for n_files in args.scales:
+                results = benchmark_scale(args, n_files, tmp_path, run_info)
+                with open(args.results_file, 'a') as f:
+                    for i in results:
+                        f.write(json.dumps(i) + '\n')
+
+    logging.info(f'Results appended to {args.results_file}')
+    return exit_code
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=main.__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        allow_abbrev=False)
+
+    arg_parser.add_argument('--scales',
+        type=int,
+        nargs='+',
+        help='Deployment sizes to benchmark, as numbers of dba files',
+        default=[10, 50])
+
+    arg_parser.add_argument('--rows_per_file',
+        type=int,
+        help='Number of rows in each synthetic dba file',
+        default=5000)
+
+    arg_parser.add_argument('--n_sensors',
+        type=int,
+        help='Number of sensors in each synthetic dba file',
+        default=100)
+
+    arg_parser.add_argument('--images_per_file',
+        type=int,
+        help='Number of synthetic images per dba file',
+        default=100)
+
+    arg_parser.add_argument('--stages',
+        type=str,
+        nargs='+',
+        help='Stages to benchmark. Output stages require the gdm stage, ' + 
+            'and startup times the startup of each entry point',
+        choices=benchmark_stages + ['startup'],
+        default=benchmark_stages + ['startup'])
+
+    arg_parser.add_argument('--repeat',
+        type=int,
+        help='Number of times to run the stages at each scale',
+        default=3)
+
+    arg_parser.add_argument('--startup_budget',
+        type=float,
+        help='Maximum startup time, in seconds, of each entry point, ' + 
+            'including interpreter startup',
+        default=0.5)
+
+    arg_parser.add_argument('--numcores',
+        type=int,
+        help='Number of cores with which to read dba files. ' +
+            'If 0, chosen from the dba file sizes; see amlr_load_dba',
+        default=1)
+
+    arg_parser.add_argument('--tracemalloc',
+        help='flag; indicates if the peak memory allocated by each stage ' +
+            'should be measured with tracemalloc, which slows the stages. ' +
+            'Allocations by pool workers are not measured',
+        action='store_true')
+
+    arg_parser.add_argument('--seed',
+        type=int,
+        help='Random seed for the synthetic deployments',
+        default=0)
+
+    arg_parser.add_argument('--work_path',
+        type=str,
+        help='Directory in which to create the synthetic deployments. ' +
+            'If empty (the default), $TMPDIR is used',
+        default='')
+
+    arg_parser.add_argument('--results_file',
+        type=str,
+        help='Path of the json lines file to which to append results',
+        default='amlr-benchmark-results.jsonl')
+
+    arg_parser.add_argument('--compare',
+        help='flag; print the median seconds of each stage for each ' +
+            'benchmarked commit in results_file, rather than benchmarking',
+        action='store_true')
+
+    arg_parser.add_argument('-l', '--loglevel',
+        type=str,
+        help='Verbosity level',
+        choices=['debug', 'info', 'warning', 'error', 'critical'],
+        default='info')
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
@@ -4,9 +4,14 @@ import os
 import sys
 import argparse
 import logging
-from subprocess import run
+from contextlib import nullcontext
 
-from amlrgliders.utils import amlr_year_path #, amlr_logger
+from amlrgliders.binary_to_dba import amlr_binary_to_dba
+from amlrgliders.storage import amlr_storage
+from amlrgliders.catalog import AmlrCatalog
+from amlrgliders.utils import amlr_year_path
+from amlrgliders.profiling import profile_options, script_profiler
+from amlrgliders.metrics import metrics_options, script_metrics, metric_set
 
 
 def main(args):
@@ -26,154 +31,37 @@ def main(args):
     logging.basicConfig(format=log_format, level=log_level)
  
 
-    deployment = args.deployment
-    project = args.project
-    mode = args.mode
     deployments_path = args.deployments_path
-
-    processDbds_file = args.processDbds_file
-    cac2lower_file = args.cac2lower_file    
-    linuxbin_path = args.linuxbin_path    
-
-    # Checks
-    if not os.path.isdir(deployments_path):
-        logging.error(f'deployments_path ({deployments_path}) does not exist')
-        return
-
-    if not os.path.isfile(processDbds_file):
-        logging.error(f'processDbds_file ({processDbds_file}) does not exist')
-        return
-
-    if not os.path.isfile(cac2lower_file):
-        logging.error(f'cac2lower_file ({cac2lower_file}) does not exist')
-        return
-
-    if not os.path.isdir(linuxbin_path):
-        logging.error(f'linuxbin_path ({linuxbin_path}) does not exist')
-        return
-
-
-    if not (mode in ['delayed', 'rt']):
-        logging.error("mode must be either 'delayed' or 'rt'")
-        return
-
-    deployment_split = deployment.split('-')
-    if len(deployment_split[1]) != 8:
-        logging.error("The deployment string format must be 'glider-YYYYmmdd', " + 
-            "eg amlr03-20220101")
-        return
-
-    #--------------------------------------------
-    # Set/check/create file paths for processDbds script
-    logging.info(f'Writing dba files for deployment {deployment}, mode {mode}')
-    glider = deployment_split[0]
-    year = amlr_year_path(project, deployment_split)
-
-    glider_depl_path = os.path.join(deployments_path, project, year, deployment)
-    # glider_data_in = os.path.join(glider_depl_path, 'glider', 'data', 'in')
-    glider_data_in = os.path.join(glider_depl_path, 'data')
-    
-    binary_path = os.path.join(glider_data_in, 'binary', mode)
-    ascii_path = os.path.join(glider_data_in, 'ascii', mode)
-    cache_path = os.path.join(deployments_path, 'cache')
-    scripts_path = os.path.join(glider_depl_path, 'scripts')
-    processDbds_out_file = f'{deployment}_{mode}_processDbds_out.txt'
-
-    logging.debug(f'processDbds file: {processDbds_file}')
-    logging.debug(f'Cache path: {cache_path}')
-    logging.debug(f'linux-bin path: {linuxbin_path}')
-    logging.debug(f'Binary path: {binary_path}')
-    logging.debug(f'Ascii path: {ascii_path}')
-    logging.debug(f'Scripts path: {scripts_path}')
-    logging.debug(f'processDbds_out file: {processDbds_out_file}')
-
-    if not os.path.isdir(cache_path):
-        logging.error(f'cache_path ({cache_path}) does not exist')
-        return
-
-    if not os.path.isdir(binary_path):
-        logging.error(f'binary_path ({binary_path}) does not exist')
+    scratch_path = args.scratch_path if args.scratch_path != '' else None
+    storage = amlr_storage(deployments_path, args.deployments_bucket)
+
+    glider_path = os.path.join(
+        deployments_path, args.project, 
+        amlr_year_path(args.project, args.deployment.split('-')), args.deployment)
+
+    # Open the deployment catalog, if specified, once deployments_path exists
+    use_catalog = args.catalog and storage.isdir(deployments_path)
+    with script_profiler(args, os.path.join(glider_path, 'scripts'), 
+                         f'{args.deployment}-{args.mode}-binary_to_dba', 
+                         scratch_path, storage), \
+            script_metrics(args, 'binary_to_dba', args.deployment, args.mode), \
+            (AmlrCatalog(deployments_path, storage, scratch_path) if use_catalog 
+             else nullcontext()) as catalog:
+        ascii_path = amlr_binary_to_dba(
+            args.deployment, args.project, args.mode, deployments_path, 
+            args.processDbds_file, args.cac2lower_file, args.linuxbin_path, 
+            sensor_filter=args.sensor_filter, numcores=args.numcores, 
+            compress_dba=args.compress_dba, scratch_path=scratch_path, 
+            storage=storage, catalog=catalog, 
+            filter_report_segments=args.filter_report_segments, 
+            unmerged=args.unmerged_dba
+        )
+        if ascii_path is not None:
+            metric_set('success', 1)
+
+    if ascii_path is None:
         return
-    
-    if not os.path.isdir(ascii_path):
-        logging.info(f'Making path at: {ascii_path}')
-        os.makedirs(ascii_path)
-
-    if not os.path.isdir(scripts_path):
-        logging.info(f'Making path at: {scripts_path}')
-        os.makedirs(scripts_path)
 
-    #--------------------------------------------
-    # Make sure cache files are lowercase
-    files_list = os.listdir(cache_path)
-    files_list_CAC = list(filter(lambda i: i.endswith(".CAC"), files_list))
-
-    if len(files_list_CAC) > 0:
-        logging.info(f'{len(files_list_CAC)} .CAC files will be renamed')
-        run_out = run([cac2lower_file, os.path.join(cache_path, "*")], 
-            capture_output=True, text=True)
-
-        if run_out.returncode != 0:
-            logging.error(f'Error running `{cac2lower_file}`')
-            logging.error(f'ARGS:\n{run_out.args}')
-            logging.error(f'STDERR:\n{run_out.stderr}')
-            return
-        else:
-            logging.info(f'Successfully completed run of `{cac2lower_file}`')
-            logging.debug(f'ARGS:\n{run_out.args}')
-            logging.debug(f'STDOUT:\n{run_out.stdout}')
-
-        # Make sure that all .CAC files have corresponding .cac files before deleting
-        delete_ok = True
-        files_list_new = os.listdir(cache_path)
-
-        for i in files_list_CAC:
-            if i.lower() not in files_list_new:
-                delete_ok = False
-
-        if delete_ok: 
-            run_out = run(["find", cache_path, '-name', '*.CAC', '-delete'])
-            if run_out.returncode != 0:
-                logging.error(f'Error running `find {cache_path} -name *.CAC -delete`')
-                return
-
-            logging.info(f"{len(files_list_CAC)} uppercase .CAC files were deleted")
-        else:
-            logging.warn("Not all '.CAC' files have a corresponding '.cac' file, " + 
-                "and thus the .CAC files were not deleted. " + 
-                "Please inspect by hand.")
-
-            del run_out
-
-    else:
-        logging.info('There are no .CAC files to rename')
-
-
-    # Make dba files
-    logging.info(f'Running processDbds script and writing dba files to {ascii_path}')
-    run_out = run([processDbds_file, "-c", cache_path, "-e", linuxbin_path, 
-                   binary_path, ascii_path], 
-                capture_output=True, text=True)    
-    if run_out.returncode != 0:
-        logging.error(f'Error running `{processDbds_file}`')
-        logging.error(f'ARGS:\n{run_out.args}')
-        logging.error(f'STDERR:\n{run_out.stderr}')
-        return
-    else:
-        logging.info(f'Successfully completed run of `{processDbds_file}`')
-        logging.debug(f'ARGS:\n{run_out.args}')
-        logging.debug(f'STDOUT:\n{run_out.stdout}')
-
-        # TODO: write to log directory, if applicable
-        # fileout_path = os.path.join(scripts_path, processDbds_out_file)
-        # logging.info(f'Writing `{processDbds_file}` output to {fileout_path}')
-        # fileout = open(fileout_path, 'w')
-        # fileout.write(f'ARGS PASSED TO processDbds SCRIPT:\n{run_out.args}\n\n\n')
-        # fileout.write(f'STDOUT:\n{run_out.stdout}')
-        # fileout.close()
-
-
-    #--------------------------------------------
     return 0
 
 
@@ -217,6 +105,61 @@ if __name__ == '__main__':
         help='Path to linux-bin directory',
         default = '/opt/amlr-gliders/resources/slocum/linux-bin_8_6')
 
+    arg_parser.add_argument('--deployments_bucket',
+        type=str,
+        help='GCS bucket that is mounted at deployments_path. ' + 
+            'If specified, files are read and written with the native ' + 
+            'GCS client rather than through gcsfuse', 
+        default='')
+
+    arg_parser.add_argument('--scratch_path',
+        type=str,
+        help='Local directory for copies of bucket files, ' + 
+            'if deployments_bucket is specified. ' + 
+            'If empty (the default), $TMPDIR is used',
+        default='')
+
+    arg_parser.add_argument('--numcores',
+        type=int,
+        help='Number of cores to use when decompressing compressed ' + 
+            'binary files (eg .scd/.tcd). ' + 
+            'This argument must be between 1 and mp.cpu_count(). ' + 
+            'If 0 (the default), all possible cores will be used',
+        default=0)
+
+    arg_parser.add_argument('--sensor_filter',
+        help='flag; indicates if dba files should only contain the sensors ' + 
+            'in the deployment sensor_defs.yml file and amlr_gdm_varnames. ' + 
+            'The sensor filter file is written to the deployment scripts folder',
+        action='store_true')
+
+    arg_parser.add_argument('--filter_report_segments',
+        type=int,
+        help='With sensor_filter, the number of segments that are also ' + 
+            'converted without the filter, to report the dba size and ' + 
+            'parse time savings. If 0, there is no report',
+        default=2)
+
+    arg_parser.add_argument('--unmerged_dba',
+        help='flag; write the flight and science dba files of each segment ' + 
+            'unmerged (processDbds -u), rather than merged with dba_merge. ' + 
+            'Unmerged dba files are merged when read by amlr_dba_to_nc.py',
+        action='store_true')
+
+    arg_parser.add_argument('--compress_dba',
+        type=str,
+        help="Compression for dba files written to the ascii directory. " + 
+            "Compressed dba files are read transparently by amlr_dba_to_nc.py. " + 
+            "'zstd' requires the zstandard package",
+        choices=['none', 'gzip', 'zstd'],
+        default='none')
+
+    arg_parser.add_argument('--catalog',
+        help='flag; indicates if the binary and dba files, and the processing ' + 
+            'status, should be recorded in the deployment catalog ' + 
+            'in deployments_path',
+        action='store_true')
+
     arg_parser.add_argument('-l', '--loglevel',
         type=str,
         help='Verbosity level',
@@ -228,6 +171,9 @@ if __name__ == '__main__':
         help='File to which to write logs',
         default='')
 
+    profile_options(arg_parser)
+    metrics_options(arg_parser)
+
     parsed_args = arg_parser.parse_args()
 
     sys.exit(main(parsed_args))
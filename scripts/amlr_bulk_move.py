@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import logging
+import argparse
+
+from amlrgliders.storage import GCSStorage, LocalStorage
+from amlrgliders.bulk_move import amlr_bulk_move
+
+
+def main(args):
+    """
+    Move (rename) all files or bucket objects under a path, by applying
+    string replacements to their paths.
+    Eg, to move imagery from 'images' to 'images-ffPCG', excluding Dir016:
+    amlr_bulk_move.py gs://amlr-imagery-proc-dev/gliders/2022/amlr07-20221204/shadowgraph/images
+        --replace /images/ /images-ffPCG/ --replace /output/ / --exclude Dir016
+
+    Completed moves are recorded in the journal file,
+    and so rerunning an interrupted command resumes it.
+
+    Returns 0 if all files were moved, otherwise 1
+    """
+
+    #--------------------------------------------
+    # Set up logger and args variables
+    log_level = getattr(logging, args.loglevel.upper())
+    log_format = '%(module)s:%(levelname)s:%(message)s [line %(lineno)d]'
+    logging.basicConfig(format=log_format, level=log_level)
+
+    path = args.path
+    if path.startswith('gs://'):
+        bucket_name = path[len('gs://'):].split('/')[0]
+        storage = GCSStorage(
+            bucket_name, project=args.gcpproject_id, max_workers=args.numworkers)
+    else:
+        if not os.path.isdir(path):
+            logging.error(f'path ({path}) does not exist')
+            return 1
+        storage = LocalStorage(max_workers=args.numworkers)
+
+    journal_file = args.journal if args.journal != '' else None
+
+    #--------------------------------------------
+    counts = amlr_bulk_move(
+        storage, path, args.replace, include=args.include, exclude=args.exclude,
+        journal_file=journal_file, dry_run=args.dry_run,
+        chunk_size=args.chunk_size)
+    logging.info(f'Bulk move summary: {counts}')
+
+    return 0 if counts['failed'] == 0 else 1
+
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=main.__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    arg_parser.add_argument('path',
+        type=str,
+        help='Local directory, or bucket prefix as gs://bucket/prefix, ' +
+            'under which to move files')
+
+    arg_parser.add_argument('--replace',
+        type=str,
+        nargs=2,
+        metavar=('OLD', 'NEW'),
+        action='append',
+        required=True,
+        help='Replace OLD with NEW in file paths. ' +
+            'Can be given multiple times; replacements are applied in order')
+
+    arg_parser.add_argument('--include',
+        type=str,
+        help='Only move files whose paths contain this string',
+        default=None)
+
+    arg_parser.add_argument('--exclude',
+        type=str,
+        help='Do not move files whose paths contain this string',
+        default=None)
+
+    arg_parser.add_argument('--journal',
+        type=str,
+        help='Local file in which to record completed moves, ' +
+            'so that interrupted runs can be resumed. ' +
+            'If empty, no journal is kept',
+        default='amlr_bulk_move_journal.txt')
+
+    arg_parser.add_argument('--dry_run',
+        help='Only log the files that would be moved',
+        action='store_true')
+
+    arg_parser.add_argument('--gcpproject',
+        type=str,
+        dest='gcpproject_id',
+        help='GCP project ID',
+        default='ggn-nmfs-usamlr-dev-7b99')
+
+    arg_parser.add_argument('--numworkers',
+        type=int,
+        help='Number of concurrent copy/delete requests',
+        default=64)
+
+    arg_parser.add_argument('--chunk_size',
+        type=int,
+        help='Number of moves between journal updates',
+        default=1000)
+
+    arg_parser.add_argument('-l', '--loglevel',
+        type=str,
+        help='Verbosity level',
+        choices=['debug', 'info', 'warning', 'error', 'critical'],
+        default='info')
+
+    parsed_args = arg_parser.parse_args()
+
+    sys.exit(main(parsed_args))
@@ -4,12 +4,17 @@ import os
 import sys
 import logging
 import argparse
+from contextlib import nullcontext
 from importlib.metadata import version
 
 from amlrgliders.utils import amlr_year_path
-from amlrgliders.glider import amlr_gdm, amlr_write_trajectory, amlr_write_ngdac
-from amlrgliders.acoustics import amlr_acoustics_metadata
-from amlrgliders.imagery import amlr_imagery_metadata
+from amlrgliders.storage import amlr_storage
+from amlrgliders.catalog import AmlrCatalog
+from amlrgliders.checkpoint import Checkpoint
+from amlrgliders.instrument import RunReport, step
+from amlrgliders.profiling import profile_options, script_profiler
+from amlrgliders.metrics import metrics_options, script_metrics, metric_set, \
+    metric_ngdac_latency
 
 
 def main(args):
@@ -24,6 +29,11 @@ def main(args):
     removed 1970-01-01 timestamps, made column names lowercase, 
     or added inteprolated variables. 
 
+    A run report, with the time and memory of each step, 
+    is written to the deployment data/out directory. 
+    If metrics_path is given, run metrics (eg rows parsed, profiles written,
+    and the latency from segment arrival to NGDAC files) are written there. 
+
     Returns the gdm object from amlr_gdm. 
     """
 
@@ -83,31 +93,35 @@ def main(args):
     deployments_path = args.deployments_path
 
     numcores = args.numcores
+    memory_budget = args.memory_budget * 1e9 if args.memory_budget > 0 else None
+    prefetch = args.prefetch
+    scratch_path = args.scratch_path if args.scratch_path != '' else None
 
     loadfrom_tmp = args.loadfromtmp
     clobber_tmp = args.clobbertmp
+    start = args.start if args.start != '' else None
+    end = args.end if args.end != '' else None
+    use_catalog = args.catalog
+    resume = args.resume
+    checkpoint_every = args.checkpoint_every
     write_trajectory = args.write_trajectory
     write_ngdac = args.write_ngdac
+    write_ragged = args.write_ragged
     
     write_acoustics = args.write_acoustics
     write_imagery = args.write_imagery
     imagery_path = args.imagery_path
 
+    storage = amlr_storage(deployments_path, args.deployments_bucket)
+    imagery_storage = amlr_storage(imagery_path, args.imagery_bucket)
 
     #--------------------------------------------
     # Checks and make glider_path variables
 
     prj_list = ['FREEBYRD', 'REFOCUS', 'SANDIEGO']    
-    if not os.path.isdir(deployments_path):
+    if not storage.isdir(deployments_path):
         logging.error(f'deployments_path ({deployments_path}) does not exist')
         return
-    else:
-        dir_expected = prj_list + ['cache']
-        if not all(x in os.listdir(deployments_path) for x in dir_expected):
-            logging.error(f"The expected folders ({', '.join(dir_expected)}) " + 
-                f'were not found in the provided directory ({deployments_path}). ' + 
-                'Did you provide the right path via deployments_path?')
-            return 
 
     deployment_split = deployment.split('-')
     deployment_mode = f'{deployment}-{mode}'
@@ -115,65 +129,188 @@ def main(args):
 
     glider_path = os.path.join(deployments_path, project, year, deployment)
     # glider_path = os.path.join(deployment_curr_path, 'glider')  
+
+    # Use the deployment catalog, if specified, rather than listing directories
+    with script_profiler(args, os.path.join(glider_path, 'scripts'), 
+                         f'{deployment_mode}-dba_to_nc', scratch_path, storage), \
+            (AmlrCatalog(deployments_path, storage, scratch_path) if use_catalog 
+             else nullcontext()) as catalog, \
+            RunReport(deployment, mode, os.path.join(glider_path, 'data', 'out'), 
+                      scratch_path, storage, numcores=numcores), \
+            script_metrics(args, 'dba_to_nc', deployment, mode):
+        if catalog is None or not catalog.has_deployment(deployment):
+            dir_expected = prj_list + ['cache']
+            deployments_list = storage.list(deployments_path)
+            if not all(x in deployments_list for x in dir_expected):
+                logging.error(f"The expected folders ({', '.join(dir_expected)}) " + 
+                    f'were not found in the provided directory ({deployments_path}). ' + 
+                    'Did you provide the right path via deployments_path?')
+                return 
     
-    if write_imagery:
-        if not os.path.isdir(imagery_path):
-            logging.error('write_imagery is true, and thus imagery_path ' + 
-                          f'({imagery_path}) must be a valid path')
+        if write_imagery:
+            if not imagery_storage.isdir(imagery_path):
+                logging.error('write_imagery is true, and thus imagery_path ' + 
+                              f'({imagery_path}) must be a valid path')
+                return
+
+        if catalog is not None:
+            catalog.add_deployment(deployment, project, glider_path)
+            catalog.set_status(deployment, mode, 'dba_to_nc', 'running')
+
+        # Checkpoint after each stage, and within dba reading and ngdac writing
+        checkpoint = None
+        if start is not None or end is not None:
+            # A time window is not a resumable run of the whole deployment
+            if resume:
+                logging.warning('resume is ignored when processing a time window')
+        elif checkpoint_every > 0:
+            checkpoint = Checkpoint(
+                os.path.join(glider_path, 'data', 'tmp', f'checkpoint-{deployment_mode}'), 
+                storage, resume, checkpoint_every)
+        elif resume:
+            logging.warning('resume is ignored, because checkpoint_every is 0')
+
+        def stage_done(stage):
+            return checkpoint is not None and checkpoint.stage_done(stage)
+
+        #--------------------------------------------
+        # Create gdm object. Processing modules are imported when needed, 
+        #   so that gdm and xarray are not loaded by eg failed checks
+        from amlrgliders.glider import amlr_gdm, amlr_write_trajectory, \
+            amlr_write_ngdac, amlr_write_profiles_ragged
+        from amlrgliders.timeseries import amlr_sensor_defs
+        logging.info(f'Creating gdm object')
+        # If the gdm stage was completed by the resumed run, load from tmp
+        if stage_done('gdm'):
+            logging.info('Resuming: loading gdm object from tmp files')
+        with step('gdm') as s:
+            gdm = amlr_gdm(
+                deployment, project, mode, glider_path, numcores, 
+                loadfrom_tmp or stage_done('gdm'), clobber_tmp, prefetch, 
+                scratch_path, storage, catalog, checkpoint=checkpoint, 
+                memory_budget=memory_budget, start=start, end=end
+            )
+            if gdm is not None:
+                s.data(gdm.data)
+
+        # Outputs of a time window replace the window in the existing files
+        import pandas as pd
+        gdm_start = pd.Timestamp(start) if start is not None else None
+        gdm_end = pd.Timestamp(end) if end is not None else None
+
+        if gdm is None:
+            logging.error('gdm processing failed and processing will be aborted')
+            if catalog is not None:
+                catalog.set_status(deployment, mode, 'dba_to_nc', 'failed', 
+                                   'gdm processing failed')
             return
-        
-
-
-    #--------------------------------------------
-    # Create gdm object  
-    logging.info(f'Creating gdm object')
-    gdm = amlr_gdm(
-        deployment, project, mode, glider_path, numcores, 
-        loadfrom_tmp, clobber_tmp
-    )
-
-    if gdm is None:
-        logging.error('gdm processing failed and processing will be aborted')
-        return
 
 
-    #--------------------------------------------
-    # Do various additional processing steps
-
-    # Convert to time series, and write trajectory data to nc file
-    if write_trajectory:
-        amlr_write_trajectory(gdm, deployment, mode, glider_path)
-
-    # Write individual (profile) nc files
-    if write_ngdac:
-        nc_ngdac_path = os.path.join(glider_path, 'data', 'nc', 'ngdac', mode)
-        amlr_write_ngdac(gdm, deployment, mode, nc_ngdac_path)
-
-
-    # Write acoustics files
-    if write_acoustics: 
-        logging.info("write_acoustics is True, and thus writing acoustic files")
-        if mode == 'rt':
-            logging.warning('You are creating acoustic data files ' + 
-                'using real-time data. ' + 
-                'This may result in inaccurate acoustic file metadata')
-        amlr_acoustics_metadata(gdm, deployment_mode, glider_path)
-
-    # Write imagery metadata file
-    if write_imagery:
-        logging.info("write_imagery is True, and thus writing acoustic files")
-        if mode == 'rt':
-            logging.warning('You are creating imagery file metadata ' + 
-                'using real-time data. ' + 
-                'This may result in inaccurate imagery file metadata')
-        amlr_imagery_metadata(
-            gdm, deployment, glider_path, 
-            os.path.join(imagery_path, 'gliders', args.ugh_imagery_year, deployment)
-        )
+        #--------------------------------------------
+        # Do various additional processing steps
+
+        # Outputs that were not written or uploaded; 
+        #   their stages are not recorded as done
+        outputs_failed = []
+
+        # Convert to time series, and write trajectory data to nc file
+        if write_trajectory and not stage_done('trajectory'):
+            with step('trajectory'):
+                out = amlr_write_trajectory(gdm, deployment, mode, glider_path, 
+                                            scratch_path=scratch_path, storage=storage, 
+                                            catalog=catalog, start=gdm_start, end=gdm_end)
+            if out is None:
+                outputs_failed.append('trajectory')
+            elif checkpoint is not None:
+                checkpoint.set_stage_done('trajectory')
+
+        # Write individual (profile) nc files
+        if write_ngdac and not stage_done('ngdac'):
+            nc_ngdac_path = os.path.join(glider_path, 'data', 'nc', 'ngdac', mode)
+            with step('ngdac'):
+                out = amlr_write_ngdac(gdm, deployment, mode, nc_ngdac_path, scratch_path, 
+                                       storage, catalog, checkpoint)
+            # Latency from the arrival of the newest segments, 
+            #   as recorded by amlr_scrape_sfmc.py
+            if args.metrics_path != '':
+                metric_ngdac_latency(args.metrics_path, deployment, mode)
+            if out is None:
+                outputs_failed.append('ngdac')
+            elif checkpoint is not None:
+                checkpoint.set_stage_done('ngdac')
+
+        # Write all profiles to one ragged array nc file
+        if write_ragged and not stage_done('ragged'):
+            out = 0
+            if gdm_start is not None or gdm_end is not None:
+                logging.warning('The ragged array profile file is not ' + 
+                    'written for a time window; reprocess the full deployment')
+            else:
+                nc_ragged_path = os.path.join(glider_path, 'data', 'nc', 'profiles')
+                sensor_defs = amlr_sensor_defs(
+                    os.path.join(glider_path, 'data', 'data-config'), storage)
+                with step('ragged'):
+                    out = amlr_write_profiles_ragged(gdm, deployment, mode, nc_ragged_path, 
+                                                     scratch_path, storage, catalog, 
+                                                     sensor_defs=sensor_defs)
+            if out is None:
+                outputs_failed.append('ragged')
+            elif checkpoint is not None:
+                checkpoint.set_stage_done('ragged')
+
+        # Write acoustics files
+        if write_acoustics and not stage_done('acoustics'): 
+            logging.info("write_acoustics is True, and thus writing acoustic files")
+            if mode == 'rt':
+                logging.warning('You are creating acoustic data files ' + 
+                    'using real-time data. ' + 
+                    'This may result in inaccurate acoustic file metadata')
+            from amlrgliders.acoustics import amlr_acoustics_metadata
+            with step('acoustics'):
+                out = amlr_acoustics_metadata(gdm, deployment_mode, glider_path, scratch_path, 
+                                              storage, catalog, start=gdm_start, end=gdm_end)
+            if out is None:
+                outputs_failed.append('acoustics')
+            elif checkpoint is not None:
+                checkpoint.set_stage_done('acoustics')
+
+        # Write imagery metadata file
+        if write_imagery and not stage_done('imagery'):
+            logging.info("write_imagery is True, and thus writing acoustic files")
+            if mode == 'rt':
+                logging.warning('You are creating imagery file metadata ' + 
+                    'using real-time data. ' + 
+                    'This may result in inaccurate imagery file metadata')
+            from amlrgliders.imagery import amlr_imagery_metadata
+            with step('imagery'):
+                out = amlr_imagery_metadata(
+                    gdm, deployment, glider_path, 
+                    os.path.join(imagery_path, 'gliders', args.ugh_imagery_year, deployment), 
+                    scratch_path=scratch_path, storage=storage, 
+                    imagery_storage=imagery_storage, catalog=catalog, 
+                    start=gdm_start, end=gdm_end
+                )
+            if out is None:
+                outputs_failed.append('imagery')
+            elif checkpoint is not None:
+                checkpoint.set_stage_done('imagery')
+
+        if len(outputs_failed) > 0:
+            logging.error(f"Writing the {', '.join(outputs_failed)} files failed; " + 
+                          'rerun (with --resume, if checkpointing) to write them')
+            if catalog is not None:
+                catalog.set_status(deployment, mode, 'dba_to_nc', 'failed', 
+                                   f"{', '.join(outputs_failed)} failed")
+            return
         
-    # All done
-    logging.info(f'Glider data processing complete for {deployment_mode}')
-    return gdm
+        # All done
+        if checkpoint is not None:
+            checkpoint.clear()
+        if catalog is not None:
+            catalog.set_status(deployment, mode, 'dba_to_nc', 'complete')
+        logging.info(f'Glider data processing complete for {deployment_mode}')
+        metric_set('success', 1)
+        return gdm
 
 
 
@@ -209,8 +346,15 @@ if __name__ == '__main__':
             'If greater than 1, parallel processing via mp.Pool.map will ' + 
             'be used for load_slocum_dbas and ' + 
             '(todo) writing individual (profile) nc files. ' +
-            'This argument must be between 1 and mp.cpu_count(). ' + 
-            'If 0 (the default), all possible cores will be used',
+            'This argument must be between 0 and mp.cpu_count(). ' + 
+            'If 0 (the default), as many cores as fit in --memory_budget ' + 
+            'will be used, estimated from the dba file sizes',
+        default=0)
+
+    arg_parser.add_argument('--memory_budget',
+        type=float,
+        help='Memory budget in GB, used to choose the number of cores ' + 
+            'when --numcores is 0. If 0 (the default), 80%% of available memory',
         default=0)
 
     arg_parser.add_argument('--loadfromtmp',
@@ -218,10 +362,74 @@ if __name__ == '__main__':
             'parquet files in glider/data/tmp directory',
         action='store_true')
     
+    arg_parser.add_argument('--start',
+        type=str,
+        help='Only process the data at or after this time, ' + 
+            "eg '2022-12-10' or '2022-12-10T06:00': only the dba files, " + 
+            'or with --loadfromtmp the row groups of the tmp data file, that ' + 
+            'overlap the time window are read, and the ngdac files, and the ' + 
+            'rows of the trajectory, acoustics, and imagery files, in the ' + 
+            'window are written again. Tmp files are not written',
+        default='')
+
+    arg_parser.add_argument('--end',
+        type=str,
+        help='Only process the data before this time; see --start',
+        default='')
+    
     arg_parser.add_argument('--clobbertmp',
         help='flag; should the tmp (parquet) files be clobbered if they exist',
         action='store_true')
 
+    arg_parser.add_argument('--catalog',
+        help='flag; indicates if the deployment catalog in deployments_path ' + 
+            'should be used: dba and imagery files are taken from the catalog ' + 
+            'rather than listed, and outputs, profiles, and processing ' + 
+            'status are recorded in the catalog',
+        action='store_true')
+
+    arg_parser.add_argument('--resume',
+        help='flag; resume a run that stopped (eg a preempted VM) ' + 
+            'from its checkpoint: completed stages are skipped, and ' + 
+            'parsed dba files and written ngdac files are not redone. ' + 
+            'Requires --checkpoint_every, in both the stopped and resumed runs',
+        action='store_true')
+
+    arg_parser.add_argument('--checkpoint_every',
+        type=int,
+        help='Number of dba files parsed, or ngdac files written, between ' + 
+            'checkpoints. Checkpoints are also saved after each stage. ' + 
+            'If 0, no checkpoints are saved. Checkpoints add storage writes, ' + 
+            'and so are opt-in; eg use 500 for long runs on preemptible VMs',
+        default=0)
+
+    arg_parser.add_argument('--prefetch',
+        help='flag; indicates if dba (or tmp parquet) files should be ' + 
+            'copied from the bucket to local scratch ahead of being read, ' + 
+            'to overlap network I/O with parsing',
+        action='store_true')
+
+    arg_parser.add_argument('--scratch_path',
+        type=str,
+        help='Local directory for prefetched files, and for staging ' + 
+            'output files before they are uploaded. ' + 
+            'If empty (the default), $TMPDIR is used',
+        default='')
+
+    arg_parser.add_argument('--deployments_bucket',
+        type=str,
+        help='GCS bucket that is mounted at deployments_path. ' + 
+            'If specified, files are read and written with the native ' + 
+            'GCS client rather than through gcsfuse, ' + 
+            'and deployments_path does not need to be mounted', 
+        default='')
+
+    arg_parser.add_argument('--imagery_bucket',
+        type=str,
+        help='GCS bucket that is mounted at imagery_path. ' + 
+            'If specified, imagery files are listed with the native GCS client', 
+        default='')
+
     arg_parser.add_argument('--write_trajectory',
         help='flag; indicates if trajectory nc file should be written',
         action='store_true')
@@ -230,6 +438,11 @@ if __name__ == '__main__':
         help='flag; indicates if ngdac nc files should be written',
         action='store_true')
 
+    arg_parser.add_argument('--write_ragged',
+        help='flag; indicates if all profiles should be written to one ' + 
+            'CF contiguous ragged array nc file',
+        action='store_true')
+
     arg_parser.add_argument('--write_acoustics',
         help='flag; indicates if acoustic files should be written',
         action='store_true')
@@ -259,6 +472,9 @@ if __name__ == '__main__':
         help='File to which to write logs',
         default='')
 
+    profile_options(arg_parser)
+    metrics_options(arg_parser)
+
     parsed_args = arg_parser.parse_args()
 
     sys.exit(main(parsed_args))
@@ -3,11 +3,18 @@
 import os
 import sys
 import stat
+import time
+import logging
 import argparse
+import multiprocessing as mp
 from subprocess import run
 
-from amlrgliders.utils import amlr_year_path, find_extensions, amlr_logger
+from amlrgliders.utils import amlr_year_path, find_extensions
 from amlrgliders.scrape_sfmc import access_secret_version, rt_files_mgmt
+from amlrgliders.slocum import amlr_decompress_files
+from amlrgliders.storage import GCSStorage
+from amlrgliders.profiling import profile_options, script_profiler
+from amlrgliders.metrics import metrics_options, script_metrics, metric_set
 
 
 def main(args):
@@ -18,7 +25,11 @@ def main(args):
 
     #--------------------------------------------
     # Set up logger and args variables
-    logger = amlr_logger(args.logfile, args.loglevel, 'amlr_scrape_sfmc')
+    # logger = amlr_logger(args.logfile, args.loglevel, 'amlr_scrape_sfmc')
+    log_level = getattr(logging, args.loglevel.upper())
+    log_format = '%(module)s:%(levelname)s:%(message)s [line %(lineno)d]'
+    logging.basicConfig(format=log_format, level=log_level)
+    logger = logging.getLogger('amlr_scrape_sfmc')
 
     deployment = args.deployment
     project = args.project
@@ -28,6 +39,7 @@ def main(args):
     gcpproject_id = args.gcpproject_id
     bucket = args.bucket
     secret_id = args.secret_id
+    numcores = args.numcores if args.numcores > 0 else mp.cpu_count()
 
     logger.info(f'Pulling files from SFMC for deployment {deployment}')
 
@@ -84,6 +96,9 @@ def main(args):
     # retcode = run(['sshpass', '-p', access_secret_version(gcpproject_id, secret_id), 
     #            'rsync', sfmc_server, sfmc_local_path], 
     # capture_output=True)
+    # Files (and sizes) before the rsync, to count the files scraped
+    sfmc_files_pre = {
+        i.name: i.stat().st_size for i in os.scandir(sfmc_local_path) if i.is_file()}
     retcode = run(['sshpass', '-f', sfmc_pwd_file, 'rsync', sfmc_server, sfmc_local_path], 
         capture_output=True)
     logger.debug(retcode.args)
@@ -97,11 +112,19 @@ def main(args):
         logger.info(f'Successfully completed rsync with SFMC dockerver for {glider}')
         logger.debug(f'Args: {retcode.args}')
         logger.debug(f'stderr: {retcode.stdout}')
+        metric_set('files_scraped', len([
+            i for i in os.scandir(sfmc_local_path) if i.is_file() and 
+            sfmc_files_pre.get(i.name) != i.stat().st_size]))
 
 
+    # Decompress compressed files (eg .scd/.tcd/.ccc) in place, so that 
+    #   they are copied to the bucket as standard binary and cache files
+    amlr_decompress_files(sfmc_local_path, sfmc_local_path, numcores)
+
     # Check for unexpected file extensions
     sfmc_file_ext = find_extensions(sfmc_local_path)
-    file_ext_expected = {".cac", ".CAC", ".sbd", ".tbd", ".ad2"} #, ".cam"
+    file_ext_expected = {".cac", ".CAC", ".ccc", ".CCC", 
+                         ".sbd", ".tbd", ".scd", ".tcd", ".ad2"} #, ".cam"
     file_ext_weird = sfmc_file_ext.difference(file_ext_expected)
     if len(file_ext_weird) > 0:
         x = os.listdir(sfmc_local_path)
@@ -116,6 +139,7 @@ def main(args):
     # https://docs.python.org/3/library/subprocess.html#replacing-bin-sh-shell-command-substitution
 
     logger.info('Starting file management')
+    storage = GCSStorage(bucket, project=gcpproject_id)
     bucket_deployment = f'gs://{bucket}/{project}/{year}/{deployment}'
     bucket_stbd = os.path.join(bucket_deployment, 'data', 'binary', 'rt')
     # TODO: update to acoustics bucket
@@ -128,21 +152,32 @@ def main(args):
 
 
     # cache files
-    rt_files_mgmt(sfmc_file_ext, '.[Cc][Aa][Cc]', name_cac, sfmc_local_path, 
-        f'gs://{bucket}/cache')
+    cac_uploaded = rt_files_mgmt(sfmc_file_ext, '.[Cc][Aa][Cc]', name_cac, sfmc_local_path, 
+        f'gs://{bucket}/cache', storage)
 
-    # sbd/tbd files
-    # TODO: add in support for compressed files
-    rt_files_mgmt(sfmc_file_ext, '.[st]bd', name_stbd, sfmc_local_path, bucket_stbd)
+    # sbd/tbd files, including those decompressed from scd/tcd files
+    stbd_uploaded = rt_files_mgmt(sfmc_file_ext, '.[st]bd', name_stbd, 
+        sfmc_local_path, bucket_stbd, storage)
+    if stbd_uploaded:
+        # New segments, for the latency of the NGDAC files made from them
+        metric_set('segments_arrived', len(stbd_uploaded))
+        metric_set('segment_arrival_timestamp_seconds', time.time())
 
     # ad2 files
-    rt_files_mgmt(sfmc_file_ext, '.ad2', name_ad2, sfmc_local_path, bucket_ad2)
+    ad2_uploaded = rt_files_mgmt(sfmc_file_ext, '.ad2', name_ad2, 
+        sfmc_local_path, bucket_ad2, storage)
 
     # # cam files TODO
     # rt_files_mgmt(sfmc_file_ext, '.cam', name_cam, sfmc_local_path, bucket_cam)
 
 
     #--------------------------------------------
+    # Files that were not copied are retried by the next scrape, 
+    #   but the scrape is not successful
+    if any(i is None for i in [cac_uploaded, stbd_uploaded, ad2_uploaded]):
+        logger.error('Not all files were copied to the bucket')
+        return
+
     return 0
 
 
@@ -191,6 +226,12 @@ if __name__ == '__main__':
         help='GCP secret ID that contains the SFMC password for the rsync', 
         default='sfmc-swoodman')
 
+    arg_parser.add_argument('--numcores',
+        type=int,
+        help='Number of cores to use when decompressing compressed files ' + 
+            '(eg .scd/.tcd). If 0 (the default), all possible cores will be used',
+        default=0)
+
     arg_parser.add_argument('-l', '--loglevel',
         type=str,
         help='Verbosity level',
@@ -202,6 +243,23 @@ if __name__ == '__main__':
         help='File to which to write logs',
         default='')
 
+    profile_options(arg_parser)
+    metrics_options(arg_parser)
+
     parsed_args = arg_parser.parse_args()
 
-    sys.exit(main(parsed_args))
+    # Profile files are written to the deployment scripts directory in the bucket
+    deployment_path = os.path.join(
+        f'gs://{parsed_args.bucket}', parsed_args.project, 
+        amlr_year_path(parsed_args.project, parsed_args.deployment.split('-')), 
+        parsed_args.deployment)
+    with script_profiler(
+            parsed_args, os.path.join(deployment_path, 'scripts'), 
+            f'{parsed_args.deployment}-scrape_sfmc', 
+            storage=GCSStorage(parsed_args.bucket, project=parsed_args.gcpproject_id) 
+                if parsed_args.profile else None), \
+            script_metrics(parsed_args, 'scrape_sfmc', parsed_args.deployment, 'rt'):
+        exit_code = main(parsed_args)
+        if exit_code == 0:
+            metric_set('success', 1)
+    sys.exit(exit_code)
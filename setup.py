@@ -8,6 +8,13 @@ setup(name='amlr-gliders',
       author_email='sam.woodman@noaa.gov',
       license='CC0',
       packages=['amlrgliders'],
+      entry_points={
+            'console_scripts': [
+                  'amlr-process=amlrgliders.process:main', 
+                  'amlr-batch=amlrgliders.batch:main', 
+                  'amlr-worker=amlrgliders.worker:main'
+            ]
+      },
       python_requires='>=3.9, !=3.10.*',
       install_requires=[
             'google-crc32c==1.1',
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from amlrgliders.bulk_move import amlr_bulk_move
+from amlrgliders.storage import LocalStorage
+
+
+class InterruptedStorage(LocalStorage):
+    """
+    LocalStorage that raises after n_chunks calls to move_many
+    """
+    def __init__(self, n_chunks):
+        super().__init__(max_workers=1)
+        self.n_chunks = n_chunks
+
+    def move_many(self, pairs):
+        if self.n_chunks == 0:
+            raise KeyboardInterrupt
+        self.n_chunks -= 1
+        return super().move_many(pairs)
+
+
+def test_resume_does_not_move_twice(tmp_path):
+    path = str(tmp_path / 'bm')
+    for i in ['f1.jpg', 'f2.jpg']:
+        os.makedirs(os.path.join(path, 'images'), exist_ok=True)
+        open(os.path.join(path, 'images', i), 'w').close()
+    replace = [('images/', 'images/2022/')]
+    journal_file = str(tmp_path / 'journal.txt')
+
+    with pytest.raises(KeyboardInterrupt):
+        amlr_bulk_move(InterruptedStorage(1), path, replace,
+                       journal_file=journal_file, chunk_size=1)
+    counts = amlr_bulk_move(LocalStorage(max_workers=1), path, replace,
+                            journal_file=journal_file, chunk_size=1)
+
+    assert counts['moved'] == 1
+    assert counts['skipped'] == 1
+    assert sorted(LocalStorage().walk_files(path)) == [
+        os.path.join('images', '2022', 'f1.jpg'),
+        os.path.join('images', '2022', 'f2.jpg'),
+    ]